@@ -0,0 +1,149 @@
+# batch.py
+# Several AOIs (the features of one FeatureCollection) in one job. They go through the
+# pipeline once, as one MultiPolygon: the S1/S2 calls are made per grid tile of the union
+# and shared by every AOI in the tile, and the model gets the combined pixels in
+# MODEL_INFERENCE batches. The map and ragi coverage are then split back out per AOI.
+import math
+
+import numpy as np
+from django.conf import settings
+
+from api import metrics
+from api.geometry import bbox, points_in_polygons, polygons, wrap_like
+from api.output import PredictionMap
+from api.pipeline import run_pipeline
+from api.utils import offload
+
+batch_aois = metrics.histogram("batch_aois", "AOIs per batch job", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+batch_edge_pixels = metrics.counter(
+    "batch_edge_pixels_total", "Batch pixels inside none of the AOIs, given to the nearest one")
+
+
+def is_position(position):
+    return isinstance(position, list) and len(position) >= 2 and all(
+        isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value) for value in position[:2])
+
+
+def ring_problem(polygon):
+    # What makes the polygon's rings unusable, or None: each ring is a closed list of at least
+    # 4 [lon, lat] positions.
+    if not isinstance(polygon, list) or not polygon:
+        return "has a polygon without rings"
+    for ring in polygon:
+        if not isinstance(ring, list) or len(ring) < 4:
+            return "has a ring with fewer than 4 positions"
+        if not all(map(is_position, ring)):
+            return "has a position that is not a [lon, lat] pair of numbers"
+        if ring[0][:2] != ring[-1][:2]:
+            return "has a ring that is not closed"
+    return None
+
+
+def aois(geojson):
+    # [{"id", "polygons", "bounds"}] for the features of a FeatureCollection, in order. The id
+    # is the feature's id, else its "id" property, else its index. Raises ValueError.
+    if not isinstance(geojson, dict) or geojson.get("type") != "FeatureCollection":
+        raise ValueError("geojson must be a FeatureCollection with one feature per AOI")
+    features = geojson.get("features")
+    if not isinstance(features, list) or not features:
+        raise ValueError("geojson has no features")
+    if len(features) > settings.BATCH["MAX_AOIS"]:
+        raise ValueError(f"At most {settings.BATCH['MAX_AOIS']} AOIs per batch, got {len(features)}")
+    result = []
+    for index, feature in enumerate(features):
+        try:
+            polygon_list = polygons(feature) if isinstance(feature, dict) else []
+        except (KeyError, TypeError):
+            raise ValueError(f"Feature {index} has a malformed geometry")
+        if not polygon_list:
+            raise ValueError(f"Feature {index} has no Polygon or MultiPolygon geometry")
+        for polygon in polygon_list:
+            problem = ring_problem(polygon)
+            if problem is not None:
+                raise ValueError(f"Feature {index} {problem}")
+        properties = feature.get("properties")
+        result.append({
+            "id": feature.get("id", properties.get("id", index) if isinstance(properties, dict) else index),
+            "polygons": polygon_list,
+            "bounds": bbox(polygon_list),
+        })
+    return result
+
+
+def union(geojson, aoi_list):
+    # All AOIs as one MultiPolygon feature, so the tiles and the pipeline see a single AOI.
+    geometry = {"type": "MultiPolygon", "coordinates": [p for aoi in aoi_list for p in aoi["polygons"]]}
+    return wrap_like(geojson, geometry)
+
+
+async def run_batch(geojson_data, startDate, endDate, flag, progress, trace=None):
+    # Same arguments and result as run_pipeline, with the output split per AOI.
+    aoi_list = aois(geojson_data)
+    batch_aois.observe(len(aoi_list))
+    result = await run_pipeline(union(geojson_data, aoi_list), startDate, endDate, flag, progress, trace)
+    if "error" in result:
+        return result
+    # run_pipeline may share its result with identical submissions, so it is not modified.
+    return {**result, "output": await offload(split_output, result["output"], aoi_list)}
+
+
+def coverage(predictions):
+    total = len(predictions)
+    ragi_count = int((predictions == 1).sum())
+    return {
+        "ragiCoverage": round(ragi_count / total * 100, 2) if total else 0,
+        "nonRagiCoverage": round((total - ragi_count) / total * 100, 2) if total else 0,
+    }
+
+
+def assign_pixels(aoi_list, lon, lat):
+    # Pixel indices per AOI, by pixel centre. Pixels in overlapping AOIs belong to each; edge
+    # pixels the extraction returned just outside every AOI go to the nearest one by bbox.
+    assigned = np.zeros(len(lon), dtype=bool)
+    selections = []
+    for aoi in aoi_list:
+        west, south, east, north = aoi["bounds"]
+        candidates = np.flatnonzero((lon >= west) & (lon <= east) & (lat >= south) & (lat <= north))
+        index = candidates[points_in_polygons(aoi["polygons"], lon[candidates], lat[candidates])]
+        assigned[index] = True
+        selections.append(index)
+
+    edge = np.flatnonzero(~assigned)
+    if len(edge):
+        west, south, east, north = np.array([aoi["bounds"] for aoi in aoi_list], dtype=np.float64).T
+        x, y = lon[edge, None], lat[edge, None]
+        dx = np.maximum(np.maximum(west - x, x - east), 0)
+        dy = np.maximum(np.maximum(south - y, y - north), 0)
+        nearest = np.argmin(dx * dx + dy * dy, axis=1)
+        for i in np.unique(nearest):
+            selections[i] = np.sort(np.concatenate([selections[i], edge[nearest == i]]))
+        batch_edge_pixels.inc(len(edge))
+    return selections, len(edge)
+
+
+def split_output(output, aoi_list):
+    # The map lists each AOI's pixels in turn; metrics["aois"][i] has the offset and number of
+    # AOI i's pixels in it and their coverage. The top-level metrics count every pixel once.
+    prediction_map = output["map"]
+    selections, edge_pixels = assign_pixels(aoi_list, prediction_map.coords[:, 0], prediction_map.coords[:, 1])
+    summaries = []
+    offset = 0
+    for aoi, index in zip(aoi_list, selections):
+        summaries.append({
+            "id": aoi["id"],
+            "offset": offset,
+            "pixels": len(index),
+            **coverage(prediction_map.predictions[index]),
+        })
+        offset += len(index)
+    index = np.concatenate(selections)
+    return {
+        **output,
+        "map": PredictionMap(prediction_map.coords[index], prediction_map.predictions[index]),
+        "metrics": {
+            **output["metrics"],
+            "pixels": len(prediction_map),
+            "edgePixels": edge_pixels,
+            "aois": summaries,
+        },
+    }
@@ -0,0 +1,159 @@
+# cache.py
+# Content-addressed cache for S1/S2 extraction results (ExtractionBlocks): an in-process LRU
+# tier bounded by bytes, optionally backed by a shared Django cache (e.g. Redis) for all replicas.
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from api import metrics
+from api.geometry import iter_geometries, ring_area
+
+cache_requests = metrics.counter(
+    "extraction_cache_requests_total", "Extraction cache lookups", ("tier", "result"))
+cache_evictions = metrics.counter(
+    "extraction_cache_evictions_total", "Entries evicted from the in-process extraction cache", ("reason",))
+cache_bytes = metrics.gauge("extraction_cache_bytes", "Approximate size of the in-process extraction cache")
+
+COORDINATE_PRECISION = 7
+
+
+def _round(coords):
+    if coords and isinstance(coords[0], (int, float)):
+        return [round(float(c), COORDINATE_PRECISION) for c in coords]
+    return [_round(c) for c in coords]
+
+
+def _canonical_ring(ring):
+    # Same ring regardless of starting vertex or winding: drop the closing vertex, wind
+    # counter-clockwise and start at the smallest vertex.
+    points = [tuple(p[:2]) for p in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+    if not points:
+        return []
+    if ring_area(points) < 0:
+        points.reverse()
+    start = points.index(min(points))
+    points = points[start:] + points[:start]
+    return [list(p) for p in points + points[:1]]
+
+
+def _canonical_geometry(geometry):
+    kind = geometry["type"]
+    coords = _round(geometry.get("coordinates", []))
+    if kind == "Polygon":
+        coords = [_canonical_ring(ring) for ring in coords]
+    elif kind == "MultiPolygon":
+        coords = sorted([_canonical_ring(ring) for ring in polygon] for polygon in coords)
+    return {"type": kind, "coordinates": coords}
+
+
+def canonical_geometry(geojson):
+    # Feature/FeatureCollection wrappers and properties do not change what gets extracted.
+    geometries = sorted(json.dumps(_canonical_geometry(g), separators=(",", ":")) for g in iter_geometries(geojson))
+    return "[" + ",".join(geometries) + "]"
+
+
+def geometry_key(namespace, geojson, *parts):
+    canonical = "|".join([canonical_geometry(geojson), *map(str, parts)])
+    return f"{namespace}:" + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def extraction_key(source, geojson, start_date, end_date):
+    # "block": entries are parsed blocks, not the raw response bodies cached previously.
+    return geometry_key(f"extract:{source}", geojson, source, start_date, end_date, "block")
+
+
+class LRUCache:
+    # evictions / size_gauge are the metrics to report to; labels are added to both.
+    def __init__(self, max_bytes, ttl, evictions=cache_evictions, size_gauge=cache_bytes, **labels):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = evictions
+        self.size_gauge = size_gauge
+        self.labels = labels
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, size, value = entry
+            if expires <= time.monotonic():
+                self._remove(key, "expired")
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key, "replaced")
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)), "size")
+            self.size_gauge.set(self.size, **self.labels)
+
+    def _remove(self, key, reason):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+        self.evictions.inc(reason=reason, **self.labels)
+        self.size_gauge.set(self.size, **self.labels)
+
+
+class ExtractionCache:
+    def __init__(self, conf):
+        self.enabled = conf["ENABLED"]
+        self.local = LRUCache(conf["MAX_BYTES"], conf["TTL"])
+        self.shared_alias = conf.get("SHARED_ALIAS")
+        self.shared_ttl = conf.get("SHARED_TTL", conf["TTL"])
+
+    async def get(self, key):
+        if not self.enabled:
+            return None
+        value = self.local.get(key)
+        cache_requests.inc(tier="local", result="hit" if value is not None else "miss")
+        if value is not None or not self.shared_alias:
+            return value
+
+        try:
+            value = await caches[self.shared_alias].aget(key)
+        except Exception as e:
+            print(f"Shared extraction cache unavailable: {e}")
+            value = None
+        cache_requests.inc(tier="shared", result="hit" if value is not None else "miss")
+        if value is not None:
+            self.local.set(key, value, value.nbytes)
+        return value
+
+    async def set(self, key, value):
+        # Entries are sized by value.nbytes; the shared tier stores them pickled.
+        if not self.enabled:
+            return
+        self.local.set(key, value, value.nbytes)
+        if self.shared_alias:
+            try:
+                await caches[self.shared_alias].aset(key, value, self.shared_ttl)
+            except Exception as e:
+                print(f"Shared extraction cache unavailable: {e}")
+
+
+_extraction_cache = None
+
+
+def get_extraction_cache():
+    global _extraction_cache
+    if _extraction_cache is None:
+        _extraction_cache = ExtractionCache(settings.EXTRACTION_CACHE)
+    return _extraction_cache
@@ -1,27 +1,46 @@
 # consumers.py
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.layers import get_channel_layer
+from django.conf import settings
+
+from api.jobs import get_job_store, notify_abandoned, request_cancel
+from api.progress import is_valid_job_id, job_group
 
 class MyWebSocketConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.group_name = "satellite_progress"
+        self.job_id = self.scope["url_route"]["kwargs"]["job_id"]
+        if not is_valid_job_id(self.job_id):
+            await self.close(code=4400)
+            return
+        self.group_name = job_group(self.job_id)
         await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await get_job_store().subscribers(self.job_id, 1)
+        self.subscribed = True
         await self.accept()
-        await self.send(text_data=json.dumps({"message": "WebSocket Connected"}))
+        await self.send(text_data=json.dumps({"message": "WebSocket Connected", "jobId": self.job_id}))
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if getattr(self, "subscribed", False):
+            remaining = await get_job_store().subscribers(self.job_id, -1)
+            if remaining == 0 and settings.JOBS["CANCEL_ABANDONED"]:
+                await notify_abandoned(self.job_id)
 
     async def receive(self, text_data):
         data = json.loads(text_data)
+        if isinstance(data, dict) and data.get("action") == "cancel":
+            await request_cancel(self.job_id, "socket")
+            await self.send(text_data=json.dumps({"type": "cancelling", "jobId": self.job_id}))
+            return
         await self.send(text_data=json.dumps({"message": f"Received: {data}"}))
 
     async def send_notification(self, event):
         message = event["message"]
         await self.send(text_data=json.dumps({
             "type": message.get("type"),
+            "jobId": message.get("jobId"),
             "startProgress": message.get("startProgress"),
             "endProgress": message.get("endProgress"),
             "message": message.get("message")
-        }))
\ No newline at end of file
+        }))
@@ -0,0 +1,126 @@
+# encoding.py
+# JSON serialization for large payloads and response compression. orjson (numpy-aware) is
+# used when installed and JSON_SERIALIZER allows it, the stdlib encoder otherwise; bodies
+# are gzip- or brotli-compressed as negotiated from Accept-Encoding.
+import gzip
+import json
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def use_orjson():
+    return orjson is not None and settings.JSON_SERIALIZER in ("auto", "orjson")
+
+
+def dumps(data):
+    # Returns UTF-8 bytes. NaN is written as null by both encoders.
+    if use_orjson():
+        return orjson.dumps(data, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    try:
+        encoded = json.dumps(data, default=_default, allow_nan=False, separators=(",", ":"))
+    except ValueError:
+        encoded = json.dumps(_replace_nan(data), default=_default, allow_nan=False, separators=(",", ":"))
+    return encoded.encode("utf-8")
+
+
+def _replace_nan(data):
+    if isinstance(data, float):
+        return None if data != data else data
+    if isinstance(data, dict):
+        return {key: _replace_nan(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_replace_nan(value) for value in data]
+    return data
+
+
+def dumps_records(df):
+    # DataFrame rows as a JSON list of objects, e.g. the model request body.
+    return dumps(df.to_dict(orient="records"))
+
+
+class FastJsonResponse(HttpResponse):
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content=dumps(data), **kwargs)
+
+
+def accepted_encoding(request):
+    # "br" or "gzip" if the client accepts it (q > 0) and compression is enabled, else None.
+    if not settings.RESPONSE_COMPRESSION["ENABLED"]:
+        return None
+    accepted = {}
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def compress(response, encoding):
+    # Compresses the body in place; small bodies and streams are left alone.
+    conf = settings.RESPONSE_COMPRESSION
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if encoding is None or response.streaming or response.has_header("Content-Encoding"):
+        return response
+    if len(response.content) < conf["MIN_BYTES"]:
+        return response
+    if encoding == "br":
+        response.content = brotli.compress(response.content, quality=conf["BROTLI_QUALITY"])
+    else:
+        response.content = gzip.compress(response.content, compresslevel=conf["GZIP_LEVEL"], mtime=0)
+    response["Content-Encoding"] = encoding
+    response["Content-Length"] = str(len(response.content))
+    return response
+
+
+class StreamCompressor:
+    # Incremental gzip/brotli for streamed bodies; every chunk is flushed so the client
+    # can decode it as soon as it arrives.
+    def __init__(self, encoding):
+        conf = settings.RESPONSE_COMPRESSION
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=conf["BROTLI_QUALITY"])
+        else:
+            self._compressor = zlib.compressobj(conf["GZIP_LEVEL"], zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
@@ -0,0 +1,240 @@
+# features.py
+# Columnar S1/S2 merge: the per-pixel, per-month responses are kept as flat typed arrays
+# and merged into one dense float32 cube (pixels x months x features) plus a fill mask.
+import math
+import operator
+import re
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from api.pixels import PixelIndex
+
+S1_FEATURES = ["VV", "VH", "VH_VV"]
+S2_FEATURES = ["NDVI", "EVI", "GNDVI", "SAVI", "NDWI", "NDMI", "RENDVI"]
+ALL_FEATURES = S1_FEATURES + S2_FEATURES
+MONTH_LABEL = re.compile(r"(\d{4})-(\d{1,2})(?!\d)")
+
+
+class FeatureCube:
+    # pixels: PixelIndex; row i of values/mask is pixel id i (S1 response order)
+    # months: month labels in first-seen order
+    # values: float32 (pixels, months, len(ALL_FEATURES)); S2 features are 0 where S2 had no data
+    # mask:   bool (pixels, months), True where S1 reported that month for the pixel
+    def __init__(self, pixels, months, values, mask):
+        self.pixels = pixels
+        self.months = months
+        self.values = values
+        self.mask = mask
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @property
+    def coords(self):
+        return self.pixels.coords
+
+
+def label_month(label):
+    # (year, month) of a month label that starts with it ("2024-01", "2024-01-01"), else None.
+    match = MONTH_LABEL.match(str(label))
+    if match is None or not 1 <= int(match.group(2)) <= 12:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def month_order(label):
+    # Sort key: chronological for labels label_month reads; others keep their order, last.
+    month = label_month(label)
+    return (0, *month) if month is not None else (1,)
+
+
+def is_error(data):
+    return isinstance(data, dict) and "error" in data and "status_code" in data
+
+
+class ExtractionBlock:
+    # One extraction response ({"lon,lat": {month: {feature: value}}}) as flat typed arrays:
+    # one row per reported (pixel, month) instead of a dict per pixel and month. Members are
+    # added one at a time as they are parsed, so the nested dict is never built.
+    def __init__(self, features):
+        self.features = features
+        self.pixels = PixelIndex()
+        self.months = {}
+        self.rows = array("i")
+        self.cols = array("i")
+        self.values = array("d")
+        self._getter = operator.itemgetter(*features)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def from_dict(cls, data, features):
+        block = cls(features)
+        for key, monthly in data.items():
+            block.add(key, monthly)
+        return block
+
+    @classmethod
+    def from_arrays(cls, features, keys, months, rows, cols, values):
+        # The inverse of pixels.keys, months and row_array()/col_array()/value_array(), e.g.
+        # for a block read back from the spatial store (api/store.py).
+        block = cls(features)
+        block.pixels.add(keys)
+        block.months = {month: j for j, month in enumerate(months)}
+        block.rows.frombytes(np.ascontiguousarray(rows, dtype=np.int32).tobytes())
+        block.cols.frombytes(np.ascontiguousarray(cols, dtype=np.int32).tobytes())
+        block.values.frombytes(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return block
+
+    @property
+    def nbytes(self):
+        keys = sum(len(key) for key in self.pixels.keys) + 100 * len(self.pixels)
+        return keys + sum(len(a) * a.itemsize for a in (self.rows, self.cols, self.values))
+
+    def add(self, key, monthly):
+        if not isinstance(monthly, dict):
+            return
+        i = self.pixels.add_key(key)
+        for month, values in monthly.items():
+            j = self.months.get(month)
+            if j is None:
+                j = self.months[month] = len(self.months)
+            n = len(self.values)
+            try:
+                self.values.extend(self._getter(values))
+            except (KeyError, TypeError):
+                # Missing features are 0 and nulls NaN, as they were in the merged dicts.
+                del self.values[n:]
+                self.values.extend([math.nan if v is None else v for v in (values.get(f, 0) for f in self.features)])
+            self.rows.append(i)
+            self.cols.append(j)
+
+    def update(self, other):
+        # Appends the rows of another block (e.g. the next tile); for a pixel and month
+        # reported by both, the rows added last win when the cube is filled.
+        pixel_map = np.fromiter(map(self.pixels.add_key, other.pixels.keys), dtype=np.int32, count=len(other.pixels))
+        month_map = np.array([self.months.setdefault(month, len(self.months)) for month in other.months], dtype=np.int32)
+        self.rows.frombytes(pixel_map[other.row_array()].tobytes())
+        self.cols.frombytes(month_map[other.col_array()].tobytes())
+        self.values.extend(other.values)
+
+    def sort_months(self):
+        # Puts the months in chronological order (see month_order), as one extraction of the
+        # whole range would have them; the model's feature columns follow this order.
+        order = sorted(self.months, key=month_order)
+        if order != list(self.months):
+            remap = np.array([order.index(month) for month in self.months], dtype=np.int32)
+            cols = remap[self.col_array()]
+            self.cols = array("i", cols.tobytes())
+            self.months = {month: j for j, month in enumerate(order)}
+        return self
+
+    def chunks(self, size):
+        # The block as blocks of `size` pixels each, in pixel id order (ids within a chunk start
+        # at 0), e.g. to store a job's results so that a page reads only the chunks it covers.
+        rows = self.row_array()
+        order = np.argsort(rows, kind="stable")  # stable: the rows added last still win
+        rows, cols, values = rows[order], self.col_array()[order], self.value_array()[order]
+        months = list(self.months)
+        for start in range(0, len(self.pixels), size):
+            first, last = np.searchsorted(rows, [start, start + size])
+            yield ExtractionBlock.from_arrays(
+                self.features, self.pixels.keys[start:start + size], months,
+                rows[first:last] - start, cols[first:last], values[first:last],
+            )
+
+    # Views over the arrays; they must not outlive further add()/update() calls.
+    def row_array(self):
+        return np.frombuffer(self.rows, dtype=np.int32)
+
+    def col_array(self):
+        return np.frombuffer(self.cols, dtype=np.int32)
+
+    def value_array(self):
+        return np.frombuffer(self.values, dtype=np.float64).reshape(-1, len(self.features))
+
+    def to_dict(self, start=0, stop=None):
+        # The response as the extraction service sent it (used when it is echoed back), or
+        # the part of it for pixel ids start <= id < stop.
+        keys, months = self.pixels.keys, list(self.months)
+        rows, cols, values = self.row_array(), self.col_array(), self.value_array()
+        if start or stop is not None:
+            selected = (rows >= start) & (rows < (len(self.pixels) if stop is None else stop))
+            rows, cols, values = rows[selected], cols[selected], values[selected]
+        missing = np.isnan(values)
+        if missing.any():
+            values = values.astype(object)
+            values[missing] = None
+        result = {}
+        for i, j, row in zip(rows.tolist(), cols.tolist(), values.tolist()):
+            result.setdefault(keys[i], {})[months[j]] = dict(zip(self.features, row))
+        return result
+
+
+def combine_blocks(blocks):
+    # One block from blocks holding different months of the same area (stored months and the
+    # months fetched to complete them, see api/store.py).
+    combined = ExtractionBlock(blocks[0].features)
+    for block in sorted(blocks, key=lambda block: min(map(month_order, block.months), default=(1,))):
+        combined.update(block)
+    return combined.sort_months()
+
+
+def extraction_results(results):
+    # The raw S1/S2 responses ({"s1": ..., "s2": ...}) rebuilt from the blocks; sources that
+    # failed are error dicts and are passed through.
+    return {source: data.to_dict() if isinstance(data, ExtractionBlock) else data for source, data in results.items()}
+
+
+def merge_s1_s2(s1, s2):
+    # s1 and s2 are ExtractionBlocks, or error dicts when the sensor failed for every tile.
+    # Pixels missing from s2 (e.g. of a tile whose S2 call failed) get zero S2 features.
+    if is_error(s1):
+        raise RuntimeError(f"{s1['error']} (HTTP {s1['status_code']})")
+    if is_error(s2):
+        # Same as before: missing Sentinel-2 data is filled with zeros.
+        print(f"Warning: {s2['error']} (HTTP {s2['status_code']}); using zero S2 features")
+        s2 = ExtractionBlock(S2_FEATURES)
+
+    pixels = s1.pixels
+    months = list(s1.months)
+    cube = np.zeros((len(pixels), len(months), len(ALL_FEATURES)), dtype=np.float32)
+    mask = np.zeros((len(pixels), len(months)), dtype=bool)
+
+    s1_rows, s1_cols = s1.row_array(), s1.col_array()
+    cube[s1_rows, s1_cols, :len(S1_FEATURES)] = s1.value_array()
+    mask[s1_rows, s1_cols] = True
+
+    # S2 pixels and months are matched to S1's; S2-only pixels and months are dropped.
+    if len(s2):
+        rows = pixels.match(s2.pixels)[s2.row_array()]
+        cols = np.array([s1.months.get(month, -1) for month in s2.months], dtype=np.int64)[s2.col_array()]
+        keep = (rows >= 0) & (cols >= 0)
+        if keep.all():
+            cube[rows, cols, len(S1_FEATURES):] = s2.value_array()
+        else:
+            cube[rows[keep], cols[keep], len(S1_FEATURES):] = s2.value_array()[keep]
+
+    return FeatureCube(pixels, months, cube, mask)
+
+
+def feature_columns(months):
+    return [f"{feat}_{month}" for month in months for feat in ALL_FEATURES]
+
+
+def feature_table(cube, include_ids=False):
+    # Model input: [id,] lon, lat, then <feature>_<month> for every month. Months a pixel did
+    # not report in S1 are NaN, as they were when rows were built from dicts.
+    n, m, f = cube.values.shape
+    matrix = cube.values.reshape(n, m * f).copy()
+    if not cube.mask.all():
+        matrix[~np.repeat(cube.mask, f, axis=1)] = np.nan
+    df = pd.DataFrame(matrix, columns=feature_columns(cube.months))
+    df.insert(0, "lat", cube.coords[:, 1])
+    df.insert(0, "lon", cube.coords[:, 0])
+    if include_ids:
+        df.insert(0, "id", np.arange(n, dtype=np.int64))
+    return df
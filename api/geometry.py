@@ -0,0 +1,160 @@
+# geometry.py
+# Small GeoJSON helpers (lon/lat degrees) so the backend does not need shapely.
+import math
+
+import numpy as np
+
+
+def iter_geometries(geojson):
+    kind = geojson.get("type") if isinstance(geojson, dict) else None
+    if kind == "FeatureCollection":
+        for feature in geojson.get("features", []):
+            yield from iter_geometries(feature)
+    elif kind == "Feature":
+        if geojson.get("geometry"):
+            yield from iter_geometries(geojson["geometry"])
+    elif kind == "GeometryCollection":
+        for geometry in geojson.get("geometries", []):
+            yield from iter_geometries(geometry)
+    elif kind is not None:
+        yield geojson
+
+
+def polygons(geojson):
+    # Every polygon in the input as a list of rings; non-areal geometries are skipped.
+    result = []
+    for geometry in iter_geometries(geojson):
+        if geometry["type"] == "Polygon":
+            result.append(geometry["coordinates"])
+        elif geometry["type"] == "MultiPolygon":
+            result.extend(geometry["coordinates"])
+    return result
+
+
+def bbox(polygon_list):
+    xs = [p[0] for polygon in polygon_list for p in polygon[0]]
+    ys = [p[1] for polygon in polygon_list for p in polygon[0]]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def ring_area(points):
+    return sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1])) / 2
+
+
+def _open_ring(ring):
+    points = [(float(p[0]), float(p[1])) for p in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points = points[:-1]
+    return points
+
+
+def polygon_area(polygon):
+    exterior, *holes = [abs(ring_area(_open_ring(ring))) for ring in polygon]
+    return exterior - sum(holes)
+
+
+def points_in_polygons(polygon_list, lon, lat):
+    # Even-odd ray casting for arrays of points; holes are rings like any other, so points
+    # in them cross an even number of edges. Returns a bool array.
+    inside = np.zeros(len(lon), dtype=bool)
+    for polygon in polygon_list:
+        in_polygon = np.zeros(len(lon), dtype=bool)
+        for ring in polygon:
+            points = _open_ring(ring)
+            for (ax, ay), (bx, by) in zip(points, points[1:] + points[:1]):
+                if ay == by:
+                    continue
+                crosses = (ay > lat) != (by > lat)
+                in_polygon ^= crosses & (lon < ax + (lat - ay) * (bx - ax) / (by - ay))
+        inside |= in_polygon
+    return inside
+
+
+def _clip_edge(points, inside, intersect):
+    if not points:
+        return points
+    out = []
+    prev = points[-1]
+    for cur in points:
+        if inside(cur):
+            if not inside(prev):
+                out.append(intersect(prev, cur))
+            out.append(cur)
+        elif inside(prev):
+            out.append(intersect(prev, cur))
+        prev = cur
+    return out
+
+
+def _at_x(x):
+    def intersect(a, b):
+        t = (x - a[0]) / (b[0] - a[0])
+        return (x, a[1] + t * (b[1] - a[1]))
+    return intersect
+
+
+def _at_y(y):
+    def intersect(a, b):
+        t = (y - a[1]) / (b[1] - a[1])
+        return (a[0] + t * (b[0] - a[0]), y)
+    return intersect
+
+
+def clip_ring(ring, xmin, ymin, xmax, ymax):
+    # Sutherland-Hodgman against an axis-aligned box. Concave rings may gain zero-width
+    # slivers along the box edge, which cover no pixels.
+    points = _open_ring(ring)
+    points = _clip_edge(points, lambda p: p[0] >= xmin, _at_x(xmin))
+    points = _clip_edge(points, lambda p: p[0] <= xmax, _at_x(xmax))
+    points = _clip_edge(points, lambda p: p[1] >= ymin, _at_y(ymin))
+    points = _clip_edge(points, lambda p: p[1] <= ymax, _at_y(ymax))
+    if len(points) < 3 or abs(ring_area(points)) < 1e-14:
+        return None
+    return [list(p) for p in points + points[:1]]
+
+
+def clip_polygon(polygon, xmin, ymin, xmax, ymax):
+    exterior = clip_ring(polygon[0], xmin, ymin, xmax, ymax)
+    if exterior is None:
+        return None
+    holes = [clip_ring(ring, xmin, ymin, xmax, ymax) for ring in polygon[1:]]
+    return [exterior, *[hole for hole in holes if hole is not None]]
+
+
+def wrap_like(original, geometry):
+    # Put a geometry in the same envelope (FeatureCollection / Feature / bare geometry)
+    # as the request so the extraction services see a familiar payload.
+    kind = original.get("type") if isinstance(original, dict) else None
+    if kind == "FeatureCollection":
+        return {"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, "geometry": geometry}]}
+    if kind == "Feature":
+        return {"type": "Feature", "properties": original.get("properties") or {}, "geometry": geometry}
+    return geometry
+
+
+def grid_tiles(geojson, tile_size, max_tiles):
+    # Split the areal part of `geojson` on a global grid of `tile_size` degrees, so the same
+    # field always produces the same tiles. The tile size doubles until at most `max_tiles`
+    # tiles remain. Returns [(tile_id, geojson)], or [(None, geojson)] if no split is needed.
+    polygon_list = polygons(geojson)
+    if not polygon_list:
+        return [(None, geojson)]
+    minx, miny, maxx, maxy = bbox(polygon_list)
+    while True:
+        x0, x1 = math.floor(minx / tile_size), math.floor(maxx / tile_size)
+        y0, y1 = math.floor(miny / tile_size), math.floor(maxy / tile_size)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= max_tiles:
+            break
+        tile_size *= 2
+    if x0 == x1 and y0 == y1:
+        return [(None, geojson)]
+
+    tiles = []
+    for ix in range(x0, x1 + 1):
+        for iy in range(y0, y1 + 1):
+            box = tuple(round(v * tile_size, 9) for v in (ix, iy, ix + 1, iy + 1))
+            clipped = [c for c in (clip_polygon(p, *box) for p in polygon_list) if c is not None]
+            if clipped:
+                geometry = {"type": "MultiPolygon", "coordinates": clipped}
+                tiles.append((f"{tile_size:g}:{ix}:{iy}", wrap_like(geojson, geometry)))
+    return tiles
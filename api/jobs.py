@@ -0,0 +1,369 @@
+# jobs.py
+# Background execution of pipeline jobs: a bounded per-process worker pool plus a
+# status/result store with TTL eviction (in-process, or Redis shared by all replicas).
+# Jobs are cancelled through the channel layer, so a request on any replica reaches the
+# one running the job.
+import asyncio
+import json
+import pickle
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from api import metrics
+from api.features import ExtractionBlock
+from api.progress import JobProgress
+from api.utils import offload
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+jobs_submitted = metrics.counter("jobs_submitted_total", "Jobs accepted by the worker pool")
+jobs_finished = metrics.counter("jobs_finished_total", "Jobs that left the worker pool", ("status",))
+jobs_rejected = metrics.counter("jobs_rejected_total", "Jobs rejected because the queue was full")
+jobs_running = metrics.gauge("jobs_running", "Jobs currently executing in this process")
+jobs_queued = metrics.gauge("jobs_queued", "Jobs waiting for a worker in this process")
+jobs_cancelled = metrics.counter("jobs_cancelled_total", "Jobs cancelled before finishing", ("reason", "stage"))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobExists(Exception):
+    pass
+
+
+class LocalJobStore:
+    # Process-local stand-in for the Redis store: plain dicts with lazy TTL eviction.
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._records = {}
+        self._results = {}
+        self._subscribers = {}
+        self._next_sweep = 0
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + min(self.ttl, 60)
+        for data in (self._records, self._results):
+            for key in [key for key, (expires, _) in data.items() if expires <= now]:
+                del data[key]
+
+    def _get(self, data, job_id):
+        entry = data.get(job_id)
+        if entry is None or entry[0] <= time.monotonic():
+            data.pop(job_id, None)
+            return None
+        return entry[1]
+
+    async def create(self, job_id, record):
+        # Returns False, leaving the job alone, if job_id is already known.
+        self._sweep()
+        if self._get(self._records, job_id) is not None:
+            return False
+        self._records[job_id] = (time.monotonic() + self.ttl, dict(record))
+        return True
+
+    async def get(self, job_id):
+        record = self._get(self._records, job_id)
+        return dict(record) if record is not None else None
+
+    async def update(self, job_id, **fields):
+        record = self._get(self._records, job_id)
+        if record is not None:
+            record.update(fields)
+            self._records[job_id] = (time.monotonic() + self.ttl, record)
+
+    async def set_result(self, job_id, result, kind="result"):
+        self._sweep()
+        self._results[job_id, kind] = (time.monotonic() + self.ttl, result)
+
+    async def get_result(self, job_id, kind="result"):
+        return self._get(self._results, (job_id, kind))
+
+    async def subscribers(self, job_id, change=0):
+        # Adds `change` to the job's count of progress sockets and returns the new count.
+        count = max(0, self._subscribers.get(job_id, 0) + change)
+        if count:
+            self._subscribers[job_id] = count
+        else:
+            self._subscribers.pop(job_id, None)
+        return count
+
+
+class RedisJobStore:
+    def __init__(self, url, ttl, prefix="jobs"):
+        self.url = url
+        self.ttl = ttl
+        self.prefix = prefix
+        self._clients = {}
+
+    def _client(self):
+        # redis.asyncio connections belong to the loop that opened them.
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = redis.from_url(self.url)
+        return client
+
+    def _key(self, job_id, kind="record"):
+        return f"{self.prefix}:{job_id}:{kind}"
+
+    async def create(self, job_id, record):
+        # Returns False, leaving the job alone, if any replica already knows job_id.
+        return bool(await self._client().set(self._key(job_id), json.dumps(record), ex=self.ttl, nx=True))
+
+    async def get(self, job_id):
+        raw = await self._client().get(self._key(job_id))
+        return json.loads(raw) if raw is not None else None
+
+    async def update(self, job_id, **fields):
+        record = await self.get(job_id)
+        if record is not None:
+            record.update(fields)
+            await self._client().set(self._key(job_id), json.dumps(record), ex=self.ttl)
+
+    async def set_result(self, job_id, result, kind="result"):
+        # Results hold numpy arrays (api.output.PredictionMap), so they are pickled.
+        await self._client().set(self._key(job_id, kind), pickle.dumps(result, pickle.HIGHEST_PROTOCOL), ex=self.ttl)
+
+    async def get_result(self, job_id, kind="result"):
+        raw = await self._client().get(self._key(job_id, kind))
+        return pickle.loads(raw) if raw is not None else None
+
+    async def subscribers(self, job_id, change=0):
+        key = self._key(job_id, "subscribers")
+        if not change:
+            return max(0, int(await self._client().get(key) or 0))
+        async with self._client().pipeline(transaction=True) as pipe:
+            count, _ = await pipe.incrby(key, change).expire(key, self.ttl).execute()
+        return max(0, count)
+
+
+def results_kind(source, n):
+    # Chunk n of a job's raw `source` results, e.g. Redis key jobs:<id>:results:s1:<n>.
+    return f"results:{source}:{n}"
+
+
+def results_chunks(results, size):
+    # The raw S1/S2 results as an index (stored as kind "results") plus {kind: block} chunks
+    # of `size` pixels each, so that reading one page does not load the whole job's results.
+    index = {"chunkSize": size, "sources": {}}
+    chunks = {}
+    for source, data in results.items():
+        if not isinstance(data, ExtractionBlock):
+            index["sources"][source] = data  # the sensor's error
+            continue
+        parts = list(data.chunks(size))
+        index["sources"][source] = {"total": len(data.pixels), "chunks": len(parts), "features": data.features}
+        chunks.update((results_kind(source, n), part) for n, part in enumerate(parts))
+    return index, chunks
+
+
+async def store_results(store, job_id, results, size):
+    index, chunks = await offload(results_chunks, results, size)
+    for kind, chunk in chunks.items():
+        await store.set_result(job_id, chunk, kind=kind)
+    # Written last: a job whose index is stored has all of its chunks.
+    await store.set_result(job_id, index, kind="results")
+
+
+async def load_results(store, job_id, source, first, last):
+    # Chunks first <= n < last of `source`, or None if any of them has expired.
+    chunks = await asyncio.gather(*(store.get_result(job_id, results_kind(source, n)) for n in range(first, last)))
+    return None if any(chunk is None for chunk in chunks) else chunks
+
+
+def control_group(job_id):
+    return f"jobctl.{job_id}"
+
+
+async def request_cancel(job_id, reason):
+    # Delivered to the runner holding the job, on whichever replica that is.
+    await get_channel_layer().group_send(control_group(job_id), {"type": "job.cancel", "reason": reason})
+
+
+async def notify_abandoned(job_id):
+    # The job's last progress socket closed (see JOBS["CANCEL_ABANDONED"]).
+    await get_channel_layer().group_send(control_group(job_id), {"type": "job.abandoned"})
+
+
+class JobRunner:
+    # At most JOBS["MAX_CONCURRENT"] jobs execute at once; up to JOBS["MAX_QUEUED"] wait.
+    def __init__(self, store, max_concurrent, max_queued):
+        self.store = store
+        self.max_concurrent = max_concurrent
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.futures = {}
+        self.tasks = {}
+        self.cancelled = {}
+        self.listeners = {}
+        self.workers = []
+        self._pending = set()
+
+    def _start_workers(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+
+    async def submit(self, job_id, func, *args):
+        # func(*args) must return the job result dict; {"error": ...} marks a failed job.
+        # Returns a future for the result that callers in this process may await.
+        self._start_workers()
+        if job_id in self.futures:
+            raise JobExists(f"Job {job_id} is already queued or running")
+        if self.queue.full():
+            jobs_rejected.inc()
+            raise QueueFull(f"{self.queue.maxsize} jobs already queued")
+        # Ids are unique for JOB_TTL, so a finished job or one on another replica keeps its record and result.
+        if not await self.store.create(job_id, {"jobId": job_id, "status": QUEUED, "createdAt": time.time()}):
+            raise JobExists(f"Job {job_id} already exists")
+        self.futures[job_id] = asyncio.get_running_loop().create_future()
+        self.listeners[job_id] = asyncio.create_task(self._listen(job_id))
+        self.queue.put_nowait((job_id, func, args))
+        jobs_submitted.inc()
+        jobs_queued.set(self.queue.qsize())
+        return self.futures[job_id]
+
+    async def cancel(self, job_id, reason):
+        # Returns False unless the job is queued or running in this process. A running job
+        # is cancelled where it waits (upstream calls, queued tiles and model batches), and
+        # recorded once it has unwound; a queued one is recorded at once and skipped.
+        future = self.futures.get(job_id)
+        if future is None or future.done() or job_id in self.cancelled:
+            return False
+        self.cancelled[job_id] = reason
+        task = self.tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        else:
+            await self._record_cancelled(job_id, "queued")
+        return True
+
+    async def _record_cancelled(self, job_id, stage):
+        reason = self.cancelled[job_id]
+        jobs_cancelled.inc(reason=reason, stage=stage)
+        jobs_finished.inc(status=CANCELLED)
+        try:
+            await self.store.update(job_id, status=CANCELLED, cancelReason=reason, finishedAt=time.time())
+            await JobProgress(job_id).send("cancelled", message="Job cancelled")
+        except Exception as e:
+            print(f"Could not record cancellation of job {job_id}: {e}")
+        self.futures[job_id].set_result({"error": "Job cancelled", "cancelled": True})
+
+    async def _listen(self, job_id):
+        # Control messages for one job, from any replica, until the job leaves the pool.
+        layer = get_channel_layer()
+        try:
+            channel = await layer.new_channel()
+            await layer.group_add(control_group(job_id), channel)
+            try:
+                while True:
+                    message = await layer.receive(channel)
+                    if message["type"] == "job.cancel":
+                        await self.cancel(job_id, message.get("reason", "client"))
+                    elif message["type"] == "job.abandoned":
+                        task = asyncio.create_task(self._cancel_if_abandoned(job_id))
+                        self._pending.add(task)
+                        task.add_done_callback(self._pending.discard)
+            finally:
+                await layer.group_discard(control_group(job_id), channel)
+        except Exception as e:
+            print(f"Control channel of job {job_id} failed: {e}")
+
+    async def _cancel_if_abandoned(self, job_id):
+        # A reload or a flaky connection reopens the socket within the grace period.
+        await asyncio.sleep(settings.JOBS["ABANDON_GRACE"])
+        if await self.store.subscribers(job_id) == 0:
+            await self.cancel(job_id, "abandoned")
+
+    async def _worker(self):
+        while True:
+            job_id, func, args = await self.queue.get()
+            jobs_queued.set(self.queue.qsize())
+            future = self.futures[job_id]
+            if future.done():
+                # Cancelled while queued.
+                self._forget(job_id)
+                self.queue.task_done()
+                continue
+            jobs_running.inc()
+            try:
+                task = self.tasks[job_id] = asyncio.create_task(func(*args))
+                await self.store.update(job_id, status=RUNNING, startedAt=time.time())
+                try:
+                    result = await task
+                except asyncio.CancelledError:
+                    if job_id not in self.cancelled or not task.done():
+                        raise
+                    await self._record_cancelled(job_id, "running")
+                    continue
+                if isinstance(result, dict) and "error" in result:
+                    await self.store.update(job_id, status=FAILED, error=result["error"], finishedAt=time.time())
+                    jobs_finished.inc(status=FAILED)
+                else:
+                    # The raw extraction results (if any) are stored on their own, in chunks,
+                    # so that reading the map or one page of them does not load them all.
+                    if isinstance(result, dict) and "results" in result:
+                        await store_results(self.store, job_id, result["results"], settings.RESULTS["CHUNK_SIZE"])
+                        await self.store.set_result(job_id, {k: v for k, v in result.items() if k != "results"})
+                    else:
+                        await self.store.set_result(job_id, result)
+                    await self.store.update(job_id, status=SUCCEEDED, finishedAt=time.time())
+                    jobs_finished.inc(status=SUCCEEDED)
+                future.set_result(result)
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                jobs_finished.inc(status=FAILED)
+                try:
+                    await self.store.update(job_id, status=FAILED, error=str(e), finishedAt=time.time())
+                except Exception as store_error:
+                    print(f"Could not record failure of job {job_id}: {store_error}")
+                future.set_result({"error": str(e)})
+            finally:
+                self._forget(job_id)
+                jobs_running.dec()
+                self.queue.task_done()
+
+    def _forget(self, job_id):
+        self.futures.pop(job_id, None)
+        task = self.tasks.pop(job_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+        self.cancelled.pop(job_id, None)
+        listener = self.listeners.pop(job_id, None)
+        if listener is not None:
+            listener.cancel()
+
+
+_store = None
+_runners = {}
+
+
+def get_job_store():
+    global _store
+    if _store is None:
+        conf = settings.JOBS
+        if conf["STORE"] == "redis":
+            _store = RedisJobStore(settings.REDIS_URL, conf["TTL"])
+        else:
+            _store = LocalJobStore(conf["TTL"])
+    return _store
+
+
+def get_job_runner():
+    loop = asyncio.get_running_loop()
+    runner = _runners.get(loop)
+    if runner is None:
+        conf = settings.JOBS
+        runner = _runners[loop] = JobRunner(get_job_store(), conf["MAX_CONCURRENT"], conf["MAX_QUEUED"])
+    return runner
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.19 on 2026-10-18 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cropdata',
+            name='covers_cell',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='data',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='east',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='end_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='geometry_key',
+            field=models.CharField(default='', max_length=80),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='job_id',
+            field=models.CharField(default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='kind',
+            field=models.CharField(default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='north',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='pixels',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='south',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='start_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='cropdata',
+            name='west',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='cropdata',
+            index=models.Index(fields=['kind', 'start_date', 'end_date', 'west'], name='cropdata_kind_dates_west'),
+        ),
+        migrations.AddIndex(
+            model_name='cropdata',
+            index=models.Index(fields=['geometry_key'], name='cropdata_geometry_key'),
+        ),
+    ]
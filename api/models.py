@@ -1,11 +1,32 @@
 from django.db import models
 
 class CropData(models.Model):
-    region_name = models.CharField(max_length=255)
-    latitude = models.FloatField()
+    # One row of the spatial store (api/store.py): the S1 or S2 extraction of one grid tile,
+    # or the predictions of one grid cell, for one date range. The pixels themselves are a
+    # compressed columnar blob in `data`; band_values describes it (features, months, pixels).
+    region_name = models.CharField(max_length=255)  # grid tile or cell id, "<size>:<ix>:<iy>"
+    latitude = models.FloatField()  # centre of the bounds
     longitude = models.FloatField()
     band_values = models.JSONField()  # Stores extracted band values as JSON
     timestamp = models.DateTimeField(auto_now_add=True)
+    kind = models.CharField(max_length=16, default="")  # "s1", "s2" or "prediction"
+    job_id = models.CharField(max_length=64, default="")
+    start_date = models.DateField(null=True)
+    end_date = models.DateField(null=True)
+    west = models.FloatField(null=True)
+    south = models.FloatField(null=True)
+    east = models.FloatField(null=True)
+    north = models.FloatField(null=True)
+    covers_cell = models.BooleanField(default=False)  # the tile is its whole grid cell
+    geometry_key = models.CharField(max_length=80, default="")
+    pixels = models.IntegerField(default=0)
+    data = models.BinaryField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["kind", "start_date", "end_date", "west"], name="cropdata_kind_dates_west"),
+            models.Index(fields=["geometry_key"], name="cropdata_geometry_key"),
+        ]
 
     def __str__(self):
         return f"{self.region_name} - {self.timestamp}"
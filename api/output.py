@@ -0,0 +1,265 @@
+# output.py
+# Pipeline output is kept columnar (PredictionMap) and only encoded when a response is
+# written, in the format the client negotiated: the GeoJSON FeatureCollection (default),
+# packed typed arrays in JSON, a binary column layout, or a raster (api/raster.py).
+# GeoJSON and NDJSON can also be streamed while the result is still being computed.
+import base64
+import inspect
+import json
+import struct
+import time
+
+import numpy as np
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from api import metrics
+from api.encoding import FastJsonResponse, StreamCompressor, compress, dumps
+from api.features import extraction_results
+from api.raster import RasterTooLarge, rasterize, to_geotiff, to_png
+from api.utils import offload
+
+GEOJSON = "geojson"
+PACKED = "packed"
+BINARY = "binary"
+RASTER = "raster"
+PNG = "png"
+GEOTIFF = "geotiff"
+NDJSON = "ndjson"
+FORMATS = (GEOJSON, PACKED, BINARY, RASTER, PNG, GEOTIFF, NDJSON)
+
+MEDIA_TYPES = {
+    PACKED: "application/vnd.cropmap.columns+json",
+    BINARY: "application/vnd.cropmap.columns",
+    RASTER: "application/vnd.cropmap.raster+json",
+    PNG: "image/png",
+    GEOTIFF: "image/tiff",
+    NDJSON: "application/x-ndjson",
+}
+
+STREAM_CHUNK_FEATURES = 2000
+
+BINARY_MAGIC = b"CMAP"
+BINARY_VERSION = 1
+
+encode_seconds = metrics.histogram(
+    "response_encode_seconds", "Time to encode a pipeline result into a response body", ("format",))
+response_bytes = metrics.histogram(
+    "response_bytes", "Size of encoded pipeline result bodies", ("format",),
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+
+
+class PredictionMap:
+    # coords: float64 (n, 2) lon/lat; predictions: int64 (n,) predicted class per pixel
+    def __init__(self, coords, predictions):
+        self.coords = coords
+        self.predictions = predictions
+
+    def __len__(self):
+        return len(self.predictions)
+
+    def columns(self):
+        # Little-endian columns; predictions use the smallest integer type that fits.
+        predictions = self.predictions
+        if not len(predictions) or (predictions.min() >= 0 and predictions.max() <= 255):
+            predictions = predictions.astype(np.uint8)
+        else:
+            predictions = predictions.astype("<i4")
+        return [
+            ("lon", np.ascontiguousarray(self.coords[:, 0], dtype="<f8")),
+            ("lat", np.ascontiguousarray(self.coords[:, 1], dtype="<f8")),
+            ("prediction", predictions),
+        ]
+
+    def features(self, start=0, stop=None):
+        features = []
+        coords, predictions = self.coords[start:stop].tolist(), self.predictions[start:stop].tolist()
+        for (lon, lat), prediction in zip(coords, predictions):
+            features.append({
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "geodesic": False,
+                    "coordinates": [lon, lat]
+                },
+                "properties": {
+                    "prediction": prediction
+                }
+            })
+        return features
+
+    def to_geojson(self):
+        return {"type": "FeatureCollection", "features": self.features()}
+
+    def to_packed(self):
+        columns = {
+            name: {"dtype": values.dtype.str, "data": base64.b64encode(values.tobytes()).decode("ascii")}
+            for name, values in self.columns()
+        }
+        return {"type": "Columns", "count": len(self), **columns}
+
+    def to_binary(self, **header):
+        # "CMAP", version byte, 3 padding bytes, uint32 header length, UTF-8 JSON header, then
+        # the data section from the next 8-byte boundary. Column offsets are relative to the
+        # data section and 8-byte aligned, so each column can be viewed in place
+        # (e.g. new Float64Array(buffer, dataStart + offset, count)).
+        columns = self.columns()
+        layout, size = [], 0
+        for name, values in columns:
+            layout.append({"name": name, "dtype": values.dtype.str, "offset": size, "length": values.nbytes})
+            size += -(-values.nbytes // 8) * 8
+        encoded = json.dumps({**header, "count": len(self), "columns": layout}, separators=(",", ":")).encode("utf-8")
+        data_start = -(-(12 + len(encoded)) // 8) * 8
+
+        body = bytearray(data_start + size)
+        body[:12] = BINARY_MAGIC + struct.pack("<B3xI", BINARY_VERSION, len(encoded))
+        body[12:12 + len(encoded)] = encoded
+        for column, (_, values) in zip(layout, columns):
+            offset = data_start + column["offset"]
+            body[offset:offset + column["length"]] = values.tobytes()
+        return bytes(body)
+
+
+def response_format(request):
+    # ?format=<name> wins over the Accept header; GeoJSON is the default.
+    fmt = request.GET.get("format")
+    if fmt in FORMATS:
+        return fmt
+    accept = request.headers.get("Accept", "")
+    for candidate in MEDIA_TYPES:
+        if any(part.split(";")[0].strip() == MEDIA_TYPES[candidate] for part in accept.split(",")):
+            return candidate
+    return GEOJSON
+
+
+def include_results(request):
+    # ?results=0|1 decides whether a GeoJSON response echoes the raw S1/S2 results;
+    # RESULTS["ECHO"] is the default.
+    value = request.GET.get("results")
+    if value is None:
+        return settings.RESULTS["ECHO"]
+    return value in ("1", "true")
+
+
+def _render_raster(output, fmt, extra):
+    raster = rasterize(output["map"])
+    if fmt == GEOTIFF:
+        return HttpResponse(to_geotiff(raster), content_type=MEDIA_TYPES[GEOTIFF])
+    png = to_png(raster)
+    if fmt == PNG:
+        # [west, south, east, north] of the image's outer edges, for placing the overlay.
+        response = HttpResponse(png, content_type=MEDIA_TYPES[PNG])
+        response["X-Raster-Bounds"] = ",".join(map(repr, raster.bounds))
+        response["Access-Control-Expose-Headers"] = "X-Raster-Bounds"
+        return response
+    height, width = raster.values.shape
+    data = {
+        "output": {
+            "raster": {
+                "bounds": raster.bounds,
+                "width": width,
+                "height": height,
+                "image": "data:image/png;base64," + base64.b64encode(png).decode("ascii"),
+            },
+            "metrics": output["metrics"],
+        },
+        **extra,
+    }
+    return FastJsonResponse(data, content_type=MEDIA_TYPES[RASTER])
+
+
+def render_result(result, fmt, encoding=None, echo_results=True, **extra):
+    # extra (e.g. jobId) is added to the top level of the response; encoding is the
+    # negotiated Content-Encoding (api.encoding.accepted_encoding). Only the GeoJSON
+    # format echoes the raw results, and only with echo_results.
+    start = time.perf_counter()
+    output = result.get("output")
+    if output is None:
+        response = FastJsonResponse({**result, **extra})
+        fmt = "error"
+    elif fmt in (RASTER, PNG, GEOTIFF):
+        try:
+            response = _render_raster(output, fmt, extra)
+        except RasterTooLarge as e:
+            response = FastJsonResponse({"error": "Raster output too large", "detail": str(e), **extra}, status=422)
+    elif fmt == BINARY:
+        body = output["map"].to_binary(metrics=output["metrics"], **extra)
+        response = HttpResponse(body, content_type=MEDIA_TYPES[BINARY])
+    elif fmt == PACKED:
+        data = {"output": {"map": output["map"].to_packed(), "metrics": output["metrics"]}, **extra}
+        response = FastJsonResponse(data, content_type=MEDIA_TYPES[PACKED])
+    else:
+        data = {**result, "output": {**output, "map": output["map"].to_geojson()}, **extra}
+        if echo_results and "results" in data:
+            data["results"] = extraction_results(data["results"])
+        else:
+            data.pop("results", None)
+        response = FastJsonResponse(data)
+    patch_vary_headers(response, ("Accept",))
+    if fmt not in (PNG, GEOTIFF):
+        compress(response, encoding)
+    encode_seconds.observe(time.perf_counter() - start, format=fmt)
+    response_bytes.observe(len(response.content), format=fmt)
+    return response
+
+
+def is_streaming(request, fmt):
+    return fmt == NDJSON or (fmt == GEOJSON and request.GET.get("stream") in ("1", "true"))
+
+
+def _feature_chunk(prediction_map, start, fmt):
+    features = prediction_map.features(start, start + STREAM_CHUNK_FEATURES)
+    if fmt == NDJSON:
+        return b"".join(dumps(feature) + b"\n" for feature in features)
+    prefix = b"," if start else b""
+    return prefix + dumps(features)[1:-1]
+
+
+async def _stream_chunks(result, fmt, extra):
+    # The first bytes go out before the pipeline has finished, and the features are encoded
+    # STREAM_CHUNK_FEATURES at a time in a worker thread, so neither time-to-first-byte nor
+    # memory grows with the size of the AOI. Streams leave out the raw "results" echo.
+    if fmt == NDJSON:
+        yield dumps({"type": "job", **extra}) + b"\n"
+    else:
+        yield dumps(extra)[:-1] + (b"," if extra else b"")
+
+    if inspect.isawaitable(result):
+        result = await result
+    output = result.get("output")
+    if output is None:
+        error = {key: value for key, value in result.items() if key not in extra}
+        if fmt == NDJSON:
+            yield dumps({"type": "error", **error}) + b"\n"
+        else:
+            yield dumps(error)[1:]
+        return
+
+    prediction_map = output["map"]
+    if fmt == NDJSON:
+        yield dumps({"type": "metrics", "metrics": output["metrics"], "count": len(prediction_map)}) + b"\n"
+    else:
+        yield b'"output":{"metrics":' + dumps(output["metrics"]) + b',"map":{"type":"FeatureCollection","features":['
+    for start in range(0, len(prediction_map), STREAM_CHUNK_FEATURES):
+        yield await offload(_feature_chunk, prediction_map, start, fmt)
+    if fmt != NDJSON:
+        yield b"]}}}"
+
+
+def streaming_response(result, fmt, encoding=None, **extra):
+    # result may be awaitable (e.g. the job's future); it is awaited inside the stream.
+    body = _stream_chunks(result, fmt, extra)
+    if encoding is not None:
+        body = _compressed(body, StreamCompressor(encoding))
+    response = StreamingHttpResponse(body, content_type=MEDIA_TYPES.get(fmt, "application/json"))
+    if encoding is not None:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept", "Accept-Encoding"))
+    return response
+
+
+async def _compressed(chunks, compressor):
+    async for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.finish()
@@ -0,0 +1,361 @@
+# pipeline.py
+# S1/S2 extraction, merge, time-series build and model inference for one AOI.
+import asyncio
+import hashlib
+import httpx
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from api import store, tracing, upstream
+from api.features import S1_FEATURES, S2_FEATURES, ExtractionBlock, combine_blocks, feature_table, merge_s1_s2
+from api.utils import offload
+from api.encoding import dumps_records
+from api.cache import extraction_key, geometry_key, get_extraction_cache
+from api.geometry import grid_tiles
+from api.jobs import get_job_store
+from api.output import PredictionMap
+from api.resilience import CircuitOpen, UpstreamStatusError, check_status, policy
+from api.singleflight import SingleFlight
+from api.streaming import ObjectReader
+
+EXTRACTION_URLS = {"s1": "/extract-s1-parameters", "s2": "/extract-s2-parameters"}
+SENSOR_NAMES = {"s1": "Sentinel-1", "s2": "Sentinel-2"}
+SENSOR_FEATURES = {"s1": S1_FEATURES, "s2": S2_FEATURES}
+
+pipeline_flight = SingleFlight("pipeline")
+prediction_flight = SingleFlight("prediction")
+
+async def run_pipeline(geojson_data, startDate, endDate, flag, progress, trace=None):
+    # Identical submissions (double clicks, retries) share one run of the pipeline.
+    # A cancelled job stops here; the shared work is cancelled too unless another job still waits on it.
+    key = geometry_key("pipeline", geojson_data, startDate, endDate, bool(flag))
+    try:
+        return await pipeline_flight.do(
+            key, fetch_s2_and_s1_indices_async, geojson_data, startDate, endDate, flag, progress, trace, progress=progress
+        )
+    except asyncio.CancelledError:
+        progress.discard()
+        raise
+
+async def read_extraction(response, features):
+    # Pixels go into the block as each one is parsed off the byte stream; neither the body
+    # nor the full response dict is held in memory.
+    block = ExtractionBlock(features)
+    reader = ObjectReader()
+    async for chunk in response.aiter_bytes():
+        for key, monthly in reader.feed(chunk):
+            block.add(key, monthly)
+    for key, monthly in reader.close():
+        block.add(key, monthly)
+    return block
+
+async def fetch_tile(source, tile_geojson, startDate, endDate):
+    # Returns (block, fetched), fetched being [(block, start, end)] for the date ranges read
+    # from the extraction service. Repeat submissions of the same tile and date range skip the
+    # upstream call; months already in the spatial store (for this tile or a whole cell around
+    # it) are not requested again, so extending a date range only fetches the new months.
+    cache = get_extraction_cache()
+    key = extraction_key(source, tile_geojson, startDate, endDate)
+    block = await cache.get(key)
+    if block is not None:
+        return block, []
+    stored, missing = None, [(startDate, endDate)]
+    conf = settings.SPATIAL_STORE
+    if conf["ENABLED"] and conf["REUSE"]:
+        stored, missing = await store.find_tile(source, SENSOR_FEATURES[source], tile_geojson, startDate, endDate)
+
+    fetched = await asyncio.gather(*(extract_range(source, tile_geojson, start, end) for start, end in missing))
+    fetched = [(block, start, end) for block, (start, end) in zip(fetched, missing)]
+    blocks = ([stored] if stored is not None else []) + [block for block, _, _ in fetched]
+    block = blocks[0] if len(blocks) == 1 else combine_blocks(blocks)
+    await cache.set(key, block)
+    return block, fetched
+
+async def extract_range(source, tile_geojson, startDate, endDate):
+    payload = {"geojson": tile_geojson, "start_date": startDate, "end_date": endDate}
+
+    async def attempt():
+        async with upstream.stream("gee", EXTRACTION_URLS[source], json=payload) as response:
+            check_status(response)
+            return await read_extraction(response, SENSOR_FEATURES[source])
+
+    # Retried, hedged and circuit-broken per settings.RESILIENCE[source].
+    return await policy(source).call(attempt)
+
+async def fetch_extractions(geojson_data, startDate, endDate, progress, fetched=None):
+    # Large AOIs are split into grid tiles; S1 and S2 are fetched per tile under one
+    # semaphore and merged as each tile arrives. Only failing tiles are retried.
+    # fetched, if given, gets (source, tile_id, tile_geojson, block, start, end) for each tile
+    # or month range of a tile read from the extraction services, for the spatial store.
+    # Returns (results, failed): failed lists the ids of the tiles each sensor failed for (None
+    # for an AOI that was not split). A sensor that failed for every tile is an error dict in results.
+    conf = settings.TILING
+    tiles = grid_tiles(geojson_data, conf["TILE_SIZE_DEG"], conf["MAX_TILES"])
+    semaphore = asyncio.Semaphore(conf["CONCURRENCY"])
+    lock = asyncio.Lock()
+    results = {source: ExtractionBlock(features) for source, features in SENSOR_FEATURES.items()}
+    errors = {source: [] for source in SENSOR_FEATURES}
+    total = 2 * len(tiles)
+    done = 0
+    started = asyncio.get_running_loop().time()
+    remaining = {source: len(tiles) for source in SENSOR_FEATURES}
+
+    async def fetch(source, tile_id, tile_geojson):
+        nonlocal done
+        error = None
+        async with semaphore:
+            try:
+                data, pieces = await fetch_tile(source, tile_geojson, startDate, endDate)
+            except UpstreamStatusError as e:
+                error = {"error": f"{source.upper()} microservice call failed", "status_code": e.status_code}
+            except CircuitOpen:
+                error = {"error": f"{source.upper()} microservice unavailable", "status_code": 503}
+
+        async with lock:
+            if error is not None:
+                # Only this tile's pixels miss the sensor; the tiles that arrived are kept.
+                errors[source].append((tile_id, error))
+            else:
+                if fetched is not None:
+                    fetched.extend((source, tile_id, tile_geojson, *piece) for piece in pieces)
+                if len(tiles) == 1:
+                    results[source] = data  # may be the cached block, so it is not modified
+                else:
+                    results[source].update(data)
+            done += 1
+            remaining[source] -= 1
+            if not remaining[source]:
+                # Time until the sensor's last tile arrived, i.e. how long S1 or S2 held up the job.
+                tracing.record_stage(f"extract_{source}", asyncio.get_running_loop().time() - started)
+            if error is not None:
+                message = f"{SENSOR_NAMES[source]} tile failed ({done}/{total})..."
+            elif done == total:
+                message = "All Satellite Data Retrieved. Merging data..."
+            elif len(tiles) == 1:
+                message = f"{SENSOR_NAMES[source]} Data Retrieved. Awaiting other data..."
+            else:
+                message = f"{SENSOR_NAMES[source]} tile retrieved ({done}/{total})..."
+            await progress.send("progress", startProgress=tracing.progress("extract", (done - 1) / total), endProgress=tracing.progress("extract", done / total), message=message)
+
+    tasks = [asyncio.create_task(fetch(source, tile_id, tile)) for tile_id, tile in tiles for source in ("s1", "s2")]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    failed = {}
+    for source, tile_errors in errors.items():
+        if not tile_errors:
+            continue
+        print(f"{SENSOR_NAMES[source]} extraction failed for {len(tile_errors)} of {len(tiles)} tiles: {tile_errors[0][1]['error']}")
+        failed[source] = [tile_id for tile_id, _ in tile_errors]
+        if len(tile_errors) == len(tiles):
+            # Nothing arrived, so the sensor failed as a whole, as an untiled call would have.
+            results[source] = tile_errors[0][1]
+    return results, failed
+
+async def fetch_s2_and_s1_indices_async(geojson_data, startDate, endDate, flag, progress, trace=None):
+    # Every stage is timed (api/tracing.py); the progress percentages come from the stages'
+    # recent durations.
+    trace = trace or tracing.Trace()
+    token = tracing.activate(trace)
+    trace.start(tracing.PREDICTION_STAGES if flag else tracing.EXTRACTION_STAGES)
+    outcome = "error"
+    try:
+        # Step 1: Fetching Sentinel-1 and Sentinel-2 Data
+        await progress.send("progress", startProgress=tracing.progress("extract", 0), endProgress=tracing.progress("extract", 0), message="Initiating Data Fetch...")
+        fetched = []
+        with tracing.stage("extract"):
+            result, failed = await fetch_extractions(geojson_data, startDate, endDate, progress, fetched)
+
+        # Step 2: Combining Sentinel-1 and Sentinel-2
+        with tracing.stage("merge"):
+            cube = await offload(merge_s1_s2, result['s1'], result['s2'])
+        trace.pixels = len(cube)
+
+        await progress.send("progress", startProgress=tracing.progress("extract"), endProgress=tracing.progress("merge"), message="Sentinel-1 and Sentinel-2 data Merged")
+        
+        if not flag:
+            with tracing.stage("output"):
+                await progress.send("progress", startProgress=tracing.progress("merge"), endProgress=tracing.progress("output", 0.4), message="Extracting coordinates and features...")
+                await progress.send("progress", startProgress=tracing.progress("output", 0.4), endProgress=tracing.progress("output", 0.8), message="Building GeoJSON features...")
+                prediction_map = PredictionMap(cube.coords, np.zeros(len(cube), dtype=np.int64))
+
+            await progress.send("progress", startProgress=tracing.progress("output", 0.8), endProgress=100, message="Finalizing prediction output...")
+            output = {
+                "map": prediction_map,
+                "metrics": {
+                    "ragiCoverage": 0,
+                    "nonRagiCoverage": 100,
+                    **failed_tiles(failed),
+                }
+            }
+            outcome = "succeeded"
+            save_to_store(progress.job_id, geojson_data, startDate, endDate, fetched)
+            # The raw extractions stay as blocks; responses rebuild them only when they echo them.
+            return {"results": result, "output": output}
+
+        else:
+            # Step 3: Generate time series DataFrame
+            await progress.send("progress", startProgress=tracing.progress("merge"), endProgress=tracing.progress("features"), message="Generating Time Series...")
+            
+            with tracing.stage("features"):
+                df = await offload(feature_table, cube, settings.MODEL_INFERENCE["SEND_IDS"])
+            await progress.send("progress", startProgress=tracing.progress("features"), endProgress=tracing.progress("inference"), message="Time series data prepared. Running Deep Learning Model...")
+
+            # Step 4: Run deep learning model
+            with tracing.stage("inference"):
+                output_data = await get_crop_prediction(df, progress)
+            await progress.send("progress", startProgress=tracing.progress("inference"), endProgress=tracing.progress("output", 0.8), message="Model predictions obtained. Generating features and metrics...")
+
+            # Step 5: Generate features and calculate metrics
+            if isinstance(output_data, dict):
+                return output_data
+            with tracing.stage("output"):
+                predictions, found = output_data
+                predictions = predictions[:len(cube)]
+                missing = len(cube) - int(found[:len(cube)].sum())
+                if missing:
+                    print(f"Warning: No matching prediction found for {missing} of {len(cube)} pixels")
+
+                ragi_count = int((predictions == 1).sum())
+                non_ragi_count = len(cube) - ragi_count
+
+                total_predictions = ragi_count + non_ragi_count
+                ragi_coverage = (ragi_count / total_predictions * 100) if total_predictions > 0 else 0
+                non_ragi_coverage = (non_ragi_count / total_predictions * 100) if total_predictions > 0 else 0
+
+                # Step 6: Assemble final output
+                output = {
+                    "map": PredictionMap(cube.coords, predictions),
+                    "metrics": {
+                        "ragiCoverage": round(ragi_coverage, 2),
+                        "nonRagiCoverage": round(non_ragi_coverage, 2),
+                        **failed_tiles(failed),
+                    }
+                }
+
+            await progress.send("progress", startProgress=tracing.progress("output", 0.8), endProgress=100, message="Output generated successfully.")
+
+            outcome = "succeeded"
+            save_to_store(progress.job_id, geojson_data, startDate, endDate, fetched, output["map"])
+            return {"output": output, "results": result}
+
+    except httpx.RequestError as e:
+        print(f"Unexpected Part 1: {str(e)}")
+        await progress.send("error", message=f"Error fetching data: {str(e)}")
+        return {"error": str(e)}
+    except Exception as e:
+        print(f"Unexpected Part 2: {str(e)}")
+        await progress.send("error", message=f"Unexpected error: {str(e)}")
+        return {"error": str(e)}
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        tracing.deactivate(token)
+        await record_trace(trace, outcome, progress)
+
+def failed_tiles(failed):
+    # Pixels of a tile whose S2 call failed have zero S2 features; those of a tile whose S1
+    # call failed are not in the map. Results name these tiles so clients can tell.
+    return {"failedTiles": failed} if failed else {}
+
+def save_to_store(job_id, geojson_data, startDate, endDate, fetched, prediction_map=None):
+    # Extraction-only runs (flag false) store their tiles but have no predictions to store.
+    if settings.SPATIAL_STORE["ENABLED"]:
+        store.save_in_background(job_id, geojson_data, startDate, endDate, fetched, prediction_map)
+
+async def record_trace(trace, outcome, progress):
+    # Per-run histograms, plus the summary on the job record of every job that shared the run.
+    summary = trace.summary()
+    tracing.job_seconds.observe(summary["seconds"], outcome=outcome)
+    tracing.job_peak_rss.observe(trace.peak_rss)
+    if trace.pixels:
+        tracing.job_pixels.observe(trace.pixels)
+    store = get_job_store()
+    for job_id in [progress.job_id, *progress.attached]:
+        try:
+            await store.update(job_id, trace=summary)
+        except Exception as e:
+            print(f"Could not record trace of job {job_id}: {e}")
+
+def frame_key(df):
+    digest = hashlib.sha256("|".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return "prediction:" + digest.hexdigest()
+
+async def get_crop_prediction(combined_input, progress):
+    # Hashing the frame takes about half a second at 1M pixels, so it runs off the event loop.
+    key = await offload(frame_key, combined_input)
+    return await prediction_flight.do(key, request_crop_prediction, combined_input, progress, progress=progress)
+
+async def request_crop_prediction(combined_input, progress):
+    # Pixels are sent in batches of MODEL_INFERENCE["BATCH_SIZE"] rows with at most
+    # MODEL_INFERENCE["MAX_INFLIGHT"] requests outstanding. Returns (predictions, found):
+    # int64 predictions indexed by pixel id and a mask of the pixels the model answered for.
+    url = "/crop-prediction-transformer"
+    conf = settings.MODEL_INFERENCE
+    batch_size = max(1, conf["BATCH_SIZE"])
+    offsets = range(0, len(combined_input), batch_size)
+    semaphore = asyncio.Semaphore(conf["MAX_INFLIGHT"])
+    if "id" in combined_input.columns:
+        ids = combined_input["id"].to_numpy(dtype=np.int64)
+    else:
+        ids = np.arange(len(combined_input), dtype=np.int64)
+    size = int(ids.max()) + 1 if len(ids) else 0
+    predictions = np.zeros(size, dtype=np.int64)
+    found = np.zeros(size, dtype=bool)
+    done = 0
+
+    async def post_batch(payload):
+        return check_status(await upstream.post("model", url, content=payload))
+
+    async def predict(offset):
+        nonlocal done
+        batch = combined_input.iloc[offset:offset + batch_size]
+        async with semaphore:
+            # Encoding and parsing a batch take tens of milliseconds, so both run off the event loop.
+            payload = await offload(dumps_records, batch)  # JSON list of row objects
+            response = await policy("model").call(post_batch, payload)
+        await offload(join_batch, response, offset, len(batch))
+
+        done += 1
+        if len(offsets) > 1:
+            await progress.send("progress", startProgress=tracing.progress("inference", (done - 1) / len(offsets)), endProgress=tracing.progress("inference", done / len(offsets)), message=f"Model batch {done}/{len(offsets)} predicted...")
+
+    def join_batch(response, offset, count):
+        items = response.json()  # Returns: [{[id,] lon, lat, prediction}, ...]
+        values = np.array([item["prediction"] for item in items], dtype=np.int64)
+        if items and all("id" in item for item in items):
+            batch_ids = np.array([item["id"] for item in items], dtype=np.int64)
+        elif len(items) == count:
+            # The model answers in request order: join by position within the batch.
+            batch_ids = ids[offset:offset + count]
+        else:
+            batch_ids = ids_for_coords([item["lon"] for item in items], [item["lat"] for item in items])
+        known = (batch_ids >= 0) & (batch_ids < size)
+        predictions[batch_ids[known]] = values[known]
+        found[batch_ids[known]] = True
+
+    def ids_for_coords(lon, lat):
+        lookup = {(x, y): i for i, x, y in zip(ids.tolist(), combined_input["lon"].tolist(), combined_input["lat"].tolist())}
+        return np.array([lookup.get((x, y), -1) for x, y in zip(lon, lat)], dtype=np.int64)
+
+    tasks = [asyncio.create_task(predict(offset)) for offset in offsets]
+    try:
+        await asyncio.gather(*tasks)
+    except (httpx.RequestError, UpstreamStatusError, CircuitOpen) as e:
+        for task in tasks:
+            task.cancel()
+        print(f"Prediction microservice call failed: {e}")
+        await progress.send("error", message=f"Prediction microservice failed: {str(e)}")
+        return {"error": str(e)}
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    return predictions, found
@@ -0,0 +1,76 @@
+# pixels.py
+# Stable integer ids for pixels. The "lon,lat" keys from the extraction services are
+# parsed once; from then on pixels are addressed by id and coordinates live in arrays.
+import numpy as np
+
+# Coordinates are matched at 1e-7 degrees (about 1 cm), so "77.5" and "77.50000" are one pixel.
+COORDINATE_SCALE = 10_000_000
+
+
+def parse_coordinates(keys):
+    if not keys:
+        return np.empty((0, 2), dtype=np.float64)
+    return np.array(",".join(keys).split(","), dtype=np.float64).reshape(-1, 2)
+
+
+class PixelIndex:
+    def __init__(self, keys=()):
+        self.keys = []
+        self._ids = {}
+        self._coords = np.empty((0, 2), dtype=np.float64)
+        self.add(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __reduce__(self):
+        return PixelIndex, (self.keys,)
+
+    def add(self, keys):
+        # Returns the ids of `keys`, assigning new ids (in order) to unseen keys.
+        return np.fromiter(map(self.add_key, keys), dtype=np.int64, count=len(keys))
+
+    def add_key(self, key):
+        pixel_id = self._ids.get(key)
+        if pixel_id is None:
+            pixel_id = self._ids[key] = len(self.keys)
+            self.keys.append(key)
+        return pixel_id
+
+    def get(self, key):
+        return self._ids.get(key)
+
+    def lookup(self, keys):
+        # ids of `keys` in this index, -1 where a key is unknown
+        return np.fromiter((self._ids.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+
+    def locations(self):
+        # One int64 per pixel id packing its coordinates on the COORDINATE_SCALE grid.
+        scaled = np.rint(self.coords * COORDINATE_SCALE).astype(np.int64)
+        return (scaled[:, 0] << 32) | (scaled[:, 1] & 0xFFFFFFFF)
+
+    def match(self, other):
+        # ids in this index of the pixels of another index (e.g. S2's pixels in S1's), by
+        # coordinates rather than by key strings; -1 where the pixel is not in this index.
+        if not len(self) or not len(other):
+            return np.full(len(other), -1, dtype=np.int64)
+        mine, theirs = self.locations(), other.locations()
+        order = np.argsort(mine, kind="stable")
+        mine = mine[order]
+        found = np.minimum(np.searchsorted(mine, theirs), len(mine) - 1)
+        return np.where(mine[found] == theirs, order[found], -1)
+
+    @property
+    def coords(self):
+        # Keys are parsed lazily, in one step for everything added since the last access.
+        if len(self._coords) < len(self.keys):
+            self._coords = np.concatenate([self._coords, parse_coordinates(self.keys[len(self._coords):])])
+        return self._coords
+
+    @property
+    def lon(self):
+        return self.coords[:, 0]
+
+    @property
+    def lat(self):
+        return self.coords[:, 1]
@@ -0,0 +1,103 @@
+# progress.py
+import asyncio
+import re
+import time
+import uuid
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from api import metrics
+
+JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+def is_valid_job_id(job_id):
+    return isinstance(job_id, str) and bool(JOB_ID_RE.match(job_id))
+
+
+progress_messages = metrics.counter(
+    "progress_updates_total", "Progress updates sent to the channel layer, or replaced by a later one first", ("outcome",))
+
+
+def job_group(job_id):
+    return f"job.{job_id}"
+
+
+class JobProgress:
+    # Sends progress updates only to the sockets subscribed to ws/progress/<job_id>, plus
+    # the jobs attached to this one because they coalesced onto the same work.
+    # "progress" updates closer together than PROGRESS["COALESCE_MS"] are coalesced: the
+    # latest state is sent once the interval is up. Other updates, and the one reaching
+    # 100%, are sent at once and replace any pending state.
+    def __init__(self, job_id, channel_layer=None, interval=None):
+        self.job_id = job_id
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.interval = settings.PROGRESS["COALESCE_MS"] / 1000 if interval is None else interval
+        self.attached = []
+        self.last = None
+        self._sent_at = float("-inf")
+        self._flush = None
+
+    async def _send_to(self, job_id, data):
+        await self.channel_layer.group_send(
+            job_group(job_id),
+            {
+                "type": "send_notification",
+                "message": {**data, "jobId": job_id}
+            }
+        )
+
+    async def _publish(self, data):
+        self._sent_at = time.monotonic()
+        progress_messages.inc(outcome="sent")
+        for job_id in [self.job_id, *self.attached]:
+            await self._send_to(job_id, data)
+
+    async def _publish_later(self, delay):
+        await asyncio.sleep(delay)
+        self._flush = None
+        await self._publish(self.last)
+
+    async def send(self, update_type, startProgress=None, endProgress=None, message=None):
+        data = {"type": update_type}
+        if endProgress is not None:
+            data["endProgress"] = endProgress
+        if startProgress is not None:
+            data["startProgress"] = startProgress
+        data["message"] = message
+        self.last = data
+
+        # A pending state replaced by this one is never sent ("coalesced").
+        wait = self._sent_at + self.interval - time.monotonic()
+        if update_type == "progress" and endProgress != 100 and (wait > 0 or self._flush is not None):
+            if self._flush is None:
+                self._flush = asyncio.create_task(self._publish_later(wait))
+            else:
+                progress_messages.inc(outcome="coalesced")
+            return
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+            progress_messages.inc(outcome="coalesced")
+        await self._publish(data)
+
+    def discard(self):
+        # Drops a pending coalesced update, e.g. once the job has been cancelled.
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+
+    async def attach(self, other):
+        # Late joiners immediately get the latest state instead of waiting for the next update.
+        self.attached.append(other.job_id)
+        if self.last is not None:
+            await self._send_to(other.job_id, self.last)
+
+    def detach(self, other):
+        if other.job_id in self.attached:
+            self.attached.remove(other.job_id)
@@ -0,0 +1,147 @@
+# raster.py
+# Snaps point predictions back onto their native sampling grid and encodes the grid as a
+# palette PNG overlay or a single-band GeoTIFF (EPSG:4326), using only numpy and zlib.
+import struct
+import zlib
+
+import numpy as np
+from django.conf import settings
+
+NODATA = 255
+
+# RGBA per predicted class; index 0 of the PNG palette is transparent (no data).
+CLASS_COLORS = [(230, 230, 230, 140), (34, 139, 34, 220)]
+OTHER_COLOR = (128, 128, 128, 200)
+
+
+class RasterTooLarge(ValueError):
+    pass
+
+
+class Raster:
+    # values: uint8 (height, width), row 0 is the northern edge, NODATA where no pixel was sampled
+    # west/north: outer edges of the top-left cell; step_x/step_y: cell size in degrees
+    def __init__(self, values, west, north, step_x, step_y):
+        self.values = values
+        self.west = west
+        self.north = north
+        self.step_x = step_x
+        self.step_y = step_y
+
+    @property
+    def bounds(self):
+        height, width = self.values.shape
+        return [self.west, self.north - height * self.step_y, self.west + width * self.step_x, self.north]
+
+
+def grid_step(values):
+    # Spacing of the sampling grid along one axis: the typical difference between
+    # neighbouring distinct coordinates (gaps are whole multiples of it and are ignored).
+    distinct = np.unique(np.round(values, 7))
+    diffs = np.diff(distinct)
+    if not len(diffs):
+        return None
+    return float(np.median(diffs[diffs <= 1.5 * diffs.min()]))
+
+
+def rasterize(prediction_map):
+    conf = settings.RASTER
+    coords = prediction_map.coords
+    if not len(coords):
+        return Raster(np.full((1, 1), NODATA, dtype=np.uint8), 0.0, 0.0, conf["DEFAULT_STEP_DEG"], conf["DEFAULT_STEP_DEG"])
+    lon, lat = coords[:, 0], coords[:, 1]
+    step_x, step_y = grid_step(lon), grid_step(lat)
+    step_x = step_x or step_y or conf["DEFAULT_STEP_DEG"]
+    step_y = step_y or step_x
+
+    west, north = lon.min() - step_x / 2, lat.max() + step_y / 2
+    cols = np.floor((lon - west) / step_x).astype(np.int64)
+    rows = np.floor((north - lat) / step_y).astype(np.int64)
+    width, height = int(cols.max()) + 1, int(rows.max()) + 1
+    if width * height > conf["MAX_PIXELS"]:
+        raise RasterTooLarge(f"{width}x{height} raster exceeds {conf['MAX_PIXELS']} pixels")
+
+    values = np.full((height, width), NODATA, dtype=np.uint8)
+    values[rows, cols] = np.clip(prediction_map.predictions, 0, NODATA - 1)
+    return Raster(values, float(west), float(north), step_x, step_y)
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def to_png(raster):
+    # 8-bit palette PNG: index 0 is transparent no-data, index k + 1 is class k.
+    height, width = raster.values.shape
+    classes = int(raster.values[raster.values != NODATA].max(initial=0)) + 1
+    colors = [(0, 0, 0, 0)] + [CLASS_COLORS[k] if k < len(CLASS_COLORS) else OTHER_COLOR for k in range(classes)]
+    indices = np.where(raster.values == NODATA, 0, raster.values + 1).astype(np.uint8)
+    # Each scanline is prefixed with filter type 0 (none).
+    scanlines = np.hstack([np.zeros((height, 1), dtype=np.uint8), indices]).tobytes()
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)),
+        _png_chunk(b"PLTE", bytes(c for color in colors for c in color[:3])),
+        _png_chunk(b"tRNS", bytes(color[3] for color in colors)),
+        _png_chunk(b"IDAT", zlib.compress(scanlines, 6)),
+        _png_chunk(b"IEND", b""),
+    ])
+
+
+# TIFF field types
+SHORT, LONG, ASCII, DOUBLE = 3, 4, 2, 12
+_FORMATS = {SHORT: "H", LONG: "I", DOUBLE: "d"}
+
+
+def to_geotiff(raster, rows_per_strip=256):
+    # Little-endian baseline TIFF, one uint8 band, deflate-compressed strips, with the
+    # GeoTIFF tags for a north-up EPSG:4326 grid and GDAL's no-data tag.
+    height, width = raster.values.shape
+    strips = [zlib.compress(raster.values[top:top + rows_per_strip].tobytes(), 6) for top in range(0, height, rows_per_strip)]
+
+    offset = 8
+    strip_offsets = []
+    for strip in strips:
+        strip_offsets.append(offset)
+        offset += len(strip)
+    offset += offset % 2
+
+    geokeys = [
+        1, 1, 0, 3,
+        1024, 0, 1, 2,     # GTModelTypeGeoKey: geographic
+        1025, 0, 1, 1,     # GTRasterTypeGeoKey: pixel is area
+        2048, 0, 1, 4326,  # GeographicTypeGeoKey: WGS 84
+    ]
+    tags = [
+        (256, LONG, [width]),
+        (257, LONG, [height]),
+        (258, SHORT, [8]),
+        (259, SHORT, [8]),  # Adobe deflate
+        (262, SHORT, [1]),  # BlackIsZero
+        (273, LONG, strip_offsets),
+        (277, SHORT, [1]),
+        (278, LONG, [rows_per_strip]),
+        (279, LONG, [len(strip) for strip in strips]),
+        (284, SHORT, [1]),
+        (339, SHORT, [1]),  # unsigned integer samples
+        (33550, DOUBLE, [raster.step_x, raster.step_y, 0.0]),
+        (33922, DOUBLE, [0.0, 0.0, 0.0, raster.west, raster.north, 0.0]),
+        (34735, SHORT, geokeys),
+        (42113, ASCII, f"{NODATA}\0".encode("ascii")),
+    ]
+
+    ifd_size = 2 + 12 * len(tags) + 4
+    extra_offset = offset + ifd_size
+    entries, extra = [], b""
+    for tag, kind, values in tags:
+        data = values if kind == ASCII else struct.pack(f"<{len(values)}{_FORMATS[kind]}", *values)
+        if len(data) <= 4:
+            entries.append(struct.pack("<HHI", tag, kind, len(values)) + data.ljust(4, b"\0"))
+        else:
+            entries.append(struct.pack("<HHII", tag, kind, len(values), extra_offset + len(extra)))
+            extra += data + b"\0" * (len(data) % 2)
+
+    header = b"II" + struct.pack("<HI", 42, offset)
+    ifd = struct.pack("<H", len(tags)) + b"".join(entries) + struct.pack("<I", 0)
+    body = b"".join(strips)
+    return header + body + b"\0" * (offset - 8 - len(body)) + ifd + extra
@@ -0,0 +1,208 @@
+# resilience.py
+# Retries, hedged requests and circuit breaking for calls to the upstream microservices.
+# Each call ("s1", "s2", "model") has its own policy (settings.RESILIENCE), latency
+# histogram and breaker. An attempt is an async function making one request; it returns
+# the result or raises, and only connection errors, timeouts, 429 and 5xx are retried.
+import asyncio
+import random
+import time
+
+import httpx
+from django.conf import settings
+
+from api import metrics
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+call_latency = metrics.histogram(
+    "upstream_call_seconds", "Latency of successful upstream attempts, per call", ("call",))
+call_retries = metrics.counter("upstream_retries_total", "Upstream attempts retried after a failure", ("call",))
+call_hedges = metrics.counter(
+    "upstream_hedges_total", "Hedged duplicate requests, by the attempt that answered first", ("call", "winner"))
+breaker_state = metrics.gauge(
+    "upstream_circuit_state", "Circuit breaker state per call: 0 closed, 1 half-open, 2 open", ("call",))
+breaker_rejections = metrics.counter(
+    "upstream_circuit_rejected_total", "Calls failed fast because the circuit was open", ("call",))
+
+
+class UpstreamStatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"upstream returned HTTP {status_code}")
+        self.status_code = status_code
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def is_retryable(error):
+    if isinstance(error, UpstreamStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (httpx.RequestError, asyncio.TimeoutError))
+
+
+def check_status(response):
+    if response.status_code != 200:
+        raise UpstreamStatusError(response.status_code)
+    return response
+
+
+class CircuitBreaker:
+    def __init__(self, name, failures, reset, probes=1):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.probes = probes
+        self.state = CLOSED
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.probing = 0
+        self._waiters = []
+
+    def _set_state(self, state):
+        self.state = state
+        breaker_state.set(state, call=self.name)
+
+    def _wake(self):
+        # The trials' outcome is known (or a trial slot is free again): waiting calls check again.
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(release, waiter)
+
+    def check(self):
+        # Raises CircuitOpen while open. Once BREAKER_RESET has passed the circuit is half-open and
+        # up to BREAKER_PROBES trial calls go through at a time; returns False for a call that has
+        # to wait for their outcome (see admit()).
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset:
+                breaker_rejections.inc(call=self.name)
+                raise CircuitOpen(f"{self.name} upstream unavailable, failing fast")
+            self._set_state(HALF_OPEN)
+        if self.probing < self.probes:
+            self.probing += 1
+            return True
+        return False
+
+    async def admit(self):
+        # Calls arriving while the trials are out go ahead once the circuit closes, and fail
+        # fast if it opens again, instead of all but the trials failing at once.
+        while not self.check():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def success(self):
+        self.consecutive = 0
+        if self.state != CLOSED:
+            self.probing = 0
+            self._set_state(CLOSED)
+            self._wake()
+
+    def abandon(self):
+        # A trial call was cancelled without an answer: a waiting call becomes the trial.
+        if self.state == HALF_OPEN:
+            self.probing = max(0, self.probing - 1)
+            self._wake()
+
+    def failure(self):
+        self.consecutive += 1
+        if self.state == HALF_OPEN or self.consecutive >= self.failures:
+            if self.state != OPEN:
+                print(f"Circuit for {self.name} upstream opened after {self.consecutive} failures")
+            self.opened_at = time.monotonic()
+            self.probing = 0
+            self._set_state(OPEN)
+            self._wake()
+
+
+def release(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class Policy:
+    def __init__(self, name, conf):
+        self.name = name
+        self.conf = conf
+        self.breaker = CircuitBreaker(name, conf["BREAKER_FAILURES"], conf["BREAKER_RESET"], conf["BREAKER_PROBES"])
+
+    def hedge_delay(self):
+        # None (no hedging) until enough attempts were seen to trust the quantile.
+        conf = self.conf
+        if not conf["HEDGE"] or call_latency.count(call=self.name) < conf["HEDGE_MIN_SAMPLES"]:
+            return None
+        return max(conf["HEDGE_MIN_DELAY"], call_latency.quantile(conf["HEDGE_QUANTILE"], call=self.name))
+
+    def backoff(self, retry):
+        # "Full jitter": concurrent callers that failed together do not retry together.
+        return random.uniform(0, self.conf["BACKOFF"] * 2 ** retry)
+
+    async def call(self, attempt, *args):
+        retries = self.conf["RETRIES"]
+        for retry in range(retries + 1):
+            await self.breaker.admit()
+            try:
+                result = await self._hedged(attempt, *args)
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # The upstream answered; the request itself was rejected.
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                if retry == retries:
+                    raise
+                call_retries.inc(call=self.name)
+                print(f"{self.name} call failed ({e or type(e).__name__}), retrying")
+                await asyncio.sleep(self.backoff(retry))
+            else:
+                self.breaker.success()
+                return result
+
+    async def _attempt(self, attempt, *args):
+        start = time.perf_counter()
+        if self.conf["TIMEOUT"] > 0:
+            result = await asyncio.wait_for(attempt(*args), self.conf["TIMEOUT"])
+        else:
+            result = await attempt(*args)
+        call_latency.observe(time.perf_counter() - start, call=self.name)
+        return result
+
+    async def _hedged(self, attempt, *args):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._attempt(attempt, *args)
+
+        primary = asyncio.create_task(self._attempt(attempt, *args))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            hedged = not done
+            if hedged:
+                tasks.add(asyncio.create_task(self._attempt(attempt, *args)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if hedged:
+                            call_hedges.inc(call=self.name, winner="primary" if task is primary else "hedge")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+_policies = {}
+
+
+def policy(name):
+    if name not in _policies:
+        _policies[name] = Policy(name, settings.RESILIENCE[name])
+    return _policies[name]
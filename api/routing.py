@@ -2,5 +2,5 @@ from django.urls import path
 from api.consumers import MyWebSocketConsumer  # Import consumer
 
 websocket_urlpatterns = [
-    path("ws/progress", MyWebSocketConsumer.as_asgi()),
+    path("ws/progress/<str:job_id>", MyWebSocketConsumer.as_asgi()),
 ]
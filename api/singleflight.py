@@ -0,0 +1,64 @@
+# singleflight.py
+# Coalesces concurrent calls with the same key onto one in-flight task.
+import asyncio
+
+from api import metrics
+
+coalesced_calls = metrics.counter(
+    "singleflight_coalesced_total", "Calls that attached to an identical in-flight call", ("call",))
+leader_calls = metrics.counter(
+    "singleflight_leader_total", "Calls that started new shared work", ("call",))
+
+
+class _Call:
+    def __init__(self, task, progress):
+        self.task = task
+        self.progress = progress
+        self.followers = []
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    def in_flight(self):
+        return len(self._calls)
+
+    async def do(self, key, func, *args, progress=None):
+        # The first caller's `progress` drives the shared work; later callers' progress is
+        # attached to it for as long as the shared call runs, so their sockets see the same
+        # updates but none the leader sends afterwards. The shared task is only cancelled once
+        # every caller waiting on it has been cancelled.
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.create_task(func(*args)), progress)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda task: self._finish(key, call))
+            leader_calls.inc(call=self.name)
+        else:
+            coalesced_calls.inc(call=self.name)
+            if progress is not None and call.progress is not None and progress is not call.progress:
+                call.followers.append(progress)
+                await call.progress.attach(progress)
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.task.done():
+                if call.waiters == 0:
+                    call.task.cancel()
+                elif progress in call.followers:
+                    call.followers.remove(progress)
+                    call.progress.detach(progress)
+
+    def _finish(self, key, call):
+        # Runs before any caller resumes, so the leader's next update reaches only its own job.
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        for progress in call.followers:
+            call.progress.detach(progress)
+        call.followers.clear()
@@ -0,0 +1,347 @@
+# store.py
+# Persistent spatial store in the CropData table. A successful job saves its S1/S2 extractions
+# per grid tile (api/geometry.grid_tiles) and its predictions per grid cell of CELL_SIZE_DEG,
+# one row each with the pixels as a compressed columnar blob, so millions of pixels are a few
+# thousand rows. Rows are looked up by kind, date range and bounds. A tile of a later AOI is
+# cut out of a stored tile that covers its whole cell, instead of being extracted again.
+# Extractions are reused month by month: a request overlapping stored months only sends the
+# missing month ranges to the extraction services (find_tile).
+import asyncio
+import datetime
+import io
+import time
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+
+from api import metrics
+from api.cache import geometry_key
+from api.geometry import bbox, points_in_polygons, polygon_area, polygons
+from api.features import ExtractionBlock, combine_blocks, label_month
+from api.models import CropData
+from api.output import PredictionMap
+from api.pixels import parse_coordinates
+from api.utils import offload
+
+PREDICTION = "prediction"
+# Slack for comparing bounds that were computed from the same grid.
+EPSILON = 1e-9
+ONE_DAY = datetime.timedelta(days=1)
+
+store_lookups = metrics.counter(
+    "spatial_store_lookups_total", "Extraction tiles looked up in the spatial store: hit, partial or miss",
+    ("kind", "result"))
+store_months = metrics.counter(
+    "spatial_store_months_total", "Tile months read from the spatial store or left to extract", ("kind", "source"))
+store_rows = metrics.counter("spatial_store_rows_written_total", "Rows written to the spatial store", ("kind",))
+store_seconds = metrics.histogram("spatial_store_seconds", "Spatial store reads and writes", ("operation",))
+
+_pending = set()
+
+
+class QueryTooLarge(Exception):
+    pass
+
+
+def parse_dates(start_date, end_date):
+    # (start, end) as dates, or None if either is not an ISO date.
+    try:
+        return datetime.date.fromisoformat(str(start_date)), datetime.date.fromisoformat(str(end_date))
+    except ValueError:
+        return None
+
+
+def month_end(day):
+    return (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1) - ONE_DAY
+
+
+def month_spans(start, end):
+    # [(label, first, last)]: the part of each calendar month from start to end that is in range.
+    spans = []
+    first = start.replace(day=1)
+    while first <= end:
+        last = month_end(first)
+        spans.append((first.strftime("%Y-%m"), max(start, first), min(end, last)))
+        first = last + ONE_DAY
+    return spans
+
+
+def date_ranges(spans):
+    # Adjacent month spans joined into [(start, end)] ISO date ranges, one extraction call each.
+    ranges = []
+    for _, first, last in spans:
+        if ranges and ranges[-1][1] + ONE_DAY == first:
+            ranges[-1][1] = last
+        else:
+            ranges.append([first, last])
+    return [(first.isoformat(), last.isoformat()) for first, last in ranges]
+
+
+def _pack(**arrays):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _unpack(data):
+    with np.load(io.BytesIO(bytes(data)), allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def encode_block(block):
+    return _pack(
+        keys=np.array(block.pixels.keys, dtype=str),
+        months=np.array(list(block.months), dtype=str),
+        rows=block.row_array(),
+        cols=block.col_array(),
+        values=block.value_array(),
+    )
+
+
+def decode_block(data, features, clip=None, months=None):
+    # With clip (a GeoJSON geometry), only the pixels inside it are kept; with months (labels),
+    # only those months.
+    arrays = _unpack(data)
+    keys, rows, cols, values = arrays["keys"], arrays["rows"], arrays["cols"], arrays["values"]
+    labels = arrays["months"]
+    if months is not None:
+        wanted = np.isin(labels, list(months))
+        selected = wanted[cols]
+        rows, values = rows[selected], values[selected]
+        cols = (np.cumsum(wanted) - 1)[cols[selected]]
+        labels = labels[wanted]
+    if clip is not None and len(keys):
+        coords = parse_coordinates(keys.tolist())
+        keep = points_in_polygons(polygons(clip), coords[:, 0], coords[:, 1])
+        selected = keep[rows]
+        rows = (np.cumsum(keep) - 1)[rows[selected]]
+        keys, cols, values = keys[keep], cols[selected], values[selected]
+    return ExtractionBlock.from_arrays(features, keys.tolist(), labels.tolist(), rows, cols, values)
+
+
+def covers_cell(tile_id, tile_geojson):
+    # Tile ids are "<size>:<ix>:<iy>" (see grid_tiles); None means the AOI was not split.
+    if tile_id is None:
+        return False
+    size = float(tile_id.split(":")[0])
+    area = sum(polygon_area(polygon) for polygon in polygons(tile_geojson))
+    return abs(area - size * size) <= 1e-6 * size * size
+
+
+def _row(kind, job_id, dates, bounds, **fields):
+    west, south, east, north = bounds
+    return CropData(
+        kind=kind, job_id=job_id, start_date=dates[0], end_date=dates[1],
+        west=west, south=south, east=east, north=north,
+        latitude=(south + north) / 2, longitude=(west + east) / 2, **fields,
+    )
+
+
+def extraction_row(job_id, source, tile_id, tile_geojson, block, start_date, end_date):
+    # Each part of a tile fetched for its own date range (see find_tile) is a row of its own.
+    dates = parse_dates(start_date, end_date)
+    return _row(
+        source, job_id, dates, bbox(polygons(tile_geojson)),
+        region_name=tile_id or "",
+        band_values={"features": block.features, "months": list(block.months), "pixels": len(block.pixels)},
+        covers_cell=covers_cell(tile_id, tile_geojson),
+        geometry_key=geometry_key("store", tile_geojson),
+        pixels=len(block.pixels),
+        data=encode_block(block),
+    )
+
+
+def prediction_rows(job_id, dates, aoi_key, prediction_map):
+    # One row per grid cell the pixels fall in.
+    size = settings.SPATIAL_STORE["CELL_SIZE_DEG"]
+    coords, predictions = prediction_map.coords, prediction_map.predictions
+    if not len(coords):
+        return []
+    cells = np.floor(coords / size).astype(np.int64)
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+    boundaries = np.flatnonzero(np.any(np.diff(cells[order], axis=0), axis=1)) + 1
+    rows = []
+    for group in np.split(order, boundaries):
+        ix, iy = cells[group[0]].tolist()
+        cell_coords = coords[group]
+        lon, lat = cell_coords[:, 0], cell_coords[:, 1]
+        rows.append(_row(
+            PREDICTION, job_id, dates, (lon.min(), lat.min(), lon.max(), lat.max()),
+            region_name=f"{size:g}:{ix}:{iy}",
+            band_values={"pixels": len(group)},
+            geometry_key=aoi_key,
+            pixels=len(group),
+            data=_pack(coords=cell_coords, predictions=predictions[group]),
+        ))
+    return rows
+
+
+def build_rows(job_id, dates, geojson, fetched, prediction_map):
+    rows = [extraction_row(job_id, *tile) for tile in fetched]
+    if prediction_map is not None:
+        rows += prediction_rows(job_id, dates, geometry_key("store", geojson), prediction_map)
+    return rows
+
+
+def write_rows(rows):
+    # Rows saved again for the same geometry and date range (a repeated AOI) replace the old ones.
+    start = time.perf_counter()
+    with transaction.atomic():
+        for kind, key, start_date, end_date in {(r.kind, r.geometry_key, r.start_date, r.end_date) for r in rows}:
+            CropData.objects.filter(kind=kind, geometry_key=key, start_date=start_date, end_date=end_date).delete()
+        CropData.objects.bulk_create(rows, batch_size=settings.SPATIAL_STORE["BATCH_SIZE"])
+    for row in rows:
+        store_rows.inc(kind=row.kind)
+    store_seconds.observe(time.perf_counter() - start, operation="write")
+
+
+async def save_job(job_id, geojson, start_date, end_date, fetched, prediction_map=None):
+    # fetched: [(source, tile_id, tile_geojson, block, start, end)] for the tiles (or the month
+    # ranges of tiles) read from the extraction services; the rest is already stored.
+    dates = parse_dates(start_date, end_date)
+    if dates is None or not (fetched or prediction_map is not None):
+        return
+    try:
+        rows = await offload(build_rows, job_id, dates, geojson, fetched, prediction_map)
+        await sync_to_async(write_rows)(rows)
+    except DatabaseError as e:
+        print(f"Could not save job {job_id} to the spatial store (is the database migrated?): {e}")
+
+
+def save_in_background(*args):
+    # The job's response does not wait for the write.
+    task = asyncio.create_task(save_job(*args))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+def find_rows(source, key, bounds, dates):
+    # Rows overlapping the date range with exactly this tile, or with a whole cell around it;
+    # newest first.
+    west, south, east, north = bounds
+    rows = CropData.objects.filter(kind=source, start_date__lte=dates[1], end_date__gte=dates[0])
+    rows = rows.filter(Q(geometry_key=key) | Q(
+        covers_cell=True, west__lte=west + EPSILON, south__lte=south + EPSILON,
+        east__gte=east - EPSILON, north__gte=north - EPSILON,
+    ))
+    return list(rows.order_by("-id").only("band_values", "geometry_key", "data", "start_date", "end_date", "timestamp"))
+
+
+def held_months(row):
+    # {(year, month): [labels]} for the month labels the row was saved with.
+    months = {}
+    for label in row.band_values.get("months", []):
+        month = label_month(label)
+        if month is not None:
+            months.setdefault(month, []).append(label)
+    return months
+
+
+def plan_months(rows, dates):
+    # For each month of the range, the newest row holding the same part of that month, written
+    # after that part ended (earlier rows may miss late acquisitions). Returns ({row: [labels]},
+    # [month spans no row holds]); the labels are the row's own, as the extraction service sent them.
+    chosen, missing = {}, []
+    labels_of = {row.pk: held_months(row) for row in rows}
+    for label, first, last in month_spans(*dates):
+        # A month's values aggregate the days requested, so the row must hold the same days.
+        month = (first.replace(day=1), month_end(first))
+        for row in rows:
+            held = (max(row.start_date, month[0]), min(row.end_date, month[1]))
+            labels = labels_of[row.pk].get((first.year, first.month))
+            if labels and held == (first, last) and row.timestamp.date() > last:
+                chosen.setdefault(row, []).extend(labels)
+                break
+        else:
+            missing.append((label, first, last))
+    return chosen, missing
+
+
+def assemble(chosen, features, tile_geojson, key):
+    blocks = [
+        decode_block(row.data, features, None if row.geometry_key == key else tile_geojson, labels)
+        for row, labels in chosen.items()
+    ]
+    return blocks[0] if len(blocks) == 1 else combine_blocks(blocks)
+
+
+async def find_tile(source, features, tile_geojson, start_date, end_date):
+    # Returns (block, missing): the tile's stored months of the range (None if none is stored)
+    # and the [(start, end)] ISO date ranges still to be extracted.
+    everything = [(start_date, end_date)]
+    dates = parse_dates(start_date, end_date)
+    polygon_list = polygons(tile_geojson)
+    if dates is None or dates[0] > dates[1] or not polygon_list:
+        return None, everything
+    key = geometry_key("store", tile_geojson)
+    start = time.perf_counter()
+    try:
+        rows = await sync_to_async(find_rows)(source, key, bbox(polygon_list), dates)
+    except DatabaseError as e:
+        store_lookups.inc(kind=source, result="error")
+        print(f"Spatial store lookup failed: {e}")
+        return None, everything
+    chosen, missing = plan_months(rows, dates)
+    months = len(month_spans(*dates))
+    block = await offload(assemble, chosen, features, tile_geojson, key) if chosen else None
+    if block is not None and (not len(block) or len(block.months) < months - len(missing)):
+        # Rows whose blob does not hold the months their labels promised are not trusted.
+        print(f"Spatial store rows for {source} tile {key} decoded without the planned months; extracting them")
+        block = None
+    if block is None:
+        store_months.inc(months, kind=source, source="extraction")
+        store_lookups.inc(kind=source, result="miss")
+        return None, everything
+    store_months.inc(months - len(missing), kind=source, source="store")
+    store_months.inc(len(missing), kind=source, source="extraction")
+    store_lookups.inc(kind=source, result="partial" if missing else "hit")
+    store_seconds.observe(time.perf_counter() - start, operation="read")
+    return block, date_ranges(missing)
+
+
+def read_predictions(bounds, polygon_list, dates):
+    west, south, east, north = bounds
+    rows = CropData.objects.filter(kind=PREDICTION, west__lte=east, east__gte=west, south__lte=north, north__gte=south)
+    if dates is not None:
+        rows = rows.filter(start_date=dates[0], end_date=dates[1])
+    ids = list(rows.order_by("id").values_list("id", "pixels"))
+    total = sum(pixels for _, pixels in ids)
+    if total > settings.SPATIAL_STORE["MAX_QUERY_PIXELS"]:
+        raise QueryTooLarge(f"{total} stored pixels in the area, more than {settings.SPATIAL_STORE['MAX_QUERY_PIXELS']}")
+    return list(CropData.objects.filter(id__in=[row_id for row_id, _ in ids]).order_by("id").values_list("data", flat=True))
+
+
+def merge_predictions(blobs, bounds, polygon_list):
+    # Pixels in the bbox (and polygons, if given); where rows overlap, the newest wins.
+    west, south, east, north = bounds
+    coords, predictions = [np.empty((0, 2))], [np.empty(0, dtype=np.int64)]
+    for data in blobs:
+        arrays = _unpack(data)
+        lon, lat = arrays["coords"][:, 0], arrays["coords"][:, 1]
+        keep = (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+        if polygon_list:
+            keep[keep] = points_in_polygons(polygon_list, lon[keep], lat[keep])
+        coords.append(arrays["coords"][keep])
+        predictions.append(arrays["predictions"][keep].astype(np.int64))
+    coords, predictions = np.concatenate(coords), np.concatenate(predictions)
+    # Each (lon, lat) pair as one complex number: a 1-d unique is much faster than axis=0.
+    _, newest = np.unique(np.ascontiguousarray(coords[::-1]).view(np.complex128).ravel(), return_index=True)
+    newest = len(coords) - 1 - newest
+    return PredictionMap(coords[newest], predictions[newest])
+
+
+async def query_predictions(bounds, polygon_list=None, start_date=None, end_date=None):
+    # Raises QueryTooLarge, ValueError for invalid dates, or DatabaseError.
+    dates = None
+    if start_date is not None or end_date is not None:
+        dates = parse_dates(start_date, end_date)
+        if dates is None:
+            raise ValueError("startDate and endDate must both be ISO dates (YYYY-MM-DD)")
+    start = time.perf_counter()
+    blobs = await sync_to_async(read_predictions)(bounds, polygon_list, dates)
+    prediction_map = await offload(merge_predictions, blobs, bounds, polygon_list)
+    store_seconds.observe(time.perf_counter() - start, operation="query")
+    return prediction_map
@@ -0,0 +1,94 @@
+# streaming.py
+# Incremental reader for large top-level JSON objects. Bytes are fed as they arrive and
+# complete members come out as (key, value) pairs, so only one member is decoded at a time.
+import codecs
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"[ \t\n\r]*")
+
+
+class ObjectReader:
+    def __init__(self):
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._text = ""
+        self._pos = 0
+        self._state = "start"
+        self._key = None
+        # A member that does not decode yet is retried once its buffered text has doubled,
+        # so a single huge member costs O(n) rather than one full re-parse per chunk.
+        self._retry_at = 0
+
+    def feed(self, chunk):
+        self._text = self._text[self._pos:] + self._utf8.decode(chunk)
+        self._pos = 0
+        return self._members(final=False)
+
+    def close(self):
+        self._text = self._text[self._pos:] + self._utf8.decode(b"", final=True)
+        self._pos = 0
+        members = self._members(final=True)
+        if self._state != "end":
+            raise json.JSONDecodeError("Unterminated object", self._text, self._pos)
+        return members
+
+    def _skip(self):
+        self._pos = _whitespace.match(self._text, self._pos).end()
+        return self._pos < len(self._text)
+
+    def _expect(self, chars):
+        char = self._text[self._pos]
+        if char not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", self._text, self._pos)
+        self._pos += 1
+        return char
+
+    def _decode(self, final):
+        if not final and len(self._text) - self._pos < self._retry_at:
+            return False, None
+        try:
+            value, end = _decoder.raw_decode(self._text, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            self._retry_at = 2 * (len(self._text) - self._pos)
+            return False, None
+        # A number at the very end of the buffer may still be missing digits.
+        if end == len(self._text) and not final:
+            return False, None
+        self._pos = end
+        self._retry_at = 0
+        return True, value
+
+    def _members(self, final):
+        members = []
+        while self._skip():
+            if self._state == "start":
+                self._expect("{")
+                self._state = "first"
+            elif self._state == "first" and self._text[self._pos] == "}":
+                self._pos += 1
+                self._state = "end"
+            elif self._state in ("first", "key"):
+                ok, key = self._decode(final)
+                if not ok:
+                    break
+                if not isinstance(key, str):
+                    raise json.JSONDecodeError("Expecting property name", self._text, self._pos)
+                self._key = key
+                self._state = "colon"
+            elif self._state == "colon":
+                self._expect(":")
+                self._state = "value"
+            elif self._state == "value":
+                ok, value = self._decode(final)
+                if not ok:
+                    break
+                members.append((self._key, value))
+                self._state = "next"
+            elif self._state == "next":
+                self._state = "key" if self._expect(",}") == "," else "end"
+            else:
+                raise json.JSONDecodeError("Extra data", self._text, self._pos)
+        return members
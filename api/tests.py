@@ -1,3 +1,1169 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import math
+import struct
+import zlib
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+import pandas as pd
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from api import resilience, store
+from api.batch import aois, split_output
+from api.cache import ExtractionCache, LRUCache, extraction_key
+from api.features import S1_FEATURES, S2_FEATURES, ExtractionBlock, combine_blocks, merge_s1_s2
+from api.geometry import bbox, clip_ring, grid_tiles, polygons, ring_area
+from api.jobs import CANCELLED, SUCCEEDED, JobRunner, LocalJobStore, get_job_runner
+from api.models import CropData
+from api.output import PredictionMap
+from api.pipeline import fetch_extractions, request_crop_prediction
+from api.pixels import PixelIndex
+from api.progress import JobProgress
+from api.raster import NODATA, rasterize, to_geotiff, to_png
+from api.routing import websocket_urlpatterns
+from api.singleflight import SingleFlight
+from api.store import date_ranges, month_spans, plan_months
+from api.streaming import ObjectReader
+from api.tiles import EXTENT, LAYER, TileIndex, encode_tile
+from api.views import stored_results
+
+
+def box(west, south, east, north):
+    return {"type": "Polygon", "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+
+def area(polygon):
+    exterior, *holes = [abs(ring_area(ring[:-1])) for ring in polygon]
+    return exterior - sum(holes)
+
+
+def read_object(chunks):
+    reader = ObjectReader()
+    members = []
+    for chunk in chunks:
+        members += reader.feed(chunk)
+    return members + reader.close()
+
+
+class GeometryTests(SimpleTestCase):
+    def test_clip_ring_to_box(self):
+        ring = box(0.0, 0.0, 2.0, 2.0)["coordinates"][0]
+        clipped = clip_ring(ring, 1.0, 1.0, 3.0, 3.0)
+        self.assertAlmostEqual(area([clipped]), 1.0)
+        self.assertEqual(clipped[0], clipped[-1])
+        self.assertIsNone(clip_ring(ring, 5.0, 5.0, 6.0, 6.0))
+
+    def test_clip_concave_ring(self):
+        # An L shape whose arms leave the box.
+        ring = [[0, 0], [3, 0], [3, 1], [1, 1], [1, 3], [0, 3], [0, 0]]
+        clipped = clip_ring(ring, 0.5, 0.5, 2.0, 2.0)
+        self.assertAlmostEqual(area([clipped]), 1.5 * 0.5 + 0.5 * 1.0)
+
+    def test_grid_tiles_cover_the_polygon(self):
+        polygon = box(77.51, 12.92, 77.63, 12.99)
+        polygon["coordinates"].append([[77.55, 12.95], [77.56, 12.95], [77.56, 12.96], [77.55, 12.96], [77.55, 12.95]])
+        tiles = grid_tiles(polygon, 0.05, 64)
+        self.assertEqual(len(tiles), 6)
+        total = 0.0
+        for tile_id, tile in tiles:
+            size, ix, iy = tile_id.split(":")
+            self.assertEqual(float(size), 0.05)
+            for part in polygons(tile):
+                xs = [p[0] for p in part[0]]
+                ys = [p[1] for p in part[0]]
+                self.assertGreaterEqual(min(xs), int(ix) * 0.05 - 1e-9)
+                self.assertLessEqual(max(xs), (int(ix) + 1) * 0.05 + 1e-9)
+                self.assertGreaterEqual(min(ys), int(iy) * 0.05 - 1e-9)
+                self.assertLessEqual(max(ys), (int(iy) + 1) * 0.05 + 1e-9)
+                total += area(part)
+        self.assertAlmostEqual(total, area(polygon["coordinates"]), places=12)
+
+    def test_grid_tiles_keep_envelope_and_limit(self):
+        feature = {"type": "Feature", "properties": {"name": "f"}, "geometry": box(77.51, 12.91, 77.79, 12.99)}
+        tiles = grid_tiles(feature, 0.05, 4)
+        self.assertEqual([tile_id for tile_id, _ in tiles], ["0.1:775:129", "0.1:776:129", "0.1:777:129"])
+        self.assertTrue(all(tile["type"] == "Feature" and tile["properties"] == {"name": "f"} for _, tile in tiles))
+
+    def test_small_aoi_is_not_split(self):
+        polygon = box(77.51, 12.91, 77.52, 12.92)
+        self.assertEqual(grid_tiles(polygon, 0.05, 64), [(None, polygon)])
+
+
+class ObjectReaderTests(SimpleTestCase):
+    DATA = {
+        "77.5001,12.9001": {"2024-01": {"VV": -12.5, "VH": None}, "2024-02": {"VV": 1e-7, "VH": -3}},
+        "name": "café ✓ \U0001f33e",
+        "list": [1, 2.5, True, False, None, "x"],
+        "empty": {},
+        "n": 1234567890,
+    }
+
+    def test_every_chunk_boundary(self):
+        body = json.dumps(self.DATA, ensure_ascii=False).encode("utf-8")
+        expected = list(self.DATA.items())
+        for split in range(len(body) + 1):
+            self.assertEqual(read_object([body[:split], body[split:]]), expected, split)
+
+    def test_one_byte_at_a_time(self):
+        # Splits every multi-byte UTF-8 character and every number across chunks.
+        body = json.dumps(self.DATA, ensure_ascii=False, indent=2).encode("utf-8")
+        self.assertEqual(read_object([body[i:i + 1] for i in range(len(body))]), list(self.DATA.items()))
+
+    def test_number_at_end_of_chunk_is_not_cut(self):
+        self.assertEqual(read_object([b'{"n": 12', b'34}']), [("n", 1234)])
+
+    def test_empty_object(self):
+        self.assertEqual(read_object([b" { } "]), [])
+
+    def test_malformed(self):
+        for body in [b'{"a": 1,, "b": 2}', b'{"a" 1}', b'[1, 2]', b'{"a": 1} x', b'{"a": tru', b'{"a": 1', b'{1: 2}', b""]:
+            with self.subTest(body=body), self.assertRaises(json.JSONDecodeError):
+                read_object([body[:3], body[3:]])
+
+    def test_invalid_utf8(self):
+        with self.assertRaises(UnicodeDecodeError):
+            read_object([b'{"a": "\xff"}'])
+
+
+class BlockMergeTests(SimpleTestCase):
+    def block(self, pixels, months, value):
+        return ExtractionBlock.from_dict(
+            {key: {month: {f: value for f in S1_FEATURES} for month in months} for key in pixels}, S1_FEATURES)
+
+    def test_tiles_merge_and_later_rows_win(self):
+        merged = self.block(["1,1", "2,2"], ["2024-01"], 1.0)
+        merged.update(self.block(["2,2", "3,3"], ["2024-01", "2024-02"], 2.0))
+        self.assertEqual(merged.pixels.keys, ["1,1", "2,2", "3,3"])
+        self.assertEqual(list(merged.months), ["2024-01", "2024-02"])
+        cube = merge_s1_s2(merged, ExtractionBlock(["NDVI"]))
+        self.assertEqual(cube.values[1, 0, 0], 2.0)
+        self.assertEqual(cube.values[0, 0, 0], 1.0)
+        self.assertFalse(cube.mask[0, 1])
+
+    def test_combine_blocks_orders_months(self):
+        combined = combine_blocks([self.block(["1,1"], ["2024-03"], 3.0), self.block(["1,1"], ["2024-01", "2024-02"], 1.0)])
+        self.assertEqual(list(combined.months), ["2024-01", "2024-02", "2024-03"])
+        self.assertEqual(combined.to_dict()["1,1"]["2024-03"]["VV"], 3.0)
+
+    def test_combine_blocks_orders_months_by_date(self):
+        combined = combine_blocks([self.block(["1,1"], ["2024-10", "2024-11-01"], 2.0), self.block(["1,1"], ["2024-9"], 1.0)])
+        self.assertEqual(list(combined.months), ["2024-9", "2024-10", "2024-11-01"])
+
+
+def sample_map():
+    # A 4 x 3 grid of 0.0001 degree pixels with the north-east one missing.
+    lon, lat = np.meshgrid(77.5 + np.arange(4) * 0.0001, 12.9 + np.arange(3) * 0.0001)
+    coords = np.column_stack([lon.ravel(), lat.ravel()])[:-1]
+    return PredictionMap(coords, np.arange(len(coords), dtype=np.int64) % 2)
+
+
+class RasterTests(SimpleTestCase):
+    def setUp(self):
+        self.map = sample_map()
+
+    def test_png(self):
+        raster = rasterize(self.map)
+        png = to_png(raster)
+        self.assertEqual(png[:8], b"\x89PNG\r\n\x1a\n")
+        chunks, pos = {}, 8
+        while pos < len(png):
+            size, = struct.unpack(">I", png[pos:pos + 4])
+            kind, data = png[pos + 4:pos + 8], png[pos + 8:pos + 8 + size]
+            self.assertEqual(struct.unpack(">I", png[pos + 8 + size:pos + 12 + size])[0], zlib.crc32(kind + data))
+            chunks[kind] = data
+            pos += 12 + size
+        width, height, depth, color_type = struct.unpack(">IIBB", chunks[b"IHDR"][:10])
+        self.assertEqual((width, height, depth, color_type), (4, 3, 8, 3))
+        self.assertEqual(chunks[b"tRNS"][0], 0)
+        rows = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=np.uint8).reshape(height, width + 1)
+        self.assertTrue((rows[:, 0] == 0).all())
+        expected = np.where(raster.values == NODATA, 0, raster.values + 1)
+        np.testing.assert_array_equal(rows[:, 1:], expected)
+        # Row 0 is north: the missing pixel is the north-east corner.
+        self.assertEqual(rows[0, -1], 0)
+        self.assertEqual(b"", chunks[b"IEND"])
+
+    def test_geotiff(self):
+        raster = rasterize(self.map)
+        tiff = to_geotiff(raster, rows_per_strip=2)
+        self.assertEqual(tiff[:4], b"II*\x00")
+        ifd, = struct.unpack("<I", tiff[4:8])
+        count, = struct.unpack("<H", tiff[ifd:ifd + 2])
+        formats = {3: ("H", 2), 4: ("I", 4), 12: ("d", 8), 2: ("s", 1)}
+        tags = {}
+        for n in range(count):
+            tag, kind, length = struct.unpack("<HHI", tiff[ifd + 2 + 12 * n:ifd + 10 + 12 * n])
+            code, size = formats[kind]
+            raw = tiff[ifd + 10 + 12 * n:ifd + 14 + 12 * n]
+            if length * size > 4:
+                offset, = struct.unpack("<I", raw)
+                raw = tiff[offset:offset + length * size]
+            tags[tag] = raw[:length] if kind == 2 else list(struct.unpack(f"<{length}{code}", raw[:length * size]))
+        self.assertEqual((tags[256], tags[257], tags[258], tags[259]), ([4], [3], [8], [8]))
+        strips = [zlib.decompress(tiff[offset:offset + size]) for offset, size in zip(tags[273], tags[279])]
+        self.assertEqual(len(strips), 2)
+        np.testing.assert_array_equal(np.frombuffer(b"".join(strips), dtype=np.uint8).reshape(3, 4), raster.values)
+        self.assertEqual(tags[33550][:2], [raster.step_x, raster.step_y])
+        self.assertEqual(tags[33922][3:5], [raster.west, raster.north])
+        self.assertIn(4326, tags[34735])
+        self.assertEqual(tags[42113], b"255\x00")
+        self.assertAlmostEqual(raster.west, 77.5 - 0.00005)
+
+
+def read_protobuf(data):
+    # [(field, wire type, value)]: varints as ints, length-delimited fields as bytes.
+    fields, pos = [], 0
+
+    def varint():
+        nonlocal pos
+        value = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    while pos < len(data):
+        key = varint()
+        wire = key & 7
+        if wire == 0:
+            value = varint()
+        elif wire == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire == 2:
+            size = varint()
+            value, pos = data[pos:pos + size], pos + size
+        else:
+            raise AssertionError(f"unexpected wire type {wire}")
+        fields.append((key >> 3, wire, value))
+    return fields
+
+
+def read_packed(data):
+    pos, values = 0, []
+    while pos < len(data):
+        value = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        values.append(value)
+    return values
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def read_tile(data):
+    # The single layer of a tile as (name, extent, [(type, properties, [[(x, y), ...] per command run]])].
+    (number, _, layer), = read_protobuf(data)
+    assert number == 3
+    fields = read_protobuf(layer)
+    keys = [value.decode() for number, _, value in fields if number == 3]
+    values = []
+    for number, _, value in fields:
+        if number == 4:
+            (kind, _, raw), = read_protobuf(value)
+            values.append(struct.unpack("<d", raw)[0] if kind == 3 else raw)
+    features = []
+    for number, _, value in fields:
+        if number != 2:
+            continue
+        feature = {n: v for n, _, v in read_protobuf(value)}
+        tags = read_packed(feature[2])
+        properties = {keys[k]: values[v] for k, v in zip(tags[0::2], tags[1::2])}
+        commands = read_packed(feature[4])
+        x = y = 0
+        paths, pos = [], 0
+        while pos < len(commands):
+            command, count = commands[pos] & 7, commands[pos] >> 3
+            pos += 1
+            if command == 7:
+                continue
+            if command == 1:
+                paths.append([])
+            for _ in range(count):
+                x += unzigzag(commands[pos])
+                y += unzigzag(commands[pos + 1])
+                pos += 2
+                paths[-1].append((x, y))
+        features.append((feature[3], properties, paths))
+    name = next(value.decode() for number, _, value in fields if number == 1)
+    version = next(value for number, _, value in fields if number == 15)
+    extent = next(value for number, _, value in fields if number == 5)
+    assert version == 2
+    return name, extent, features
+
+
+def tile_of(lon, lat, z):
+    n = 2 ** z
+    y = (1 - math.log(math.tan(math.radians(lat)) + 1 / math.cos(math.radians(lat))) / math.pi) / 2
+    return int((lon + 180) / 360 * n), int(y * n)
+
+
+def tile_to_lonlat(z, x, y, px, py):
+    n = 2 ** z
+    wx, wy = (x + px / EXTENT) / n, (y + py / EXTENT) / n
+    return wx * 360 - 180, math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * wy))))
+
+
+class VectorTileTests(SimpleTestCase):
+    def setUp(self):
+        self.map = sample_map()
+
+    @override_settings(TILES={"DETAIL_ZOOM": 14, "AGGREGATE_CELLS": 64})
+    def test_vector_tile_points(self):
+        z = 16
+        x, y = tile_of(77.50015, 12.9001, z)
+        name, extent, features = read_tile(encode_tile(TileIndex(self.map), z, x, y))
+        self.assertEqual((name, extent), (LAYER, EXTENT))
+        decoded = {}
+        for geometry_type, properties, paths in features:
+            self.assertEqual(geometry_type, 1)
+            for px, py in paths[0]:
+                decoded[tile_to_lonlat(z, x, y, px, py)] = properties["prediction"]
+        self.assertEqual(len(decoded), len(self.map))
+        for (lon, lat), prediction in zip(self.map.coords.tolist(), self.map.predictions.tolist()):
+            match = [p for (dlon, dlat), p in decoded.items() if abs(dlon - lon) < 1e-5 and abs(dlat - lat) < 1e-5]
+            self.assertEqual(match, [prediction])
+
+    @override_settings(TILES={"DETAIL_ZOOM": 14, "AGGREGATE_CELLS": 4})
+    def test_vector_tile_cells(self):
+        z = 8
+        x, y = tile_of(77.5, 12.9, z)
+        _, _, features = read_tile(encode_tile(TileIndex(self.map), z, x, y))
+        self.assertEqual(sum(properties["count"] for _, properties, _ in features), len(self.map))
+        geometry_type, properties, paths = features[0]
+        self.assertEqual(geometry_type, 3)
+        self.assertAlmostEqual(properties["ragiFraction"], round(float(self.map.predictions.mean()), 3))
+        (x0, y0), = paths[0][:1]
+        size = EXTENT // 4
+        self.assertEqual(paths[0], [(x0, y0), (x0 + size, y0), (x0 + size, y0 + size), (x0, y0 + size)])
+        self.assertEqual(encode_tile(TileIndex(self.map), z, x + 1, y), b"")
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("api.resilience.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = resilience.CircuitBreaker("test", failures=2, reset=10)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.failure()
+        self.breaker.check()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, resilience.CLOSED)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, resilience.OPEN)
+        with self.assertRaises(resilience.CircuitOpen):
+            self.breaker.check()
+
+    def test_half_open_lets_one_trial_through(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 10
+        self.assertTrue(self.breaker.check())
+        self.assertEqual(self.breaker.state, resilience.HALF_OPEN)
+        # Other calls wait for the trial instead of failing.
+        self.assertFalse(self.breaker.check())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, resilience.CLOSED)
+        self.assertTrue(self.breaker.check())
+
+    def test_half_open_admits_probes(self):
+        breaker = resilience.CircuitBreaker("test", failures=1, reset=10, probes=3)
+        breaker.failure()
+        self.now += 10
+        self.assertEqual([breaker.check() for _ in range(4)], [True, True, True, False])
+
+    def test_failed_trial_reopens(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 10
+        self.breaker.check()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, resilience.OPEN)
+        self.now += 9
+        with self.assertRaises(resilience.CircuitOpen):
+            self.breaker.check()
+        self.now += 1
+        self.assertTrue(self.breaker.check())
+        self.assertEqual(self.breaker.state, resilience.HALF_OPEN)
+
+    def test_abandoned_trial_hands_over(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 10
+        self.breaker.check()
+        self.assertFalse(self.breaker.check())
+        self.breaker.abandon()
+        self.assertEqual(self.breaker.state, resilience.HALF_OPEN)
+        self.assertTrue(self.breaker.check())
+
+    async def opened_breaker(self):
+        # Half-open, with the trial call admitted and three calls waiting for its outcome.
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 10
+        await self.breaker.admit()
+        return [asyncio.create_task(self.breaker.admit()) for _ in range(3)]
+
+    async def test_waiting_calls_go_ahead_once_the_trial_succeeds(self):
+        waiting = await self.opened_breaker()
+        await asyncio.sleep(0)
+        self.assertFalse(any(task.done() for task in waiting))
+        self.breaker.success()
+        await asyncio.gather(*waiting)
+
+    async def test_waiting_calls_fail_fast_once_the_trial_fails(self):
+        waiting = await self.opened_breaker()
+        await asyncio.sleep(0)
+        self.breaker.failure()
+        for result in await asyncio.gather(*waiting, return_exceptions=True):
+            self.assertIsInstance(result, resilience.CircuitOpen)
+
+
+class PolicyTests(SimpleTestCase):
+    CONF = {
+        "RETRIES": 2, "BACKOFF": 0.0, "HEDGE": False, "HEDGE_QUANTILE": 0.95, "HEDGE_MIN_DELAY": 0.5,
+        "HEDGE_MIN_SAMPLES": 20, "TIMEOUT": 0, "BREAKER_FAILURES": 3, "BREAKER_RESET": 30, "BREAKER_PROBES": 1,
+    }
+
+    def call(self, policy, outcomes):
+        calls = []
+
+        async def attempt():
+            calls.append(None)
+            outcome = outcomes[min(len(calls), len(outcomes)) - 1]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        return asyncio.run(policy.call(attempt)), len(calls)
+
+    def test_retries_retryable_errors(self):
+        policy = resilience.Policy("test-retry", self.CONF)
+        outcomes = [resilience.UpstreamStatusError(503), resilience.UpstreamStatusError(429), "ok"]
+        self.assertEqual(self.call(policy, outcomes), ("ok", 3))
+        self.assertEqual(policy.breaker.state, resilience.CLOSED)
+
+    def test_client_errors_are_not_retried(self):
+        policy = resilience.Policy("test-client", self.CONF)
+        with self.assertRaises(resilience.UpstreamStatusError):
+            self.call(policy, [resilience.UpstreamStatusError(400), "ok"])
+        self.assertEqual(policy.breaker.consecutive, 0)
+
+    def test_breaker_fails_fast_once_open(self):
+        policy = resilience.Policy("test-breaker", {**self.CONF, "RETRIES": 0})
+        for _ in range(3):
+            with self.assertRaises(resilience.UpstreamStatusError):
+                self.call(policy, [resilience.UpstreamStatusError(502)])
+        with self.assertRaises(resilience.CircuitOpen):
+            self.call(policy, ["ok"])
+
+    async def test_calls_wait_for_the_trial_after_an_outage(self):
+        # Tiles of one job retrying together once the circuit is half-open.
+        policy = resilience.Policy("test-trial", {**self.CONF, "RETRIES": 0, "BREAKER_RESET": 0})
+        policy.breaker.failure()
+        policy.breaker.failure()
+        policy.breaker.failure()
+        release = asyncio.Event()
+        calls = []
+
+        async def attempt():
+            calls.append(None)
+            await release.wait()
+            return "ok"
+
+        tiles = [asyncio.create_task(policy.call(attempt)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(calls), 1)
+        release.set()
+        self.assertEqual(await asyncio.gather(*tiles), ["ok"] * 5)
+        self.assertEqual(policy.breaker.state, resilience.CLOSED)
+
+
+class MonthPlanTests(SimpleTestCase):
+    def row(self, pk, start, end, written, months):
+        return CropData(
+            id=pk, start_date=datetime.date.fromisoformat(start), end_date=datetime.date.fromisoformat(end),
+            timestamp=datetime.datetime.fromisoformat(written), band_values={"months": months},
+        )
+
+    def dates(self, start, end):
+        return datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+
+    def test_month_spans_and_ranges(self):
+        spans = month_spans(*self.dates("2023-12-15", "2024-03-10"))
+        self.assertEqual([label for label, _, _ in spans], ["2023-12", "2024-01", "2024-02", "2024-03"])
+        self.assertEqual(spans[0][1:], self.dates("2023-12-15", "2023-12-31"))
+        self.assertEqual(spans[2][1:], self.dates("2024-02-01", "2024-02-29"))
+        self.assertEqual(spans[3][1:], self.dates("2024-03-01", "2024-03-10"))
+        self.assertEqual(date_ranges([spans[0], spans[1], spans[3]]), [("2023-12-15", "2024-01-31"), ("2024-03-01", "2024-03-10")])
+
+    def test_only_missing_months_are_extracted(self):
+        row = self.row(1, "2024-01-01", "2024-03-31", "2024-05-01", ["2024-01", "2024-02", "2024-03"])
+        chosen, missing = plan_months([row], self.dates("2024-01-01", "2024-04-30"))
+        self.assertEqual(chosen, {row: ["2024-01", "2024-02", "2024-03"]})
+        self.assertEqual(date_ranges(missing), [("2024-04-01", "2024-04-30")])
+
+    def test_months_need_the_same_days_and_a_later_write(self):
+        row = self.row(1, "2024-01-01", "2024-03-31", "2024-03-20", ["2024-01", "2024-02", "2024-03"])
+        chosen, missing = plan_months([row], self.dates("2024-01-15", "2024-03-31"))
+        self.assertEqual(chosen, {row: ["2024-02"]})
+        self.assertEqual(date_ranges(missing), [("2024-01-15", "2024-01-31"), ("2024-03-01", "2024-03-31")])
+
+    def test_months_come_from_the_rows_labels(self):
+        dated = self.row(1, "2024-01-01", "2024-02-29", "2024-05-01", ["2024-01-01", "2024-02-01"])
+        named = self.row(2, "2024-01-01", "2024-02-29", "2024-05-01", ["January", "February"])
+        gap = self.row(3, "2024-01-01", "2024-02-29", "2024-05-01", ["2024-02"])
+        dates = self.dates("2024-01-01", "2024-02-29")
+        self.assertEqual(plan_months([dated], dates), ({dated: ["2024-01-01", "2024-02-01"]}, []))
+        self.assertEqual(plan_months([named], dates)[0], {})
+        chosen, missing = plan_months([gap], dates)
+        self.assertEqual(chosen, {gap: ["2024-02"]})
+        self.assertEqual([label for label, _, _ in missing], ["2024-01"])
+
+    def test_newest_row_wins(self):
+        newer = self.row(2, "2024-01-01", "2024-01-31", "2024-06-01", ["2024-01"])
+        older = self.row(1, "2024-01-01", "2024-01-31", "2024-05-01", ["2024-01"])
+        self.assertEqual(plan_months([newer, older], self.dates("2024-01-01", "2024-01-31"))[0], {newer: ["2024-01"]})
+
+
+class StoreTests(TestCase):
+    # The 0.05 degree grid cell 1550:258, and three pixels in it.
+    TILE = "0.05:1550:258"
+    KEYS = ["77.51,12.91", "77.52,12.93", "77.54,12.94"]
+
+    def setUp(self):
+        self.tile = box(77.50, 12.90, 77.55, 12.95)
+        self.block = ExtractionBlock(S1_FEATURES)
+        for i, key in enumerate(self.KEYS):
+            self.block.add(key, {month: {f: i + 0.5 for f in S1_FEATURES} for month in ("2024-01", "2024-02")})
+
+    async def save(self, **extra):
+        fetched = [("s1", self.TILE, self.tile, self.block, "2024-01-01", "2024-02-29")]
+        await store.save_job("store-job", self.tile, "2024-01-01", "2024-02-29", fetched, **extra)
+
+    async def test_tile_round_trip(self):
+        await self.save()
+        block, missing = await store.find_tile("s1", S1_FEATURES, self.tile, "2024-01-01", "2024-02-29")
+        self.assertEqual((block.to_dict(), missing), (self.block.to_dict(), []))
+        # A tile of a later AOI is cut out of the stored cell.
+        part = box(77.50, 12.90, 77.525, 12.925)
+        block, missing = await store.find_tile("s1", S1_FEATURES, part, "2024-01-01", "2024-02-29")
+        self.assertEqual(list(block.to_dict()), ["77.51,12.91"])
+        # Only the months that are not stored are left to extract.
+        block, missing = await store.find_tile("s1", S1_FEATURES, self.tile, "2024-01-01", "2024-04-30")
+        self.assertEqual((list(block.months), missing), (["2024-01", "2024-02"], [("2024-03-01", "2024-04-30")]))
+        block, missing = await store.find_tile("s2", S2_FEATURES, self.tile, "2024-01-01", "2024-02-29")
+        self.assertEqual((block, missing), (None, [("2024-01-01", "2024-02-29")]))
+
+    async def test_saving_again_replaces_the_rows(self):
+        await self.save()
+        self.block = ExtractionBlock.from_dict({self.KEYS[0]: {"2024-01": {f: 9.0 for f in S1_FEATURES}}}, S1_FEATURES)
+        await self.save()
+        block, _ = await store.find_tile("s1", S1_FEATURES, self.tile, "2024-01-01", "2024-01-31")
+        self.assertEqual(block.to_dict(), self.block.to_dict())
+        self.assertEqual(await CropData.objects.filter(kind="s1").acount(), 1)
+
+    async def test_prediction_query_round_trip(self):
+        coords = np.array([[77.51, 12.91], [77.52, 12.93], [77.56, 12.96]])
+        await self.save(prediction_map=PredictionMap(coords, np.array([1, 2, 3])))
+        found = await store.query_predictions((77.50, 12.90, 77.55, 12.95))
+        self.assertEqual((found.coords.tolist(), found.predictions.tolist()), (coords[:2].tolist(), [1, 2]))
+        found = await store.query_predictions((77.50, 12.90, 77.60, 13.0), polygons(box(77.515, 12.92, 77.6, 13.0)))
+        self.assertEqual(found.predictions.tolist(), [2, 3])
+        found = await store.query_predictions((77.50, 12.90, 77.60, 13.0), None, "2023-01-01", "2023-12-31")
+        self.assertEqual(len(found), 0)
+        with override_settings(SPATIAL_STORE={**settings.SPATIAL_STORE, "MAX_QUERY_PIXELS": 2}):
+            with self.assertRaises(store.QueryTooLarge):
+                await store.query_predictions((77.50, 12.90, 77.60, 13.0))
+
+
+def submission(job_id):
+    return json.dumps({
+        "geojson": box(77.51, 12.91, 77.52, 12.92), "startDate": "2024-01-01", "endDate": "2024-03-31",
+        "flag": "test", "jobId": job_id,
+    })
+
+
+async def stop(runner):
+    tasks = runner.workers + list(runner.listeners.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@override_settings(JOBS={**settings.JOBS, "MAX_CONCURRENT": 1, "MAX_QUEUED": 1})
+class JobTests(SimpleTestCase):
+    def setUp(self):
+        # Stands in for run_pipeline: each job waits until released.
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+        async def job(*args):
+            self.started.set()
+            await self.release.wait()
+            return {"output": "done"}
+
+        patcher = mock.patch("api.views.run_pipeline", job)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def post(self, job_id):
+        return await self.async_client.post("/api/jobs/", submission(job_id), content_type="application/json")
+
+    async def test_duplicate_job_id_is_rejected(self):
+        runner = get_job_runner()
+        try:
+            self.assertEqual((await self.post("job-duplicate")).status_code, 202)
+            future = runner.futures["job-duplicate"]
+            self.assertEqual((await self.post("job-duplicate")).status_code, 409)
+            self.release.set()
+            self.assertEqual(await future, {"output": "done"})
+            # A finished job keeps its id for JOB_TTL.
+            self.assertEqual((await self.post("job-duplicate")).status_code, 409)
+            self.assertEqual((await runner.store.get("job-duplicate"))["status"], SUCCEEDED)
+        finally:
+            await stop(runner)
+
+    async def test_full_queue_is_rejected(self):
+        runner = get_job_runner()
+        try:
+            self.assertEqual((await self.post("job-running")).status_code, 202)
+            await self.started.wait()
+            self.assertEqual((await self.post("job-queued")).status_code, 202)
+            response = await self.post("job-rejected")
+            self.assertEqual(response.status_code, 429)
+            self.assertIsNone(await runner.store.get("job-rejected"))
+            self.release.set()
+            await runner.futures["job-queued"]
+            self.assertEqual((await self.post("job-rejected")).status_code, 202)
+        finally:
+            self.release.set()
+            await stop(runner)
+
+    async def test_local_store_evicts_after_ttl(self):
+        now = [1000.0]
+        with mock.patch("api.jobs.time.monotonic", lambda: now[0]):
+            store = LocalJobStore(60)
+            self.assertTrue(await store.create("job-ttl", {"status": "queued"}))
+            self.assertFalse(await store.create("job-ttl", {"status": "queued"}))
+            await store.create("job-stale", {"status": "queued"})
+            await store.set_result("job-ttl", {"output": 1})
+            now[0] += 59
+            await store.update("job-ttl", status="running")
+            self.assertEqual(await store.get_result("job-ttl"), {"output": 1})
+            now[0] += 59
+            # update() renewed the record; the result was written 118 s ago.
+            self.assertEqual((await store.get("job-ttl"))["status"], "running")
+            self.assertIsNone(await store.get_result("job-ttl"))
+            now[0] += 60
+            self.assertIsNone(await store.get("job-ttl"))
+            self.assertTrue(await store.create("job-ttl", {"status": "queued"}))
+            # Expired entries nobody reads again are swept on writes.
+            self.assertEqual(set(store._records), {"job-ttl"})
+            self.assertEqual(store._results, {})
+
+    async def test_cancel_queued_and_running_jobs(self):
+        runner = JobRunner(LocalJobStore(60), 1, 5)
+        calls = []
+
+        async def job(name):
+            calls.append(name)
+            self.started.set()
+            await self.release.wait()
+
+        try:
+            running = await runner.submit("cancel-running", job, "running")
+            queued = await runner.submit("cancel-queued", job, "queued")
+            await self.started.wait()
+            self.assertTrue(await runner.cancel("cancel-queued", "client"))
+            self.assertEqual(await queued, {"error": "Job cancelled", "cancelled": True})
+            self.assertEqual((await runner.store.get("cancel-queued"))["status"], CANCELLED)
+            self.assertEqual((await runner.store.get("cancel-running"))["status"], "running")
+            self.assertTrue(await runner.cancel("cancel-running", "client"))
+            self.assertEqual(await running, {"error": "Job cancelled", "cancelled": True})
+            record = await runner.store.get("cancel-running")
+            self.assertEqual((record["status"], record["cancelReason"]), (CANCELLED, "client"))
+            # The worker skips the cancelled queued job.
+            await runner.queue.join()
+            self.assertEqual(calls, ["running"])
+            self.assertFalse(await runner.cancel("cancel-running", "client"))
+            self.assertEqual(runner.futures, {})
+        finally:
+            await stop(runner)
+
+    async def test_cancel_endpoint(self):
+        runner = get_job_runner()
+        try:
+            self.assertEqual((await self.post("job-endpoint")).status_code, 202)
+            future = runner.futures["job-endpoint"]
+            await self.started.wait()
+            self.assertEqual((await self.async_client.get("/api/jobs/job-endpoint/cancel/")).status_code, 405)
+            self.assertEqual((await self.async_client.post("/api/jobs/job-unknown/cancel/")).status_code, 404)
+            response = await self.async_client.post("/api/jobs/job-endpoint/cancel/")
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(json.loads(response.content), {"jobId": "job-endpoint", "status": "cancelling"})
+            # The request reaches the runner through the job's control group.
+            self.assertEqual(await future, {"error": "Job cancelled", "cancelled": True})
+            record = await runner.store.get("job-endpoint")
+            self.assertEqual((record["status"], record["cancelReason"]), (CANCELLED, "endpoint"))
+            self.assertEqual((await self.async_client.post("/api/jobs/job-endpoint/cancel/")).status_code, 409)
+        finally:
+            self.release.set()
+            await stop(runner)
+
+    @override_settings(JOBS={**settings.JOBS, "CANCEL_ABANDONED": True, "ABANDON_GRACE": 0})
+    async def test_job_is_cancelled_when_its_last_socket_closes(self):
+        runner = get_job_runner()
+        try:
+            self.assertEqual((await self.post("job-abandoned")).status_code, 202)
+            future = runner.futures["job-abandoned"]
+            await self.started.wait()
+            sockets = [WebsocketCommunicator(URLRouter(websocket_urlpatterns), "ws/progress/job-abandoned") for _ in range(2)]
+            for socket in sockets:
+                self.assertTrue((await socket.connect())[0])
+            self.assertEqual(await runner.store.subscribers("job-abandoned"), 2)
+            await sockets[0].disconnect()
+            await asyncio.sleep(0.05)
+            self.assertFalse(future.done())
+            await sockets[1].disconnect()
+            self.assertEqual(await asyncio.wait_for(future, 1), {"error": "Job cancelled", "cancelled": True})
+            self.assertEqual((await runner.store.get("job-abandoned"))["cancelReason"], "abandoned")
+        finally:
+            self.release.set()
+            await stop(runner)
+
+
+class CacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("api.cache.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(max_bytes=30, ttl=60)
+        cache.set("a", "A", 10)
+        cache.set("b", "B", 10)
+        cache.set("c", "C", 10)
+        self.assertEqual(cache.get("a"), "A")
+        cache.set("d", "D", 10)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual([cache.get(key) for key in "acd"], ["A", "C", "D"])
+        cache.set("c", "C2", 20)
+        self.assertEqual((cache.size, list(cache._entries)), (30, ["d", "c"]))
+        cache.set("big", "X", 31)
+        self.assertIsNone(cache.get("big"))
+        self.assertEqual(cache.size, 30)
+
+    def test_entries_expire(self):
+        cache = LRUCache(max_bytes=100, ttl=60)
+        cache.set("a", "A", 10)
+        self.now += 59
+        self.assertEqual(cache.get("a"), "A")
+        self.now += 1
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.size, 0)
+
+    async def test_shared_tier_fills_the_local_one(self):
+        conf = {"ENABLED": True, "MAX_BYTES": 1 << 20, "TTL": 60, "SHARED_ALIAS": "default", "SHARED_TTL": 600}
+        block = ExtractionBlock.from_dict({"1,1": {"2024-01": {f: 1.0 for f in S1_FEATURES}}}, S1_FEATURES)
+        key = extraction_key("s1", box(77.51, 12.91, 77.52, 12.92), "2024-01-01", "2024-01-31")
+        await ExtractionCache(conf).set(key, block)
+        replica = ExtractionCache(conf)
+        self.assertIsNone(replica.local.get(key))
+        self.assertEqual((await replica.get(key)).to_dict(), block.to_dict())
+        self.assertIsNotNone(replica.local.get(key))
+        self.assertIsNone(await ExtractionCache({**conf, "ENABLED": False}).get(key))
+
+    def test_keys_ignore_vertex_order_winding_and_envelope(self):
+        ring = box(77.51, 12.91, 77.52, 12.92)["coordinates"][0]
+        rotated = ring[2:-1] + ring[:3]
+        feature = {"type": "Feature", "properties": {"name": "f"}, "geometry": {"type": "Polygon", "coordinates": [rotated[::-1]]}}
+        key = extraction_key("s1", box(77.51, 12.91, 77.52, 12.92), "2024-01-01", "2024-01-31")
+        self.assertEqual(extraction_key("s1", feature, "2024-01-01", "2024-01-31"), key)
+        self.assertNotEqual(extraction_key("s2", feature, "2024-01-01", "2024-01-31"), key)
+        self.assertNotEqual(extraction_key("s1", feature, "2024-01-01", "2024-02-29"), key)
+
+
+class RecordingLayer:
+    # Stands in for the channel layer: keeps each message sent to a job's group.
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message["message"]["message"]))
+
+    def messages(self, job_id):
+        return [message for group, message in self.sent if group == f"job.{job_id}"]
+
+
+class ProgressTests(SimpleTestCase):
+    async def test_progress_updates_are_coalesced(self):
+        layer = RecordingLayer()
+        progress = JobProgress("progress-coalesce", layer, interval=0.05)
+        await progress.send("progress", 0, 10, "10")
+        await progress.send("progress", 10, 20, "20")
+        await progress.send("progress", 20, 30, "30")
+        # Within the interval: only the first is sent, the latest state follows once it is up.
+        self.assertEqual(layer.messages("progress-coalesce"), ["10"])
+        await asyncio.sleep(0.1)
+        self.assertEqual(layer.messages("progress-coalesce"), ["10", "30"])
+
+    async def test_other_updates_are_sent_at_once(self):
+        layer = RecordingLayer()
+        progress = JobProgress("progress-final", layer, interval=60)
+        await progress.send("progress", 0, 10, "10")
+        await progress.send("progress", 10, 40, "40")
+        await progress.send("error", message="failed")
+        await progress.send("progress", 40, 100, "100")
+        # "40" was pending and is replaced by the error; nothing is left to send later.
+        self.assertEqual(layer.messages("progress-final"), ["10", "failed", "100"])
+        self.assertIsNone(progress._flush)
+
+    async def test_discard_drops_the_pending_update(self):
+        layer = RecordingLayer()
+        progress = JobProgress("progress-discard", layer, interval=0.02)
+        await progress.send("progress", 0, 10, "10")
+        await progress.send("progress", 10, 20, "20")
+        progress.discard()
+        await asyncio.sleep(0.05)
+        self.assertEqual(layer.messages("progress-discard"), ["10"])
+
+
+class SingleFlightTests(SimpleTestCase):
+    async def test_cancelled_follower_leaves_the_shared_call_running(self):
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            await release.wait()
+            return value * 2
+
+        leader = asyncio.create_task(flight.do("key", work, 1))
+        follower = asyncio.create_task(flight.do("key", work, 1))
+        await asyncio.sleep(0)
+        follower.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await follower
+        release.set()
+        self.assertEqual(await leader, 2)
+        self.assertEqual(calls, [1])
+        self.assertEqual(flight.in_flight(), 0)
+
+    async def test_shared_call_is_cancelled_with_its_last_caller(self):
+        flight = SingleFlight("test")
+        started = asyncio.Event()
+        cancelled = []
+
+        async def work():
+            started.set()
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        callers = [asyncio.create_task(flight.do("key", work)) for _ in range(2)]
+        await started.wait()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        self.assertEqual(cancelled, [True])
+        self.assertEqual(flight.in_flight(), 0)
+
+    async def test_followers_only_see_progress_of_the_shared_call(self):
+        layer = RecordingLayer()
+        leader, follower = JobProgress("job-a", layer, interval=0), JobProgress("job-b", layer, interval=0)
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            await leader.send("progress", endProgress=50, message="shared")
+            return "done"
+
+        await leader.send("progress", endProgress=10, message="before")
+        first = asyncio.create_task(flight.do("key", work, progress=leader))
+        second = asyncio.create_task(flight.do("key", work, progress=follower))
+        await asyncio.sleep(0)
+        release.set()
+        self.assertEqual(await first, "done")
+        # The leader carries on with its own job before the follower has resumed.
+        await leader.send("progress", endProgress=100, message="after")
+        self.assertEqual(await second, "done")
+        self.assertEqual(layer.messages("job-b"), ["before", "shared"])
+        self.assertEqual(layer.messages("job-a"), ["before", "shared", "after"])
+        self.assertEqual(leader.attached, [])
+
+
+def tile_pixel(tile_geojson):
+    # The one pixel the fake extraction returns for a tile: its bbox centre.
+    west, south, east, north = bbox(polygons(tile_geojson))
+    return f"{(west + east) / 2:.5f},{(south + north) / 2:.5f}"
+
+
+@override_settings(TILING={"TILE_SIZE_DEG": 0.05, "MAX_TILES": 64, "CONCURRENCY": 4})
+class TileFailureTests(SimpleTestCase):
+    AOI = box(77.51, 12.91, 77.69, 12.99)
+
+    def setUp(self):
+        self.tiles = grid_tiles(self.AOI, 0.05, 64)
+        self.failing = set()
+
+        async def fetch_tile(source, tile_geojson, startDate, endDate):
+            pixel = tile_pixel(tile_geojson)
+            if (source, pixel) in self.failing:
+                raise resilience.UpstreamStatusError(502)
+            features = S1_FEATURES if source == "s1" else S2_FEATURES
+            return ExtractionBlock.from_dict({pixel: {"2024-01": {f: 1.0 for f in features}}}, features), []
+
+        patcher = mock.patch("api.pipeline.fetch_tile", fetch_tile)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.layer = RecordingLayer()
+
+    async def fetch(self):
+        return await fetch_extractions(self.AOI, "2024-01-01", "2024-01-31", JobProgress("tiles", self.layer, interval=0))
+
+    async def test_failed_s2_tile_only_misses_its_own_pixels(self):
+        tile_id, tile = self.tiles[3]
+        self.failing.add(("s2", tile_pixel(tile)))
+        results, failed = await self.fetch()
+        self.assertEqual(len(self.tiles), 8)
+        self.assertEqual(failed, {"s2": [tile_id]})
+        self.assertEqual(len(results["s1"].pixels), 8)
+        self.assertEqual(len(results["s2"].pixels), 7)
+        cube = merge_s1_s2(results["s1"], results["s2"])
+        s2 = cube.values[:, 0, len(S1_FEATURES):]
+        missing = cube.pixels.lookup([tile_pixel(tile)])[0]
+        self.assertTrue((s2[missing] == 0).all())
+        self.assertEqual(int((s2 == 1.0).all(axis=1).sum()), 7)
+        # Failed tiles count towards progress like the others.
+        self.assertEqual(len(self.layer.messages("tiles")), 16)
+        self.assertEqual(sum("tile failed" in message for message in self.layer.messages("tiles")), 1)
+
+    async def test_failed_s1_tile_keeps_the_other_tiles(self):
+        tile_id, tile = self.tiles[0]
+        self.failing.add(("s1", tile_pixel(tile)))
+        results, failed = await self.fetch()
+        self.assertEqual(failed, {"s1": [tile_id]})
+        cube = merge_s1_s2(results["s1"], results["s2"])
+        self.assertEqual(len(cube), 7)
+        self.assertTrue((cube.values[:, 0, :] == 1.0).all())
+
+    async def test_sensor_failing_for_every_tile(self):
+        self.failing.update(("s1", tile_pixel(tile)) for _, tile in self.tiles)
+        results, failed = await self.fetch()
+        self.assertEqual(len(failed["s1"]), 8)
+        self.assertEqual(results["s1"], {"error": "S1 microservice call failed", "status_code": 502})
+        with self.assertRaises(RuntimeError):
+            merge_s1_s2(results["s1"], results["s2"])
+
+
+@override_settings(MODEL_INFERENCE={"SEND_IDS": True, "BATCH_SIZE": 3, "MAX_INFLIGHT": 2})
+class ModelBatchTests(SimpleTestCase):
+    def setUp(self):
+        self.requests = []
+        self.answer = None
+        self.progress = JobProgress("model", RecordingLayer(), interval=0)
+
+        async def post(name, path, content):
+            rows = json.loads(content)
+            self.requests.append(rows)
+            return httpx.Response(200, json=self.answer(rows))
+
+        patcher = mock.patch("api.pipeline.upstream.post", post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def frame(self, ids=True):
+        lon = 77.5 + np.arange(8) * 0.0001
+        df = pd.DataFrame({"lon": lon, "lat": np.full(8, 12.9), "VV_2024-01": np.arange(8, dtype=np.float64)})
+        if ids:
+            df.insert(0, "id", np.arange(8, dtype=np.int64))
+        return df
+
+    async def test_join_by_id(self):
+        # The model answers out of order; each row carries its id.
+        self.answer = lambda rows: [{"id": row["id"], "prediction": row["VV_2024-01"] % 3} for row in reversed(rows)]
+        predictions, found = await request_crop_prediction(self.frame(), self.progress)
+        self.assertEqual([len(rows) for rows in self.requests], [3, 3, 2])
+        np.testing.assert_array_equal(predictions, np.arange(8) % 3)
+        self.assertTrue(found.all())
+
+    async def test_join_by_position(self):
+        self.answer = lambda rows: [{"prediction": row["VV_2024-01"] % 3} for row in rows]
+        predictions, found = await request_crop_prediction(self.frame(ids=False), self.progress)
+        self.assertNotIn("id", self.requests[0][0])
+        np.testing.assert_array_equal(predictions, np.arange(8) % 3)
+        self.assertTrue(found.all())
+
+    async def test_join_by_coordinates_when_rows_are_missing(self):
+        # Shorter answers cannot be joined by position; the row for pixel 4 is dropped.
+        self.answer = lambda rows: [
+            {"lon": row["lon"], "lat": row["lat"], "prediction": 1} for row in rows if row["VV_2024-01"] != 4]
+        predictions, found = await request_crop_prediction(self.frame(ids=False), self.progress)
+        np.testing.assert_array_equal(found, np.arange(8) != 4)
+        np.testing.assert_array_equal(predictions, (np.arange(8) != 4).astype(np.int64))
+
+    async def test_model_failure_is_an_error_result(self):
+        async def post(name, path, content):
+            return httpx.Response(400)
+
+        with mock.patch("api.pipeline.upstream.post", post):
+            result = await request_crop_prediction(self.frame(), self.progress)
+        self.assertEqual(result, {"error": "upstream returned HTTP 400"})
+
+
+class PixelJoinTests(SimpleTestCase):
+    def test_match_by_coordinates(self):
+        s1 = PixelIndex(["77.5,12.9", "77.5001,12.9", "-0.1,-33.25"])
+        s2 = PixelIndex(["-0.100000,-33.250000", "77.50010,12.90000", "77.6,12.9"])
+        np.testing.assert_array_equal(s1.match(s2), [2, 1, -1])
+        np.testing.assert_array_equal(s2.match(s1), [-1, 1, 0])
+        np.testing.assert_array_equal(PixelIndex().match(s2), [-1, -1, -1])
+
+    def test_merge_joins_differently_formatted_keys(self):
+        s1 = ExtractionBlock.from_dict({"77.5,12.9": {"2024-01": {f: 1.0 for f in S1_FEATURES}}}, S1_FEATURES)
+        s2 = ExtractionBlock.from_dict({"77.50000,12.90000": {"2024-01": {f: 2.0 for f in S2_FEATURES}}}, S2_FEATURES)
+        cube = merge_s1_s2(s1, s2)
+        self.assertTrue((cube.values[0, 0, len(S1_FEATURES):] == 2.0).all())
+
+
+@override_settings(RESULTS={**settings.RESULTS, "CHUNK_SIZE": 4})
+class ResultsPagingTests(SimpleTestCase):
+    def setUp(self):
+        # Ten S1 pixels, each with January and February; the February rows come from a later tile.
+        self.s1 = ExtractionBlock(S1_FEATURES)
+        for month in ("2024-01", "2024-02"):
+            for i in range(10):
+                self.s1.add(f"77.{i},12.9", {month: {f: float(i) for f in S1_FEATURES}})
+        self.s2 = {"error": "S2 microservice call failed", "status_code": 503}
+
+        async def job(*args):
+            return {"output": "done", "results": {"s1": self.s1, "s2": self.s2}}
+
+        patcher = mock.patch("api.views.run_pipeline", job)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def run_job(self, job_id):
+        runner = get_job_runner()
+        try:
+            response = await self.async_client.post("/api/jobs/", submission(job_id), content_type="application/json")
+            self.assertEqual(response.status_code, 202)
+            while (await runner.store.get(job_id))["status"] != SUCCEEDED:
+                await asyncio.sleep(0.01)
+        finally:
+            await stop(runner)
+        return runner.store
+
+    async def page(self, job_id, **params):
+        response = await self.async_client.get(f"/api/jobs/{job_id}/results/", params)
+        return response.status_code, json.loads(response.content)
+
+    async def test_pages_read_only_their_chunks(self):
+        store = await self.run_job("results-pages")
+        kinds = []
+        get_result = store.get_result
+
+        async def recording_get_result(job_id, kind="result"):
+            kinds.append(kind)
+            return await get_result(job_id, kind)
+
+        with mock.patch.object(store, "get_result", recording_get_result):
+            status, page = await self.page("results-pages", offset=3, limit=4)
+        self.assertEqual(status, 200)
+        self.assertEqual(kinds, ["results", "results:s1:0", "results:s1:1"])
+        self.assertEqual((page["total"], page["nextOffset"]), (10, 7))
+        self.assertEqual(page["results"], self.s1.to_dict(3, 7))
+        self.assertEqual(list(page["results"]), [f"77.{i},12.9" for i in range(3, 7)])
+
+        status, page = await self.page("results-pages", offset=8, limit=5)
+        self.assertEqual((page["total"], page["nextOffset"]), (10, None))
+        self.assertEqual(page["results"], self.s1.to_dict(8, 10))
+        status, page = await self.page("results-pages", offset=10, limit=5)
+        self.assertEqual((status, page["results"]), (200, {}))
+
+    async def test_failed_sensor_and_invalid_pages(self):
+        await self.run_job("results-errors")
+        status, page = await self.page("results-errors", source="s2")
+        self.assertEqual((status, page["total"], page["results"]), (200, 0, self.s2))
+        self.assertEqual((await self.page("results-errors", limit=0))[0], 400)
+        self.assertEqual((await self.page("results-errors", offset=-1))[0], 400)
+        self.assertEqual((await self.page("results-missing"))[0], 404)
+
+    async def test_echo_joins_the_chunks(self):
+        await self.run_job("results-echo")
+        raw = await stored_results("results-echo")
+        self.assertEqual(raw["s1"].to_dict(), self.s1.to_dict())
+        self.assertEqual(raw["s2"], self.s2)
+
+
+def collection(*geometries):
+    return {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "id": f"field-{i}", "properties": {}, "geometry": geometry} for i, geometry in enumerate(geometries)
+    ]}
+
+
+class BatchTests(SimpleTestCase):
+    async def test_malformed_geometry_is_rejected(self):
+        malformed = [
+            {"type": "Polygon", "coordinates": []},
+            {"type": "Polygon", "coordinates": [[[1, 2], [3]]]},
+            {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1], [0, 0]]]},
+            {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 1]]]},
+            {"type": "Polygon", "coordinates": [[[0, 0], [1, 0], ["1", 1], [0, 0]]]},
+            {"type": "Polygon", "coordinates": 5},
+            {"type": "Polygon"},
+            {"type": "MultiPolygon", "coordinates": [[[[0, 0], [1, 0], [0, 0]]]]},
+            {"type": "MultiPolygon", "coordinates": 5},
+        ]
+        for geometry in malformed:
+            body = {**json.loads(submission("batch-malformed")), "geojson": collection(box(0, 0, 1, 1), geometry)}
+            response = await self.async_client.post("/api/batch/jobs/", json.dumps(body), content_type="application/json")
+            self.assertEqual(response.status_code, 400, geometry)
+            self.assertTrue(json.loads(response.content)["detail"].startswith("Feature 1 "), geometry)
+
+    def test_aois(self):
+        aoi_list = aois(collection(box(0, 0, 1, 1), {"type": "Polygon", "coordinates": [[[2, 2, 5], [3, 2, 5], [3, 3, 5], [2, 2, 5]]]}))
+        self.assertEqual([aoi["id"] for aoi in aoi_list], ["field-0", "field-1"])
+        self.assertEqual(aoi_list[1]["bounds"], (2, 2, 3, 3))
+        with self.assertRaises(ValueError):
+            aois({"type": "FeatureCollection", "features": {"type": "Feature"}})
+
+    def test_split_output_gives_each_aoi_its_own_pixels(self):
+        aoi_list = aois(collection(box(0, 0, 1, 1), box(2, 0, 3, 1)))
+        coords = np.array([[2.5, 0.5], [0.2, 0.2], [3.01, 0.5], [0.8, 0.8], [2.2, 0.1]])
+        output = {"map": PredictionMap(coords, np.array([1, 0, 1, 1, 0])), "metrics": {"pixels": 5}}
+        split = split_output(output, aoi_list)
+        # AOI 0 has pixels 1 and 3; AOI 1 has 0, 4 and the edge pixel 2 just outside it.
+        self.assertEqual(split["map"].coords.tolist(), coords[[1, 3, 0, 2, 4]].tolist())
+        self.assertEqual(split["map"].predictions.tolist(), [0, 1, 1, 1, 0])
+        self.assertEqual(split["metrics"]["edgePixels"], 1)
+        self.assertEqual(split["metrics"]["aois"], [
+            {"id": "field-0", "offset": 0, "pixels": 2, "ragiCoverage": 50.0, "nonRagiCoverage": 50.0},
+            {"id": "field-1", "offset": 2, "pixels": 3, "ragiCoverage": 66.67, "nonRagiCoverage": 33.33},
+        ])
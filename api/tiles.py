@@ -0,0 +1,221 @@
+# tiles.py
+# Mapbox Vector Tiles for finished prediction maps. Pixels are projected to Web Mercator
+# once per job and sorted by Morton code, so every tile z <= INDEX_ZOOM is a contiguous
+# slice of the index. At DETAIL_ZOOM and above a tile holds the pixels as points; below it
+# they are aggregated into square cells carrying the ragi fraction and pixel count.
+import math
+
+import numpy as np
+from django.conf import settings
+
+from api import metrics
+from api.cache import LRUCache
+
+INDEX_ZOOM = 24
+EXTENT = 4096
+LAYER = "predictions"
+MAX_LATITUDE = 85.0511287798
+
+tiles_served = metrics.counter("vector_tiles_total", "Vector tiles served", ("cache",))
+tile_cache_evictions = metrics.counter(
+    "vector_tile_cache_evictions_total", "Entries evicted from the vector tile caches", ("cache", "reason"))
+tile_cache_bytes = metrics.gauge("vector_tile_cache_bytes", "Approximate size of the vector tile caches", ("cache",))
+
+
+def _spread(values):
+    # Interleave zeros between the low 32 bits: abcd -> 0a0b0c0d.
+    values = values & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton(x, y):
+    return _spread(np.asarray(x, dtype=np.uint64)) | (_spread(np.asarray(y, dtype=np.uint64)) << np.uint64(1))
+
+
+def mercator(coords):
+    # lon/lat degrees to Web Mercator in world units: x and y in [0, 1), y pointing south.
+    lat = np.radians(np.clip(coords[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+    x = (coords[:, 0] + 180.0) / 360.0
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0
+    return np.clip(x, 0.0, np.nextafter(1.0, 0.0)), np.clip(y, 0.0, np.nextafter(1.0, 0.0))
+
+
+class TileIndex:
+    def __init__(self, prediction_map):
+        x, y = mercator(prediction_map.coords)
+        scale = 2 ** INDEX_ZOOM
+        codes = morton((x * scale).astype(np.uint64), (y * scale).astype(np.uint64))
+        order = np.argsort(codes, kind="stable")
+        self.codes = codes[order]
+        self.x = x[order]
+        self.y = y[order]
+        self.predictions = prediction_map.predictions[order]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.x.nbytes + self.y.nbytes + self.predictions.nbytes
+
+    def query(self, z, x, y):
+        shift = np.uint64(2 * (INDEX_ZOOM - z))
+        prefix = int(morton(x, y))
+        start, end = np.searchsorted(self.codes, [np.uint64(prefix) << shift, np.uint64(prefix + 1) << shift])
+        return slice(start, end)
+
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+
+def _varints(values):
+    # Protobuf varint encoding of a whole array at once.
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b""
+    sizes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        sizes += values >= np.uint64(1 << (7 * k))
+    owner = np.repeat(np.arange(len(values)), sizes)
+    position = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    out = ((values[owner] >> (7 * position).astype(np.uint64)) & np.uint64(0x7F)).astype(np.uint8)
+    out[position < sizes[owner] - 1] |= 0x80
+    return out.tobytes()
+
+
+def _varint(value):
+    return _varints([value])
+
+
+def _field(number, wire_type, payload):
+    key = _varint((number << 3) | wire_type)
+    if wire_type == 2:
+        return key + _varint(len(payload)) + payload
+    return key + payload
+
+
+def _command(command, count):
+    return (count << 3) | command
+
+
+def _point_geometry(px, py):
+    # One MoveTo with a zigzag-encoded delta per point.
+    deltas = np.empty(2 * len(px), dtype=np.int64)
+    deltas[0::2] = np.diff(px, prepend=0)
+    deltas[1::2] = np.diff(py, prepend=0)
+    return _varint(_command(1, len(px))) + _varints(_zigzag(deltas))
+
+
+def _cell_geometry(cx, cy, size):
+    # Square ring per cell, clockwise in tile space (an exterior ring): one row of
+    # commands per cell, since every feature's cursor starts at (0, 0).
+    parts = np.empty((len(cx), 11), dtype=np.int64)
+    parts[:, 0] = _command(1, 1)
+    parts[:, 1] = _zigzag(cx * size)
+    parts[:, 2] = _zigzag(cy * size)
+    parts[:, 3] = _command(2, 3)
+    parts[:, 4:10] = _zigzag(np.array([size, 0, 0, size, -size, 0], dtype=np.int64))
+    parts[:, 10] = _command(7, 1)
+    return parts
+
+
+class _Layer:
+    def __init__(self, name):
+        self.name = name
+        self.keys = {}
+        self.values = {}
+        self.features = []
+
+    def _tag(self, key, value):
+        k = self.keys.setdefault(key, len(self.keys))
+        # Keyed with the type so that 1 and 1.0 stay distinct values.
+        v = self.values.setdefault((type(value), value), len(self.values))
+        return [k, v]
+
+    def add(self, geometry_type, geometry, properties):
+        tags = [index for key, value in properties.items() for index in self._tag(key, value)]
+        self.features.append(
+            _field(2, 2, _varints(tags)) + _field(3, 0, _varint(geometry_type)) + _field(4, 2, geometry)
+        )
+
+    def encode(self):
+        parts = [_field(15, 0, _varint(2)), _field(1, 2, self.name.encode("utf-8"))]
+        parts += [_field(2, 2, feature) for feature in self.features]
+        parts += [_field(3, 2, key.encode("utf-8")) for key in self.keys]
+        for kind, value in self.values:
+            if kind is float:
+                parts.append(_field(4, 2, _field(3, 1, np.float64(value).astype("<f8").tobytes())))
+            else:
+                parts.append(_field(4, 2, _field(5, 0, _varint(value))))
+        parts.append(_field(5, 0, _varint(EXTENT)))
+        return _field(3, 2, b"".join(parts))
+
+
+def encode_tile(index, z, x, y):
+    # Returns the encoded tile, or b"" when no pixel falls inside it.
+    conf = settings.TILES
+    selected = index.query(z, x, y)
+    if selected.start == selected.stop:
+        return b""
+    scale = 2 ** z
+    px = np.floor((index.x[selected] * scale - x) * EXTENT).astype(np.int64)
+    py = np.floor((index.y[selected] * scale - y) * EXTENT).astype(np.int64)
+    predictions = index.predictions[selected]
+    layer = _Layer(LAYER)
+
+    if z >= conf["DETAIL_ZOOM"]:
+        # One MultiPoint feature per predicted class.
+        for value in np.unique(predictions).tolist():
+            mask = predictions == value
+            layer.add(1, _point_geometry(px[mask], py[mask]), {"prediction": int(value)})
+        return layer.encode()
+
+    cells = conf["AGGREGATE_CELLS"]
+    size = EXTENT // cells
+    cell = (py // size) * cells + px // size
+    counts = np.bincount(cell, minlength=cells * cells)
+    ragi = np.bincount(cell, weights=predictions == 1, minlength=cells * cells)
+    occupied = np.flatnonzero(counts)
+    geometry = _cell_geometry(occupied % cells, occupied // cells, size)
+    for n, c in enumerate(occupied.tolist()):
+        properties = {"ragiFraction": round(float(ragi[c] / counts[c]), 3), "count": int(counts[c])}
+        layer.add(3, _varints(geometry[n]), properties)
+    return layer.encode()
+
+
+_indexes = None
+_tiles = None
+
+
+def _caches():
+    global _indexes, _tiles
+    if _indexes is None:
+        conf = settings.TILES
+        _indexes = LRUCache(conf["INDEX_CACHE_BYTES"], conf["CACHE_TTL"], tile_cache_evictions, tile_cache_bytes, cache="index")
+        _tiles = LRUCache(conf["TILE_CACHE_BYTES"], conf["CACHE_TTL"], tile_cache_evictions, tile_cache_bytes, cache="tile")
+    return _indexes, _tiles
+
+
+# The caches are keyed by run, e.g. (job_id, finishedAt), since a job id can be reused once
+# its job has expired.
+def cached_tile(run, z, x, y):
+    tile = _caches()[1].get((run, z, x, y))
+    tiles_served.inc(cache="hit" if tile is not None else "miss")
+    return tile
+
+
+def cached_index(run):
+    return _caches()[0].get(run)
+
+
+def build_index(run, prediction_map):
+    index = TileIndex(prediction_map)
+    _caches()[0].set(run, index, index.nbytes)
+    return index
+
+
+def render_tile(run, index, z, x, y):
+    tile = encode_tile(index, z, x, y)
+    _caches()[1].set((run, z, x, y), tile, len(tile) + 100)
+    return tile
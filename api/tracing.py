@@ -0,0 +1,159 @@
+# tracing.py
+# Per-job trace of the indices pipeline: W3C trace context for the upstream calls, stage
+# timings, pixel counts and peak memory as Prometheus histograms, and the stage weights
+# that progress percentages are derived from.
+import contextvars
+import os
+import re
+import secrets
+import time
+from contextlib import contextmanager
+
+from api import metrics
+
+# Progress runs from PROGRESS_START to 100%; each stage gets a share proportional to its
+# weight: the median of its recent durations once every stage of the run has WEIGHT_SAMPLES
+# of them, DEFAULT_WEIGHTS until then.
+PROGRESS_START = 10
+DEFAULT_WEIGHTS = {"extract": 30, "merge": 10, "features": 15, "inference": 25, "output": 10}
+WEIGHT_SAMPLES = 5
+PREDICTION_STAGES = ("extract", "merge", "features", "inference", "output")
+EXTRACTION_STAGES = ("extract", "merge", "output")
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+stage_seconds = metrics.histogram("pipeline_stage_seconds", "Duration of pipeline stages", ("stage",))
+job_seconds = metrics.histogram("pipeline_job_seconds", "Duration of whole pipeline runs", ("outcome",))
+job_pixels = metrics.histogram("pipeline_pixels", "Pixels per pipeline run", buckets=SIZE_BUCKETS)
+job_peak_rss = metrics.histogram(
+    "pipeline_peak_rss_bytes", "Peak process RSS sampled at stage boundaries during a run", buckets=SIZE_BUCKETS)
+
+_current = contextvars.ContextVar("trace", default=None)
+
+try:
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def current_rss():
+    # Resident set size of the process in bytes (Linux; 0 elsewhere). Shared by all jobs
+    # running in the process.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class Trace:
+    def __init__(self, trace_id=None, flags="01"):
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.flags = flags
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.pixels = 0
+        self.peak_rss = current_rss()
+        self.upstream_bytes = {}
+        self.plan = None
+
+    @classmethod
+    def from_header(cls, header):
+        # Continues the caller's trace if it sent a valid traceparent header.
+        match = TRACEPARENT_RE.match((header or "").strip().lower())
+        if match is None or match.group(1) == "0" * 32:
+            return cls()
+        return cls(match.group(1), match.group(3))
+
+    def traceparent(self):
+        # A new span id for every outgoing call.
+        return f"00-{self.trace_id}-{secrets.token_hex(8)}-{self.flags}"
+
+    def sample_memory(self):
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    def add_bytes(self, name, direction, size):
+        key = f"{name}.{direction}"
+        self.upstream_bytes[key] = self.upstream_bytes.get(key, 0) + size
+
+    def start(self, stages):
+        # Fixes the progress range of each stage for this run, so percentages only go up.
+        self.plan = plan_stages(stage_weights(stages))
+
+    def summary(self):
+        return {
+            "traceId": self.trace_id,
+            "seconds": round(time.perf_counter() - self.started, 3),
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "pixels": self.pixels,
+            "peakRssBytes": self.peak_rss,
+            "upstreamBytes": self.upstream_bytes,
+        }
+
+
+def stage_weights(stages):
+    measured = {name: stage_seconds.quantile(0.5, stage=name) for name in stages}
+    if all(stage_seconds.count(stage=name) >= WEIGHT_SAMPLES for name in stages):
+        # Every stage keeps at least 1% of the range so its updates still move the bar.
+        total = sum(measured.values()) or 1.0
+        return {name: max(seconds / total, 0.01) for name, seconds in measured.items()}
+    return {name: DEFAULT_WEIGHTS[name] for name in stages}
+
+
+def plan_stages(weights):
+    # {stage: (start, end)} percentages, in the order of `weights`.
+    total = sum(weights.values())
+    plan, position = {}, 0
+    for name, weight in weights.items():
+        start = PROGRESS_START + (100 - PROGRESS_START) * position / total
+        position += weight
+        plan[name] = (start, PROGRESS_START + (100 - PROGRESS_START) * position / total)
+    return plan
+
+
+DEFAULT_PLAN = plan_stages({name: DEFAULT_WEIGHTS[name] for name in PREDICTION_STAGES})
+
+
+def progress(stage, fraction=1.0):
+    # Percentage at `fraction` of `stage` in the active trace's plan (the default plan
+    # outside a pipeline run), as an int for the progress messages.
+    trace = _current.get()
+    plan = trace.plan if trace is not None and trace.plan is not None else DEFAULT_PLAN
+    start, end = plan[stage]
+    return int(round(start + (end - start) * min(max(fraction, 0.0), 1.0)))
+
+
+def current_trace():
+    return _current.get()
+
+
+def activate(trace):
+    # Tasks created afterwards in this context (tiles, batches, shared work) see the trace.
+    return _current.set(trace)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+def headers():
+    trace = _current.get()
+    return {"traceparent": trace.traceparent()} if trace is not None else {}
+
+
+@contextmanager
+def stage(name):
+    # Times a pipeline stage; failed or cancelled stages are not recorded, so they do not
+    # skew the progress weights.
+    start = time.perf_counter()
+    yield
+    record_stage(name, time.perf_counter() - start)
+
+
+def record_stage(name, seconds):
+    stage_seconds.observe(seconds, stage=name)
+    trace = _current.get()
+    if trace is not None:
+        trace.stages[name] = trace.stages.get(name, 0.0) + seconds
+        trace.sample_memory()
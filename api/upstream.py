@@ -0,0 +1,121 @@
+# upstream.py
+# One long-lived, pooled httpx.AsyncClient per upstream microservice and process.
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from django.conf import settings
+
+from api import metrics, tracing
+
+upstream_requests = metrics.counter(
+    "upstream_requests_total", "Requests sent to upstream microservices", ("upstream", "status"))
+upstream_connections = metrics.counter(
+    "upstream_connections_opened_total", "New TCP connections opened to upstream microservices", ("upstream",))
+upstream_latency = metrics.histogram(
+    "upstream_request_seconds", "Upstream request latency until the response body is read", ("upstream",))
+upstream_bytes = metrics.histogram(
+    "upstream_payload_bytes", "Request and response body sizes of upstream calls", ("upstream", "direction"),
+    buckets=tracing.SIZE_BUCKETS)
+
+_clients = {}
+
+
+def _build_client(name):
+    conf = settings.UPSTREAMS[name]
+    http2 = conf.get("HTTP2", False)
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print(f"HTTP/2 requested for upstream '{name}' but the h2 package is not installed; using HTTP/1.1")
+            http2 = False
+
+    return httpx.AsyncClient(
+        base_url=conf["BASE_URL"],
+        http2=http2,
+        timeout=httpx.Timeout(conf.get("TIMEOUT", 60), connect=conf.get("CONNECT_TIMEOUT", 10)),
+        limits=httpx.Limits(
+            max_connections=conf.get("MAX_CONNECTIONS", 20),
+            max_keepalive_connections=conf.get("MAX_KEEPALIVE_CONNECTIONS", 10),
+            keepalive_expiry=conf.get("KEEPALIVE_EXPIRY", 30),
+        ),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+def get_client(name):
+    # Connections are bound to the event loop that opened them, so a client is only
+    # reused on the loop it was created on (uvicorn runs a single loop per process).
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(name)
+    if entry is None or entry[1] is not loop or entry[0].is_closed:
+        entry = _clients[name] = (_build_client(name), loop)
+    return entry[0]
+
+
+async def aclose_clients():
+    loop = asyncio.get_running_loop()
+    entries = list(_clients.values())
+    _clients.clear()
+    for client, client_loop in entries:
+        if client_loop is loop:
+            await client.aclose()
+
+
+def _connection_trace(name):
+    async def trace(event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            upstream_connections.inc(upstream=name)
+    return trace
+
+
+def _traced(kwargs):
+    # Adds the job's traceparent header, if a trace is active (api/tracing.py).
+    headers = tracing.headers()
+    if headers:
+        kwargs["headers"] = {**kwargs.get("headers", {}), **headers}
+    return kwargs
+
+
+def _record_sizes(name, response):
+    sent = int(response.request.headers.get("Content-Length", 0))
+    received = response.num_bytes_downloaded
+    upstream_bytes.observe(sent, upstream=name, direction="sent")
+    upstream_bytes.observe(received, upstream=name, direction="received")
+    trace = tracing.current_trace()
+    if trace is not None:
+        trace.add_bytes(name, "sent", sent)
+        trace.add_bytes(name, "received", received)
+
+
+async def post(name, path, **kwargs):
+    client = get_client(name)
+    start = time.perf_counter()
+    status = "error"
+    try:
+        response = await client.post(path, extensions={"trace": _connection_trace(name)}, **_traced(kwargs))
+        status = str(response.status_code)
+        _record_sizes(name, response)
+        return response
+    finally:
+        upstream_requests.inc(upstream=name, status=status)
+        upstream_latency.observe(time.perf_counter() - start, upstream=name)
+
+
+@asynccontextmanager
+async def stream(name, path, **kwargs):
+    # Like post(), but the body is left for the caller to read incrementally
+    # (response.aiter_bytes()); latency covers the time until the body was consumed.
+    client = get_client(name)
+    start = time.perf_counter()
+    status = "error"
+    try:
+        async with client.stream("POST", path, extensions={"trace": _connection_trace(name)}, **_traced(kwargs)) as response:
+            status = str(response.status_code)
+            yield response
+            _record_sizes(name, response)
+    finally:
+        upstream_requests.inc(upstream=name, status=status)
+        upstream_latency.observe(time.perf_counter() - start, upstream=name)
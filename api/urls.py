@@ -5,5 +5,14 @@ urlpatterns = [
   path("", views.home_view, name="home"),
   path("test/", views.test_view, name="test"),
   path("fetch-indices/", views.fetch_s2_and_s1_indices, name="fetch-indices"),
-  path("mock-results/", views.generate_mock_results, name="mock-results")
+  path("mock-results/", views.generate_mock_results, name="mock-results"),
+  path("batch/", views.fetch_batch, name="batch"),
+  path("batch/jobs/", views.submit_batch, name="batch-submit"),
+  path("jobs/", views.submit_job, name="job-submit"),
+  path("jobs/<str:job_id>/", views.job_status, name="job-status"),
+  path("jobs/<str:job_id>/cancel/", views.cancel_job, name="job-cancel"),
+  path("jobs/<str:job_id>/result/", views.job_result, name="job-result"),
+  path("jobs/<str:job_id>/results/", views.job_results, name="job-results"),
+  path("jobs/<str:job_id>/tiles/<int:z>/<int:x>/<int:y>.mvt", views.job_tile, name="job-tile"),
+  path("store/", views.store_query, name="store-query"),
 ]
@@ -0,0 +1,11 @@
+# utils.py
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+async def offload(func, *args, size=None, **kwargs):
+    # Run CPU-heavy parsing/encoding in the default executor instead of the event loop.
+    # Small payloads are cheaper to handle inline than to hand over to a thread.
+    if size is not None and size < settings.ASYNC_OFFLOAD_BYTES:
+        return func(*args, **kwargs)
+    return await sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
@@ -1,12 +1,60 @@
 import json
 import asyncio
-import httpx
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
-from asgiref.sync import async_to_sync
-from datetime import datetime, timedelta
-from channels.layers import get_channel_layer
-import pandas as pd
+from django.conf import settings
+from django.db import DatabaseError
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import patch_cache_control
+from api import metrics, store, upstream
+from api.batch import aois, run_batch
+from api.pipeline import run_pipeline
+from api.jobs import (
+    CANCELLED, FAILED, FINISHED, QUEUED, SUCCEEDED, JobExists, QueueFull, get_job_runner, get_job_store, load_results,
+    request_cancel,
+)
+from api.encoding import FastJsonResponse, accepted_encoding, compress
+from api.features import ExtractionBlock
+from api.geometry import bbox, polygons
+from api.output import GEOJSON, include_results, is_streaming, render_result, response_format, streaming_response
+from api.singleflight import SingleFlight
+from api.tiles import INDEX_ZOOM, build_index, cached_index, cached_tile, render_tile
+from api.utils import offload
+from api.progress import JobProgress, is_valid_job_id, new_job_id
+from api.tracing import Trace
+
+REQUIRED_FIELDS = ("geojson", "flag", "startDate", "endDate")
+
+tile_index_flight = SingleFlight("tile_index")
+tile_flight = SingleFlight("tile")
+
+class RequestValidationError(ValueError):
+    pass
+
+def async_csrf_exempt(view_func):
+    # django.views.decorators.csrf.csrf_exempt wraps views in a sync function on
+    # Django 4.2, which would hide the coroutine from the ASGI handler.
+    view_func.csrf_exempt = True
+    return view_func
+
+def parse_fetch_request(body):
+    req = json.loads(body.decode("utf-8"))
+    if not isinstance(req, dict):
+        raise RequestValidationError("Request body must be a JSON object")
+    missing = [field for field in REQUIRED_FIELDS if field not in req]
+    if missing:
+        raise RequestValidationError(f"Missing required fields: {', '.join(missing)}")
+    # Clients may pick the job id themselves so they can open ws/progress/<jobId> before submitting.
+    if "jobId" in req and not is_valid_job_id(req["jobId"]):
+        raise RequestValidationError("jobId must be 1-64 characters of letters, digits, '-' or '_'")
+    return req
+
+def parse_batch_request(body):
+    # A submission whose geojson is a FeatureCollection of up to BATCH["MAX_AOIS"] AOIs.
+    req = parse_fetch_request(body)
+    try:
+        aois(req["geojson"])
+    except ValueError as e:
+        raise RequestValidationError(str(e))
+    return req
 
 def home_view(request):
     return JsonResponse({"message": "Welcome to the Crop Mapping API!"})
@@ -14,257 +62,298 @@ def home_view(request):
 def test_view(request):
     return JsonResponse({"message": "Test route working!"})
 
-async def send_ws_update(channel_layer, update_type, startProgress=None, endProgress=None, message=None):
-    data = {"type": update_type}
-    if endProgress is not None:
-        data["endProgress"] = endProgress
-    if startProgress is not None:
-        data["startProgress"] = startProgress
-    data["message"] = message
-    await channel_layer.group_send(
-        "satellite_progress",
-        {
-            "type": "send_notification",
-            "message": data
-        }
-    )
-
-async def fetch_s2_and_s1_indices_async(geojson_data, startDate, endDate, flag):
-    channel_layer = get_channel_layer()
-    # url_s1 = "http://localhost:4000/extract-s1-parameters"
-    # url_s2 = "http://localhost:4000/extract-s2-parameters"
-    # url_s1 = "http://host.docker.internal:4000/extract-s1-parameters"
-    # url_s2 = "http://host.docker.internal:4000/extract-s2-parameters"
-    url_s1 = "https://gee.agroscope.site/extract-s1-parameters"
-    url_s2 = "https://gee.agroscope.site/extract-s2-parameters"
+def metrics_view(request):
+    return HttpResponse(metrics.render_prometheus(), content_type="text/plain; version=0.0.4")
 
+async def read_fetch_request(request, parse):
+    # Returns (req, job_id), or (None, error_response) when the body is not a valid submission.
     try:
-        # Step 1: Fetching Sentinel-1 and Sentinel-2 Data (10–50% handled earlier)
-        await send_ws_update(channel_layer, "progress", startProgress=10, endProgress=10, message="Initiating Data Fetch...")
-        results = {}
-        lock = asyncio.Lock()
-
-        async def fetch_and_update(source, url):
-            async with httpx.AsyncClient(timeout=60) as client:
-                payload = {"geojson": geojson_data, "start_date": startDate, "end_date": endDate}
-                response = await client.post(url, json=payload, headers={"Content-Type": "application/json"})
-
-            async with lock:
-                results[source] = response
-                total_received = len(results)
-                sensor_name = "Sentinel-1" if source.upper() == "S1" else "Sentinel-2"
-
-                if total_received == 1:
-                    await send_ws_update(channel_layer, "progress", startProgress=10, endProgress=25, message=f"{sensor_name} Data Retrieved. Awaiting other data...")
-                elif total_received == 2:
-                    await send_ws_update(channel_layer, "progress", startProgress=25, endProgress=40, message="All Satellite Data Retrieved. Merging data...")
-
-        await asyncio.gather(fetch_and_update("s1", url_s1), fetch_and_update("s2", url_s2))
-
-        # Step 2: Combining Sentinel-1 and Sentinel-2
-        result = {
-            source: response.json() if response.status_code == 200 else
-                   {"error": f"{source.upper()} microservice call failed", "status_code": response.status_code}
-            for source, response in results.items()
-        }
-
-        s1_vals = result.get('s1', {})
-        s2_vals = result.get('s2', {})
-
-        s2_default = {"NDVI": 0, "EVI": 0, "GNDVI": 0, "SAVI": 0, "NDWI": 0, "NDMI": 0, "RENDVI": 0}
-
-        combined_input = {}
-
-        for key in s1_vals:
-            s1_monthly = s1_vals.get(key, {})
-            s2_monthly = s2_vals.get(key, {})
-
-            monthly_combined = {}
-
-            for month in s1_monthly.keys():
-                s1_features = s1_monthly.get(month, {})
-                s2_features = s2_monthly.get(month, s2_default)
-
-                merged_features = {
-                    "VV": s1_features.get("VV", 0),
-                    "VH": s1_features.get("VH", 0),
-                    "VH_VV": s1_features.get("VH_VV", 0),
-                }
-
-                for k in s2_default:
-                    merged_features[k] = s2_features.get(k, 0)
-
-                monthly_combined[month] = merged_features
-
-            combined_input[key] = monthly_combined
-
-        await send_ws_update(channel_layer, "progress", startProgress=40, endProgress=50, message="Sentinel-1 and Sentinel-2 data Merged")
-        
-        if not flag:
-            await send_ws_update(channel_layer, "progress", startProgress=50, endProgress=70, message="Extracting coordinates and features...")
-            coordinates = list(combined_input.keys())
-            
-            await send_ws_update(channel_layer, "progress", startProgress=70, endProgress=90, message="Building GeoJSON features...")
-            features = []
-            for idx, key in enumerate(coordinates):
-                coord = key.split(',')
-                features.append({
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "geodesic": False,
-                        "coordinates": [float(coord[0]), float(coord[1])]
-                    },
-                    "properties": {
-                        "prediction": 0
-                    }
-                })
-
-            await send_ws_update(channel_layer, "progress", startProgress=90, endProgress=100, message="Finalizing prediction output...")
-            output = {
-                "map": {
-                    "type": "FeatureCollection",
-                    "features": features,
-                },
-                "metrics": {
-                    "ragiCoverage": 0,
-                    "nonRagiCoverage": 100,
-                }
-            }
-            return {"results": result, "output": output}
-
-        else:
-            # Step 3: Generate time series DataFrame (50–65%)
-            await send_ws_update(channel_layer, "progress", startProgress=50, endProgress=65, message="Generating Time Series...")
-            
-            rows = []
-            all_features = ["VV", "VH", "VH_VV", "NDVI", "EVI", "GNDVI", "SAVI", "NDWI", "NDMI", "RENDVI"]
-
-            for key, month_data in combined_input.items():
-                lon, lat = map(float, key.split(","))
-                row = {"lon": lon, "lat": lat}
-
-                for month, features in month_data.items():
-                    for feat in all_features:
-                        col_name = f"{feat}_{month}"
-                        row[col_name] = features.get(feat, 0)
-                rows.append(row)
-
-            df = pd.DataFrame(rows)
-            await send_ws_update(channel_layer, "progress", startProgress=65, endProgress=90, message="Time series data prepared. Running Deep Learning Model...")
-
-            # Step 4: Run deep learning model (65–90%)
-            output_data = await get_crop_prediction(df)
-            await send_ws_update(channel_layer, "progress", startProgress=90, endProgress=98, message="Model predictions obtained. Generating features and metrics...")
-
-            # Step 5: Generate features and calculate metrics (90–98%)
-            output_lookup = {f"{item['lon']},{item['lat']}": item["prediction"] for item in output_data}
-            coordinates = list(combined_input.keys())
-            features = []
-            ragi_count = 0
-            non_ragi_count = 0
-
-            for key in coordinates:
-                lon, lat = map(float, key.split(','))
-                
-                prediction = output_lookup.get(key, 0)
-                if key not in output_lookup:
-                    print(f"Warning: No matching prediction found for coordinates ({lon}, {lat})")
-                
-                if prediction == 1:
-                    ragi_count += 1
-                else:
-                    non_ragi_count += 1
-                
-                features.append({
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "geodesic": False,
-                        "coordinates": [lon, lat]
-                    },
-                    "properties": {
-                        "prediction": prediction
-                    }
-                })
-
-            total_predictions = ragi_count + non_ragi_count
-            ragi_coverage = (ragi_count / total_predictions * 100) if total_predictions > 0 else 0
-            non_ragi_coverage = (non_ragi_count / total_predictions * 100) if total_predictions > 0 else 0
-
-            # Step 6: Assemble final output (98–100%)
-            output = {
-                "map": {
-                    "type": "FeatureCollection",
-                    "features": features,
-                },
-                "metrics": {
-                    "ragiCoverage": round(ragi_coverage, 2),
-                    "nonRagiCoverage": round(non_ragi_coverage, 2),
-                }
-            }
-
-            await send_ws_update(channel_layer, "progress", startProgress=98, endProgress=100, message="Output generated successfully.")
-
-            return {"output": output, "results": result}
-
-    except httpx.RequestError as e:
-        print(f"Unexpected Part 1: {str(e)}")
-        await send_ws_update(channel_layer, "error", message=f"Error fetching data: {str(e)}")
-        return {"error": str(e)}
-    except Exception as e:
-        print(f"Unexpected Part 2: {str(e)}")
-        await send_ws_update(channel_layer, "error", message=f"Unexpected error: {str(e)}")
-        return {"error": str(e)}
-
-@csrf_exempt
-def fetch_s2_and_s1_indices(request):
+        body = request.body
+        req = await offload(parse, body, size=len(body))
+        job_id = req.get('jobId') or new_job_id()
+    except json.JSONDecodeError as e:
+        return None, JsonResponse({"error": "Invalid GeoJSON data", "detail": str(e)}, status=400)
+    except RequestValidationError as e:
+        return None, JsonResponse({"error": "Invalid request", "detail": str(e)}, status=400)
+    return req, job_id
+
+async def submit_pipeline_job(request, req, job_id, func):
+    # Returns (future, None), or (None, error_response) when the worker pool cannot take the job.
+    # A traceparent header from the client is continued in the calls to the microservices.
+    try:
+        future = await get_job_runner().submit(
+            job_id, func,
+            req['geojson'], req['startDate'], req['endDate'], req['flag'], JobProgress(job_id),
+            Trace.from_header(request.headers.get("traceparent")),
+        )
+    except QueueFull as e:
+        return None, JsonResponse({"error": "Too many jobs in progress, retry later", "detail": str(e)}, status=429)
+    except JobExists as e:
+        return None, JsonResponse({"error": "Job already submitted", "detail": str(e)}, status=409)
+    return future, None
+
+@async_csrf_exempt
+async def fetch_s2_and_s1_indices(request):
+    return await run_submission(request, parse_fetch_request, run_pipeline)
+
+@async_csrf_exempt
+async def submit_job(request):
+    return await queue_submission(request, parse_fetch_request, run_pipeline)
+
+@async_csrf_exempt
+async def fetch_batch(request):
+    return await run_submission(request, parse_batch_request, run_batch)
+
+@async_csrf_exempt
+async def submit_batch(request):
+    return await queue_submission(request, parse_batch_request, run_batch)
+
+async def run_submission(request, parse, func):
+    # Runs the job and answers with its result, e.g. func=run_pipeline for one AOI.
     if request.method != "POST":
         return JsonResponse({"message": "Send a POST request with GeoJSON"}, status=405)
 
-    try:
-        req = json.loads(request.body.decode("utf-8"))
-        geojson_data = req['geojson']
-        flag = req['flag']
-        startDate = req['startDate']
-        endDate = req['endDate']
-
-    except json.JSONDecodeError as e:
-        return JsonResponse({"error": "Invalid GeoJSON data", "detail": str(e)}, status=400)
+    req, job_id = await read_fetch_request(request, parse)
+    if req is None:
+        return job_id
 
     try:
-        results = async_to_sync(fetch_s2_and_s1_indices_async)(geojson_data, startDate, endDate, flag)
-        return JsonResponse(results)
+        future, error = await submit_pipeline_job(request, req, job_id, func)
+        if error is not None:
+            return error
+        # The job keeps running (and its result stays in the job store) if this request goes away.
+        fmt = response_format(request)
+        if is_streaming(request, fmt):
+            return streaming_response(asyncio.shield(future), fmt, accepted_encoding(request), jobId=job_id)
+        results = await asyncio.shield(future)
+        return await offload(render_result, results, fmt, accepted_encoding(request), include_results(request), jobId=job_id)
     except Exception as e:
         print(e)
         return JsonResponse({"error": f"Unexpected error: {str(e)}"}, status=500)
 
-async def get_crop_prediction(combined_input):
-    # url = 'http://localhost:6000/crop-prediction-transformer'
-    # url = 'http://host.docker.internal:6000/crop-prediction-transformer'
-    url = 'https://model.agroscope.site/crop-prediction-transformer'
-    payload = combined_input.to_dict(orient='records')  # Convert DataFrame to list of dicts
+async def queue_submission(request, parse, func):
+    # Answers 202 with the job id at once; the result is read from /jobs/<jobId>/result/.
+    if request.method != "POST":
+        return JsonResponse({"message": "Send a POST request with GeoJSON"}, status=405)
+
+    req, job_id = await read_fetch_request(request, parse)
+    if req is None:
+        return job_id
+
+    future, error = await submit_pipeline_job(request, req, job_id, func)
+    if error is not None:
+        return error
+    return JsonResponse({"jobId": job_id, "status": QUEUED}, status=202)
 
+async def job_status(request, job_id):
+    record = await get_job_store().get(job_id)
+    if record is None:
+        return JsonResponse({"error": "Unknown or expired job", "jobId": job_id}, status=404)
+    return JsonResponse(record)
+
+@async_csrf_exempt
+async def cancel_job(request, job_id):
+    if request.method != "POST":
+        return JsonResponse({"message": "Send a POST request to cancel the job"}, status=405)
+    record = await get_job_store().get(job_id)
+    if record is None:
+        return JsonResponse({"error": "Unknown or expired job", "jobId": job_id}, status=404)
+    if record["status"] in FINISHED:
+        return JsonResponse(record, status=409)
+    await request_cancel(job_id, "endpoint")
+    return JsonResponse({"jobId": job_id, "status": "cancelling"}, status=202)
+
+async def load_job_record(job_id):
+    # Returns (record, None), or (None, error_response) unless the job succeeded.
+    record = await get_job_store().get(job_id)
+    if record is None:
+        return None, JsonResponse({"error": "Unknown or expired job", "jobId": job_id}, status=404)
+    if record["status"] in (FAILED, CANCELLED):
+        return None, JsonResponse(record, status=409)
+    if record["status"] != SUCCEEDED:
+        return None, JsonResponse(record, status=202)
+    return record, None
+
+async def load_job_result(job_id, kind="result"):
+    # Returns (result, None), or (None, error_response) unless the job succeeded and its result is still stored.
+    # kind "results" is the raw S1/S2 extraction results, stored apart from the output.
+    record, error = await load_job_record(job_id)
+    if error is not None:
+        return None, error
+    return await stored_result(job_id, kind)
+
+async def stored_result(job_id, kind="result"):
+    result = await get_job_store().get_result(job_id, kind)
+    if result is None:
+        return None, JsonResponse({"error": "Result expired", "jobId": job_id}, status=404)
+    return result, None
+
+async def job_result(request, job_id):
+    result, error = await load_job_result(job_id)
+    if error is not None:
+        return error
+    fmt = response_format(request)
+    if is_streaming(request, fmt):
+        return streaming_response(result, fmt, accepted_encoding(request), jobId=job_id)
+    echo = fmt == GEOJSON and include_results(request)
+    if echo:
+        raw = await stored_results(job_id)
+        if raw is not None:
+            result = {**result, "results": raw}
+    return await offload(render_result, result, fmt, accepted_encoding(request), echo, jobId=job_id)
+
+async def stored_results(job_id):
+    # All of a job's raw S1/S2 results, joined from their chunks; None once any has expired.
+    store = get_job_store()
+    index = await store.get_result(job_id, "results")
+    if index is None:
+        return None
+    raw = {}
+    for source, entry in index["sources"].items():
+        if "chunks" not in entry:
+            raw[source] = entry
+            continue
+        chunks = await load_results(store, job_id, source, 0, entry["chunks"])
+        if chunks is None:
+            return None
+        raw[source] = ExtractionBlock(entry["features"])
+        for chunk in chunks:
+            raw[source].update(chunk)
+    return raw
+
+def results_page(entry, chunks, first, size, source, offset, limit):
+    # `chunks` are chunks first, first + 1, ... of the source, covering the page.
+    if "chunks" not in entry:
+        # The sensor's extraction failed; its error is the whole "page".
+        return {"source": source, "offset": offset, "limit": limit, "total": 0, "nextOffset": None, "results": entry}
+    total = entry["total"]
+    results = {}
+    for n, chunk in enumerate(chunks, first):
+        start = n * size
+        results.update(chunk.to_dict(max(offset - start, 0), min(offset + limit - start, size)))
+    return {
+        "source": source,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "nextOffset": offset + limit if offset + limit < total else None,
+        "results": results,
+    }
+
+async def job_results(request, job_id):
+    # Pages through the raw S1/S2 results of a finished job, `limit` pixels at a time in
+    # the order the extraction service returned them: ?source=s1|s2&offset=0&limit=1000.
+    conf = settings.RESULTS
+    source = request.GET.get("source", "s1")
+    try:
+        offset = int(request.GET.get("offset", 0))
+        limit = int(request.GET.get("limit", conf["PAGE_SIZE"]))
+    except ValueError:
+        offset = limit = -1
+    if source not in ("s1", "s2") or offset < 0 or not 0 < limit <= conf["MAX_PAGE_SIZE"]:
+        detail = f"source must be s1 or s2, offset >= 0 and 0 < limit <= {conf['MAX_PAGE_SIZE']}"
+        return JsonResponse({"error": "Invalid request", "detail": detail, "jobId": job_id}, status=400)
+
+    index, error = await load_job_result(job_id, "results")
+    if error is not None:
+        return error
+    # Only the chunks holding pixels offset <= id < offset + limit are read.
+    entry, size = index["sources"].get(source, {}), index["chunkSize"]
+    first = offset // size
+    last = min(-(-(offset + limit) // size), entry.get("chunks", 0))
+    chunks = []
+    if first < last:
+        chunks = await load_results(get_job_store(), job_id, source, first, last)
+        if chunks is None:
+            return JsonResponse({"error": "Result expired", "jobId": job_id}, status=404)
+    page = await offload(results_page, entry, chunks, first, size, source, offset, limit)
+    response = FastJsonResponse({"jobId": job_id, **page})
+    return compress(response, accepted_encoding(request))
+
+async def job_tile(request, job_id, z, x, y):
+    if z > INDEX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        return JsonResponse({"error": "Tile out of range", "jobId": job_id}, status=400)
+
+    record, error = await load_job_record(job_id)
+    if error is not None:
+        return error
+    # A job id can be reused once its job has expired; the tiles of the earlier run must not be served.
+    run = (job_id, record.get("finishedAt"))
+    tile = cached_tile(run, z, x, y)
+    if tile is None:
+        index = cached_index(run)
+        if index is None:
+            result, error = await stored_result(job_id)
+            if error is not None:
+                return error
+            # A map view requests many tiles at once; the index is built once per run.
+            index = await tile_index_flight.do(run, offload, build_index, run, result["output"]["map"])
+        tile = await tile_flight.do((run, z, x, y), offload, render_tile, run, index, z, x, y)
+
+    response = HttpResponse(tile, content_type="application/vnd.mapbox-vector-tile", status=200 if tile else 204)
+    patch_cache_control(response, private=True, max_age=settings.TILES["CACHE_TTL"])
+    return compress(response, accepted_encoding(request))
+
+def parse_store_query(request):
+    # (bounds, polygons, startDate, endDate) from GET ?bbox=west,south,east,north or a POST body
+    # {"geojson": ...}; startDate/endDate (query or body) are optional and select one date range.
+    if request.method == "POST":
+        req = json.loads(request.body.decode("utf-8"))
+        if not isinstance(req, dict) or "geojson" not in req:
+            raise RequestValidationError("Request body must be a JSON object with a geojson field")
+        polygon_list = polygons(req["geojson"])
+        if not polygon_list:
+            raise RequestValidationError("geojson must contain a Polygon or MultiPolygon")
+        return bbox(polygon_list), polygon_list, req.get("startDate"), req.get("endDate")
+    try:
+        west, south, east, north = map(float, request.GET.get("bbox", "").split(","))
+    except ValueError:
+        raise RequestValidationError("bbox must be west,south,east,north")
+    if west > east or south > north:
+        raise RequestValidationError("bbox must be west,south,east,north")
+    return (west, south, east, north), None, request.GET.get("startDate"), request.GET.get("endDate")
+
+@async_csrf_exempt
+async def store_query(request):
+    # Stored predictions of earlier jobs inside a bbox or polygon (api/store.py), in the same
+    # formats as job results. Where stored jobs overlap, the newest prediction wins.
+    if request.method not in ("GET", "POST"):
+        return JsonResponse({"error": "Only GET and POST methods allowed"}, status=405)
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            response = await client.post(url, json=payload, headers={"Content-Type": "application/json"})
-            response.raise_for_status()
-            return response.json()  # Returns: [{lon, lat, prediction}, ...]
-    except httpx.RequestError as e:
-        print(f"Prediction microservice call failed: {e}")
-        await send_ws_update(get_channel_layer(), "error", message=f"Prediction microservice failed: {str(e)}")
-        return {"error": str(e)}
-
-@csrf_exempt
-def generate_mock_results(request):
+        bounds, polygon_list, start_date, end_date = parse_store_query(request)
+        prediction_map = await store.query_predictions(bounds, polygon_list, start_date, end_date)
+    except (json.JSONDecodeError, UnicodeDecodeError, RequestValidationError, ValueError) as e:
+        return JsonResponse({"error": "Invalid request", "detail": str(e)}, status=400)
+    except store.QueryTooLarge as e:
+        return JsonResponse({"error": "Query area too large", "detail": str(e)}, status=422)
+    except DatabaseError as e:
+        print(f"Spatial store query failed: {e}")
+        return JsonResponse({"error": "Spatial store unavailable"}, status=503)
+
+    ragi_count = int((prediction_map.predictions == 1).sum())
+    total = len(prediction_map)
+    result = {"output": {"map": prediction_map, "metrics": {
+        "pixels": total,
+        "ragiCoverage": round(ragi_count / total * 100, 2) if total else 0,
+        "nonRagiCoverage": round((total - ragi_count) / total * 100, 2) if total else 0,
+    }}}
+    fmt = response_format(request)
+    if is_streaming(request, fmt):
+        return streaming_response(result, fmt, accepted_encoding(request))
+    return await offload(render_result, result, fmt, accepted_encoding(request), False)
+
+@async_csrf_exempt
+async def generate_mock_results(request):
     if request.method == "POST":
-        geojson = json.loads(request.body.decode("utf-8"))
-        result = async_to_sync(mock_results)(geojson)
-        return JsonResponse(result)
+        body = request.body
+        try:
+            geojson = await offload(json.loads, body, size=len(body))
+        except json.JSONDecodeError as e:
+            return JsonResponse({"error": "Invalid GeoJSON data", "detail": str(e)}, status=400)
+        result = await mock_results(geojson)
+        return await offload(JsonResponse, result)
     return JsonResponse({"error": "Only POST method allowed"}, status=405)
 
 async def mock_results(geojson):
-    url = "http://localhost:4000/mock-results"
-    async with httpx.AsyncClient(timeout=60) as client:
-        response = await client.post(url, json=geojson, headers={"Content-Type": "application/json"})
-        return response.json()
\ No newline at end of file
+    response = await upstream.post("mock", "/mock-results", json=geojson)
+    return response.json()
@@ -0,0 +1,121 @@
+"""
+Concurrency benchmark for the fetch-indices view.
+
+Drives the Django ASGI application in-process with N concurrent requests against a
+slow local stand-in of the GEE microservice, once through the native async view and
+once through the previous sync view that wrapped the pipeline in async_to_sync.
+
+    python -m benchmarks.bench_async_views --concurrency 8 32 64 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crop_mapping_backend.settings")
+
+import django
+
+django.setup()
+
+import httpx
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.urls import include, path
+
+from api.output import GEOJSON, render_result
+from api.pipeline import fetch_s2_and_s1_indices_async
+from api.progress import JobProgress, new_job_id
+from benchmarks.standins import StandinUpstream, point_upstreams, serve
+
+
+def legacy_fetch_indices(request):
+    req = json.loads(request.body.decode("utf-8"))
+    results = async_to_sync(fetch_s2_and_s1_indices_async)(
+        req["geojson"], req["startDate"], req["endDate"], req["flag"], JobProgress(new_job_id())
+    )
+    return render_result(results, GEOJSON)
+
+
+legacy_fetch_indices.csrf_exempt = True
+
+urlpatterns = [
+    path("legacy/fetch-indices/", legacy_fetch_indices),
+    path("api/", include("api.urls")),
+]
+
+_requests = iter(range(1_000_000))
+
+
+def payload():
+    # Every request gets its own AOI, so no request is answered from the extraction cache or
+    # shares a pipeline run with another; the stand-in answers the same anyway.
+    shift = next(_requests) * 0.001
+    ring = [[77.5 + shift, 12.9], [77.6 + shift, 12.9], [77.6 + shift, 13.0], [77.5 + shift, 12.9]]
+    return {
+        "geojson": {"type": "Polygon", "coordinates": [ring]},
+        "startDate": "2024-01-01",
+        "endDate": "2024-03-31",
+        "flag": False,
+    }
+
+
+async def run_batch(client, url, concurrency):
+    peak_threads = threading.active_count()
+    done = asyncio.Event()
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while not done.is_set():
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample_threads())
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(client.post(url, json=payload()) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await sampler
+    failures = sum(1 for r in responses if r.status_code != 200)
+    return {"elapsed_s": round(elapsed, 3), "peak_threads": peak_threads, "failures": failures}
+
+
+async def main(args):
+    app = get_asgi_application()
+    transport = httpx.ASGITransport(app=app)
+    report = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=None) as client:
+        # Warm the upstream connection pool so both modes start from the same state.
+        await run_batch(client, "/api/fetch-indices/", max(args.concurrency))
+        for concurrency in args.concurrency:
+            for mode, url in (("async", "/api/fetch-indices/"), ("legacy", "/legacy/fetch-indices/")):
+                row = {"mode": mode, "concurrency": concurrency, **await run_batch(client, url, concurrency)}
+                row["requests_per_s"] = round(concurrency / row["elapsed_s"], 2)
+                report.append(row)
+                print(json.dumps(row))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8, 32, 64])
+    parser.add_argument("--latency", type=float, default=0.5, help="stand-in upstream latency in seconds")
+    parser.add_argument("--pixels", type=int, default=20)
+    parser.add_argument("--max-connections", type=int, default=256, help="upstream connection pool size")
+    args = parser.parse_args()
+
+    upstream = StandinUpstream(pixels=args.pixels, latency=args.latency)
+    with serve(upstream) as base_url:
+        point_upstreams(base_url)
+        settings.UPSTREAMS["gee"]["MAX_CONNECTIONS"] = args.max_connections
+        settings.UPSTREAMS["gee"]["MAX_KEEPALIVE_CONNECTIONS"] = args.max_connections
+        # Every request must wait for the stand-in, as a first submission would.
+        settings.EXTRACTION_CACHE["ENABLED"] = False
+        settings.SPATIAL_STORE["ENABLED"] = False
+        # Measure the request path, not the per-pod job limit.
+        settings.JOBS["MAX_CONCURRENT"] = settings.JOBS["MAX_QUEUED"] = max(args.concurrency)
+        settings.ROOT_URLCONF = "benchmarks.bench_async_views"
+        asyncio.run(main(args))
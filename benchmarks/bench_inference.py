@@ -0,0 +1,83 @@
+"""
+Throughput of batched model inference against a local stand-in model server.
+
+Runs get_crop_prediction's batching over a synthetic feature table for every
+combination of batch size and in-flight limit and reports pixels per second.
+
+    python -m benchmarks.bench_inference --pixels 50000 --batch-sizes 1000 5000 50000 --inflight 1 2 4 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crop_mapping_backend.settings")
+
+import django
+
+django.setup()
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from api.pipeline import request_crop_prediction
+from api.progress import JobProgress
+from benchmarks.standins import StandinUpstream, point_upstreams, serve
+
+FEATURES = ["VV", "VH", "VH_VV", "NDVI", "EVI", "GNDVI", "SAVI", "NDWI", "NDMI", "RENDVI"]
+
+
+def feature_table(pixels, months):
+    rng = np.random.default_rng(0)
+    columns = {"id": np.arange(pixels), "lon": 77.5 + (np.arange(pixels) % 1000) * 0.0001, "lat": 12.9 + (np.arange(pixels) // 1000) * 0.0001}
+    for month in range(1, months + 1):
+        for feat in FEATURES:
+            columns[f"{feat}_2024-{month:02d}"] = rng.random(pixels).astype("float32")
+    return pd.DataFrame(columns)
+
+
+async def run(df, batch_size, inflight):
+    settings.MODEL_INFERENCE["BATCH_SIZE"] = batch_size
+    settings.MODEL_INFERENCE["MAX_INFLIGHT"] = inflight
+    start = time.perf_counter()
+    predictions, found = await request_crop_prediction(df, JobProgress("bench"))
+    elapsed = time.perf_counter() - start
+    assert len(predictions) == len(df) and found.all()
+    return {
+        "batch_size": batch_size,
+        "inflight": inflight,
+        "batches": -(-len(df) // batch_size),
+        "elapsed_s": round(elapsed, 3),
+        "pixels_per_s": round(len(df) / elapsed),
+    }
+
+
+async def main(args):
+    df = feature_table(args.pixels, args.months)
+    await run(df.iloc[:100], 100, 1)  # warm the connection pool
+    report = []
+    for batch_size in args.batch_sizes:
+        for inflight in args.inflight:
+            row = await run(df, batch_size, inflight)
+            report.append(row)
+            print(json.dumps(row))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pixels", type=int, default=50000)
+    parser.add_argument("--months", type=int, default=6)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1000, 5000, 20000, 50000])
+    parser.add_argument("--inflight", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--model-latency", type=float, default=0.05, help="fixed seconds per model request")
+    parser.add_argument("--row-cost", type=float, default=0.00002, help="model seconds per pixel")
+    parser.add_argument("--model-workers", type=int, default=4, help="requests the stand-in processes at once")
+    args = parser.parse_args()
+
+    upstream = StandinUpstream(model_latency=args.model_latency, model_row_cost=args.row_cost, model_workers=args.model_workers)
+    with serve(upstream) as base_url:
+        point_upstreams(base_url)
+        asyncio.run(main(args))
@@ -0,0 +1,199 @@
+"""
+Load test of /api/fetch-indices/ with its progress sockets.
+
+Starts the stand-in upstreams and the application under uvicorn, each in its own
+process, then runs --requests jobs with --concurrency at a time. Each job opens
+ws/progress/<jobId>, posts to /api/fetch-indices/ and reads the socket until the final
+update. Reports one JSON object with request latency and time to first progress update
+(p50/p95/p99), throughput, status counts and the server's peak RSS.
+
+    python -m benchmarks.bench_load --requests 200 --concurrency 20 --pixels 2000 --flag
+    python -m benchmarks.bench_load --error-rate 0.05 --jitter 0.5 --output load.json
+    python -m benchmarks.bench_load --url http://localhost:8000   # an already running server
+
+Jobs use distinct AOIs by default so the extraction cache and request coalescing do not
+collapse them; --identical sends the same AOI every time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+import httpx
+import websockets
+
+from benchmarks.report import environment, percentiles, wait_rusage
+from benchmarks.standins import StandinUpstream, _free_port, serve
+
+# How long to wait for the final progress update once the response is in.
+FINAL_UPDATE_WAIT = 2.0
+
+
+def payload(index, args, job_id):
+    # Each job's AOI is shifted so cache keys differ; the stand-ins answer the same anyway.
+    shift = 0 if args.identical else index * 0.001
+    ring = [[77.5 + shift, 12.9], [77.6 + shift, 12.9], [77.6 + shift, 13.0], [77.5 + shift, 12.9]]
+    return {
+        "geojson": {"type": "Polygon", "coordinates": [ring]},
+        "startDate": "2024-01-01",
+        "endDate": f"2024-{args.months:02d}-28",
+        "flag": args.flag,
+        "jobId": job_id,
+    }
+
+
+@contextmanager
+def serve_app(upstream_url, args):
+    # The application in its own uvicorn process, pointed at the stand-ins; yields the base
+    # URL and a dict that gets the server's peak RSS once it has stopped.
+    port = _free_port("127.0.0.1")
+    env = {
+        **os.environ,
+        "GEE_SERVICE_URL": upstream_url,
+        "MODEL_SERVICE_URL": upstream_url,
+        "JOBS_MAX_CONCURRENT": str(args.jobs),
+        "JOBS_MAX_QUEUED": str(max(args.concurrency, 50)),
+        "UPSTREAM_MAX_CONNECTIONS": str(max(args.concurrency * 4, 20)),
+        "RESULTS_ECHO": "0",
+    }
+    log = open(args.server_log, "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "crop_mapping_backend.asgi:application", "--port", str(port),
+         "--log-level", "warning", "--lifespan", "on"],
+        env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    stats = {}
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(f"{base_url}/metrics", timeout=1)
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("application server failed to start")
+                time.sleep(0.1)
+        yield base_url, stats
+    finally:
+        process.terminate()
+        _, stats["peak_rss_mib"] = wait_rusage(process)
+        log.close()
+
+
+async def run_job(client, base_url, index, args):
+    job_id = f"load-{uuid.uuid4().hex[:12]}"
+    ws_url = base_url.replace("http", "ws", 1) + f"/ws/progress/{job_id}"
+    record = {"status": None, "latency_s": None, "first_progress_s": None, "updates": 0, "final": False}
+    async with websockets.connect(ws_url) as socket:
+        await socket.recv()  # "WebSocket Connected"
+        start = time.perf_counter()
+
+        async def read_progress():
+            async for raw in socket:
+                message = json.loads(raw)
+                if message.get("type") not in ("progress", "error"):
+                    continue
+                if record["first_progress_s"] is None:
+                    record["first_progress_s"] = time.perf_counter() - start
+                record["updates"] += 1
+                if message.get("type") == "error" or message.get("endProgress") == 100:
+                    record["final"] = True
+                    return
+
+        reader = asyncio.create_task(read_progress())
+        try:
+            response = await client.post(f"{base_url}/api/fetch-indices/", json=payload(index, args, job_id))
+            await response.aread()
+            record["status"] = response.status_code
+        except httpx.HTTPError as e:
+            record["status"] = type(e).__name__
+        record["latency_s"] = time.perf_counter() - start
+        try:
+            await asyncio.wait_for(reader, FINAL_UPDATE_WAIT)
+        except asyncio.TimeoutError:
+            pass
+    return record
+
+
+async def run(base_url, args):
+    slots = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+
+        async def one(index):
+            async with slots:
+                return await run_job(client, base_url, index, args)
+
+        # A few jobs first, so connection setup and imports are not in the numbers.
+        await asyncio.gather(*(one(-1 - i) for i in range(min(args.warmup, args.requests))))
+        start = time.perf_counter()
+        records = await asyncio.gather(*(one(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+
+    ok = [r for r in records if r["status"] == 200]
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "pixels": args.pixels,
+        "months": args.months,
+        "flag": args.flag,
+        "ok": len(ok),
+        "status": dict(Counter(str(r["status"]) for r in records)),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(ok) / elapsed, 2),
+        "pixels_per_s": round(len(ok) * args.pixels / elapsed, 1),
+        "latency_s": percentiles([r["latency_s"] for r in ok]),
+        "first_progress_s": percentiles([r["first_progress_s"] for r in records if r["first_progress_s"] is not None]),
+        "updates_per_job": round(sum(r["updates"] for r in records) / len(records), 1),
+        "final_update_missing": sum(1 for r in ok if not r["final"]),
+    }
+
+
+def main(args):
+    if args.url:
+        report = asyncio.run(run(args.url.rstrip("/"), args))
+        report["server_peak_rss_mib"] = None
+    else:
+        upstream = StandinUpstream(
+            pixels=args.pixels, months=args.months, latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, model_latency=args.model_latency, model_error_rate=args.model_error_rate,
+            seed=args.seed,
+        )
+        with serve(upstream) as upstream_url, serve_app(upstream_url, args) as (base_url, stats):
+            report = asyncio.run(run(base_url, args))
+        report["server_peak_rss_mib"] = stats["peak_rss_mib"]
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "benchmarks": {"load": {"rows": [report]}}}, f, indent=2)
+    print(json.dumps(report))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10, help="jobs in flight at once")
+    parser.add_argument("--warmup", type=int, default=2, help="jobs run before measuring")
+    parser.add_argument("--flag", action="store_true", help="run model inference (flag=true)")
+    parser.add_argument("--identical", action="store_true", help="send the same AOI for every job")
+    parser.add_argument("--jobs", type=int, default=4, help="JOBS_MAX_CONCURRENT of the server")
+    parser.add_argument("--url", default=None, help="load an already running server instead")
+    parser.add_argument("--server-log", default=os.devnull, help="file for the application server's output")
+    parser.add_argument("--output", default=None, help="also write the report, with the environment, to this file")
+    standin = parser.add_argument_group("stand-in upstreams")
+    standin.add_argument("--pixels", type=int, default=1000, help="pixels per extraction response")
+    standin.add_argument("--months", type=int, default=3)
+    standin.add_argument("--latency", type=float, default=0.2, help="seconds per extraction request")
+    standin.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds per extraction request")
+    standin.add_argument("--error-rate", type=float, default=0.0, help="fraction of extraction requests answered with 503")
+    standin.add_argument("--model-latency", type=float, default=0.05)
+    standin.add_argument("--model-error-rate", type=float, default=0.0)
+    standin.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
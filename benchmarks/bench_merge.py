@@ -0,0 +1,121 @@
+"""
+Micro-benchmark of S1/S2 response parsing, merge and feature-table build.
+
+Compares json.loads of the response bodies plus the previous nested-dict loops with
+the streamed parse into ExtractionBlocks and the columnar merge in api.features, at
+several pixel counts, reporting wall time and tracemalloc peak memory.
+
+    python -m benchmarks.bench_merge --pixels 10000 100000 1000000 --months 6
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+import pandas as pd
+
+from api.features import S2_FEATURES, ExtractionBlock, feature_table, merge_s1_s2
+from api.streaming import ObjectReader
+from benchmarks.standins import S1_FEATURES, synthetic_pixels
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def legacy_merge(s1_body, s2_body):
+    s1_vals = json.loads(s1_body)
+    s2_vals = json.loads(s2_body)
+    s2_default = {f: 0 for f in S2_FEATURES}
+    combined_input = {}
+    for key in s1_vals:
+        s1_monthly = s1_vals.get(key, {})
+        s2_monthly = s2_vals.get(key, {})
+        monthly_combined = {}
+        for month in s1_monthly.keys():
+            s1_features = s1_monthly.get(month, {})
+            s2_features = s2_monthly.get(month, s2_default)
+            merged_features = {f: s1_features.get(f, 0) for f in S1_FEATURES}
+            for k in s2_default:
+                merged_features[k] = s2_features.get(k, 0)
+            monthly_combined[month] = merged_features
+        combined_input[key] = monthly_combined
+    return combined_input
+
+
+def legacy_table(combined_input):
+    rows = []
+    all_features = S1_FEATURES + S2_FEATURES
+    for key, month_data in combined_input.items():
+        lon, lat = map(float, key.split(","))
+        row = {"lon": lon, "lat": lat}
+        for month, features in month_data.items():
+            for feat in all_features:
+                row[f"{feat}_{month}"] = features.get(feat, 0)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def streamed_merge(s1_body, s2_body):
+    blocks = []
+    for body, features in ((s1_body, S1_FEATURES), (s2_body, S2_FEATURES)):
+        block = ExtractionBlock(features)
+        reader = ObjectReader()
+        for offset in range(0, len(body), CHUNK_SIZE):
+            for key, monthly in reader.feed(body[offset:offset + CHUNK_SIZE]):
+                block.add(key, monthly)
+        for key, monthly in reader.close():
+            block.add(key, monthly)
+        blocks.append(block)
+    return merge_s1_s2(*blocks)
+
+
+def measure(func, *args):
+    # Timed without tracing (tracemalloc slows allocation-heavy code several times over),
+    # then run again under tracemalloc for the peak.
+    gc.collect()
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def run(pixels, months):
+    s1 = json.dumps(synthetic_pixels(pixels, months, S1_FEATURES)).encode()
+    s2 = json.dumps(synthetic_pixels(pixels, months, S2_FEATURES, seed=1)).encode()
+
+    combined, legacy_merge_s, legacy_merge_peak = measure(legacy_merge, s1, s2)
+    legacy_df, legacy_table_s, legacy_table_peak = measure(legacy_table, combined)
+    del combined
+    cube, merge_s, merge_peak = measure(streamed_merge, s1, s2)
+    df, table_s, table_peak = measure(feature_table, cube)
+
+    pd.testing.assert_frame_equal(df, legacy_df.astype(df.dtypes.to_dict()), check_exact=False, rtol=1e-6)
+    mib = 1024 * 1024
+    return {
+        "pixels": pixels,
+        "months": months,
+        "body_mib": round((len(s1) + len(s2)) / mib, 1),
+        "matrix_mib": round(cube.values.nbytes / mib, 1),
+        "legacy_merge_s": round(legacy_merge_s, 3),
+        "legacy_table_s": round(legacy_table_s, 3),
+        "legacy_peak_mib": round(max(legacy_merge_peak, legacy_table_peak) / mib, 1),
+        "streamed_merge_s": round(merge_s, 3),
+        "streamed_table_s": round(table_s, 3),
+        "streamed_peak_mib": round(max(merge_peak, table_peak) / mib, 1),
+        "speedup": round((legacy_merge_s + legacy_table_s) / (merge_s + table_s), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pixels", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--months", type=int, default=6)
+    args = parser.parse_args()
+    for pixels in args.pixels:
+        print(json.dumps(run(pixels, args.months)))
@@ -0,0 +1,52 @@
+"""
+Micro-benchmark of the fetch-indices response formats.
+
+Encodes the same prediction map as a GeoJSON FeatureCollection, as packed typed-array
+JSON, as binary columns and as PNG/GeoTIFF rasters, reporting encode time and body
+size per format.
+
+    python -m benchmarks.bench_output --pixels 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crop_mapping_backend.settings")
+
+import django
+
+django.setup()
+
+import numpy as np
+
+from api.output import BINARY, GEOJSON, GEOTIFF, PACKED, PNG, PredictionMap, render_result
+
+
+def synthetic_map(pixels):
+    i = np.arange(pixels)
+    coords = np.column_stack([77.5 + (i % 1000) * 0.0001, 12.9 + (i // 1000) * 0.0001])
+    return PredictionMap(coords, (i % 2).astype(np.int64))
+
+
+def run(pixels, repeat):
+    result = {"output": {"map": synthetic_map(pixels), "metrics": {"ragiCoverage": 50.0, "nonRagiCoverage": 50.0}}}
+    report = {"pixels": pixels}
+    for fmt in (GEOJSON, PACKED, BINARY, PNG, GEOTIFF):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = render_result(result, fmt, jobId="bench")
+            timings.append(time.perf_counter() - start)
+        report[f"{fmt}_encode_s"] = round(min(timings), 4)
+        report[f"{fmt}_kib"] = round(len(response.content) / 1024, 1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pixels", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    for pixels in args.pixels:
+        print(json.dumps(run(pixels, args.repeat)))
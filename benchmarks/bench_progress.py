@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of progress delivery through the channel layer.
+
+One job sends a burst of progress updates (as many tiles and model batches would) through
+api.progress.JobProgress on one channel layer instance, while a socket's channel on a
+second instance (another replica, with --redis) receives them. Reports updates sent,
+channel-layer messages, messages received and whether the final state arrived, per
+coalescing interval.
+
+    python -m benchmarks.bench_progress --updates 500 --coalesce-ms 0 50 250
+    python -m benchmarks.bench_progress --redis redis://localhost:6379/0
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crop_mapping_backend.settings")
+
+import django
+
+django.setup()
+
+from channels.layers import InMemoryChannelLayer
+
+from api.progress import JobProgress, job_group
+
+
+def channel_layers(redis_url):
+    if redis_url is None:
+        layer = InMemoryChannelLayer()
+        return layer, layer
+    from channels_redis.core import RedisChannelLayer
+
+    return RedisChannelLayer(hosts=[redis_url], prefix="bench"), RedisChannelLayer(hosts=[redis_url], prefix="bench")
+
+
+class CountingLayer:
+    # Counts group_send calls (channel-layer round trips) of the wrapped layer.
+    def __init__(self, layer):
+        self.layer = layer
+        self.sends = 0
+
+    async def group_send(self, group, message):
+        self.sends += 1
+        await self.layer.group_send(group, message)
+
+
+async def run(updates, interval, gap, redis_url):
+    sender, receiver = channel_layers(redis_url)
+    job_id = f"bench{int(interval * 1000)}"
+    channel = await receiver.new_channel()
+    await receiver.group_add(job_group(job_id), channel)
+
+    received = []
+
+    async def receive():
+        while True:
+            message = await receiver.receive(channel)
+            received.append(message["message"])
+            if message["message"].get("endProgress") == 100:
+                return
+
+    receiving = asyncio.create_task(receive())
+    layer = CountingLayer(sender)
+    progress = JobProgress(job_id, layer, interval=interval)
+    start = time.perf_counter()
+    for n in range(1, updates + 1):
+        await progress.send("progress", startProgress=10 + 88 * (n - 1) // updates, endProgress=10 + 88 * n // updates, message=f"{n}/{updates}")
+        await asyncio.sleep(gap)
+    await progress.send("progress", startProgress=98, endProgress=100, message="Output generated successfully.")
+    await asyncio.wait_for(receiving, 30)
+    elapsed = time.perf_counter() - start
+    await receiver.group_discard(job_group(job_id), channel)
+    return {
+        "coalesce_ms": int(interval * 1000),
+        "updates": updates + 1,
+        "channel_messages": layer.sends,
+        "received": len(received),
+        "final_received": received[-1]["endProgress"] == 100,
+        "elapsed_s": round(elapsed, 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--gap-ms", type=float, default=2, help="time between updates")
+    parser.add_argument("--coalesce-ms", type=int, nargs="+", default=[0, 50, 250])
+    parser.add_argument("--redis", default=None, help="Redis URL; default is the in-memory layer")
+    args = parser.parse_args()
+    for coalesce_ms in args.coalesce_ms:
+        report = asyncio.run(run(args.updates, coalesce_ms / 1000, args.gap_ms / 1000, args.redis))
+        print(json.dumps(report))
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark of result serialization and compression.
+
+Encodes a synthetic fetch-indices result (GeoJSON map plus the raw S1/S2 "results"
+echo) with Django's JsonResponse, with api.encoding on the stdlib encoder and on
+orjson, then gzip/brotli-compresses the body, reporting time and bytes for each.
+
+    python -m benchmarks.bench_serialization --pixels 100000 --months 6
+"""
+import argparse
+import gzip
+import json
+import os
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crop_mapping_backend.settings")
+
+import django
+
+django.setup()
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from api import encoding
+from benchmarks.bench_output import synthetic_map
+from benchmarks.standins import S1_FEATURES, S2_FEATURES, synthetic_pixels
+
+
+def best_of(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+    return result, round(min(timings), 3)
+
+
+def run(pixels, months, repeat):
+    result = {
+        "output": {"map": synthetic_map(pixels).to_geojson(), "metrics": {"ragiCoverage": 50.0, "nonRagiCoverage": 50.0}},
+        "results": {
+            "s1": synthetic_pixels(pixels, months, S1_FEATURES),
+            "s2": synthetic_pixels(pixels, months, S2_FEATURES, seed=1),
+        },
+        "jobId": "bench",
+    }
+    report = {"pixels": pixels, "months": months}
+
+    response, report["django_json_s"] = best_of(repeat, JsonResponse, result)
+    report["django_json_mib"] = round(len(response.content) / 1024 / 1024, 1)
+
+    for serializer in ("json", "orjson"):
+        if serializer == "orjson" and encoding.orjson is None:
+            continue
+        settings.JSON_SERIALIZER = serializer
+        body, report[f"{serializer}_s"] = best_of(repeat, encoding.dumps, result)
+        report[f"{serializer}_mib"] = round(len(body) / 1024 / 1024, 1)
+
+    conf = settings.RESPONSE_COMPRESSION
+    compressed, report["gzip_s"] = best_of(repeat, gzip.compress, body, conf["GZIP_LEVEL"])
+    report["gzip_mib"] = round(len(compressed) / 1024 / 1024, 1)
+    if encoding.brotli is not None:
+        compressed, report["brotli_s"] = best_of(repeat, lambda data: encoding.brotli.compress(data, quality=conf["BROTLI_QUALITY"]), body)
+        report["brotli_mib"] = round(len(compressed) / 1024 / 1024, 1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pixels", type=int, nargs="+", default=[100000])
+    parser.add_argument("--months", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    for pixels in args.pixels:
+        print(json.dumps(run(pixels, args.months, args.repeat)))
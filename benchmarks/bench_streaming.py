@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of buffered vs streamed fetch-indices responses.
+
+For synthetic prediction maps of growing size, measures time-to-first-byte and the
+tracemalloc peak while producing the whole body, once for the buffered GeoJSON
+response and once for the streamed GeoJSON and NDJSON bodies.
+
+    python -m benchmarks.bench_streaming --pixels 10000 100000 1000000
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import time
+import tracemalloc
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crop_mapping_backend.settings")
+
+import django
+
+django.setup()
+
+from api.output import GEOJSON, NDJSON, render_result, streaming_response
+from benchmarks.bench_output import synthetic_map
+
+
+async def buffered(result):
+    start = time.perf_counter()
+    response = render_result(result, GEOJSON, jobId="bench")
+    return time.perf_counter() - start, len(response.content)
+
+
+async def streamed(result, fmt):
+    start = time.perf_counter()
+    ttfb, size = None, 0
+    async for chunk in streaming_response(result, fmt, jobId="bench").streaming_content:
+        if ttfb is None:
+            ttfb = time.perf_counter() - start
+        size += len(chunk)
+    return ttfb, size
+
+
+def measure(coroutine):
+    gc.collect()
+    tracemalloc.start()
+    ttfb, size = asyncio.run(coroutine)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ttfb, size, peak
+
+
+def run(pixels):
+    result = {"output": {"map": synthetic_map(pixels), "metrics": {"ragiCoverage": 50.0, "nonRagiCoverage": 50.0}}}
+    mib = 1024 * 1024
+    report = {"pixels": pixels}
+    for name, coroutine in (("buffered", buffered(result)), ("stream_geojson", streamed(result, GEOJSON)), ("stream_ndjson", streamed(result, NDJSON))):
+        ttfb, size, peak = measure(coroutine)
+        report[f"{name}_ttfb_ms"] = round(ttfb * 1000, 1)
+        report[f"{name}_peak_mib"] = round(peak / mib, 1)
+        report[f"{name}_mib"] = round(size / mib, 1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pixels", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+    for pixels in args.pixels:
+        print(json.dumps(run(pixels)))
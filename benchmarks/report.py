@@ -0,0 +1,97 @@
+# Helpers shared by the load generator and the suite: latency percentiles, peak RSS of
+# child processes, the environment a report was taken in, and comparing two reports.
+import os
+import platform
+import subprocess
+
+import numpy as np
+
+# Report keys where a larger value is a regression, and those where a smaller one is.
+LOWER_IS_BETTER = ("_s", "_ms", "_mib", "_kib", "p50", "p95", "p99")
+HIGHER_IS_BETTER = ("_per_s", "_rps", "speedup")
+# Timings that stay under this many seconds are noise, not regressions.
+MIN_SECONDS = 0.005
+
+
+def percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50": round(p50, 4), "p95": round(p95, 4), "p99": round(p99, 4), "max": round(max(samples), 4)}
+
+
+def wait_rusage(process):
+    # Reaps a subprocess.Popen child and returns (returncode, peak RSS in MiB) from wait4;
+    # ru_maxrss is in KiB on Linux.
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, round(rusage.ru_maxrss / 1024, 1)
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def _direction(key):
+    if key.endswith(HIGHER_IS_BETTER):
+        return -1
+    if key.endswith(LOWER_IS_BETTER):
+        return 1
+    return 0
+
+
+def _seconds(key, value):
+    if key.endswith("_ms"):
+        return value / 1000
+    if key.endswith(("_s", "p50", "p95", "p99")) and not key.endswith("_per_s"):
+        return value
+    return None
+
+
+def _flatten(row, prefix=""):
+    for key, value in row.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+def compare(baseline, current, tolerance):
+    # Rows are matched by benchmark name and position. Returns one entry per metric that got
+    # worse by more than `tolerance` (0.2 = 20%).
+    regressions = []
+    for name, result in current["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        for index, (old_row, new_row) in enumerate(zip(base["rows"], result["rows"])):
+            old = dict(_flatten(old_row))
+            for key, value in _flatten(new_row):
+                direction = _direction(key)
+                previous = old.get(key)
+                if not direction or not previous:
+                    continue
+                seconds = _seconds(key, value)
+                if seconds is not None and max(seconds, _seconds(key, previous)) < MIN_SECONDS:
+                    continue
+                change = (value - previous) / previous * direction
+                if change > tolerance:
+                    regressions.append({"benchmark": name, "row": index, "metric": key, "baseline": previous,
+                                        "current": value, "change": round(change, 3)})
+        if base.get("peak_rss_mib") and result.get("peak_rss_mib"):
+            change = (result["peak_rss_mib"] - base["peak_rss_mib"]) / base["peak_rss_mib"]
+            if change > tolerance:
+                regressions.append({"benchmark": name, "row": None, "metric": "peak_rss_mib",
+                                    "baseline": base["peak_rss_mib"], "current": result["peak_rss_mib"],
+                                    "change": round(change, 3)})
+    return regressions
@@ -0,0 +1,201 @@
+# Local stand-ins for the GEE extraction and model microservices used by the benchmarks.
+# Run on its own to point a real deployment at it (GEE_SERVICE_URL and MODEL_SERVICE_URL):
+#
+#     python -m benchmarks.standins --port 4000 --pixels 5000 --months 6 --latency 1 --error-rate 0.05
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import socket
+import time
+from contextlib import contextmanager
+
+import uvicorn
+
+S1_FEATURES = ["VV", "VH", "VH_VV"]
+S2_FEATURES = ["NDVI", "EVI", "GNDVI", "SAVI", "NDWI", "NDMI", "RENDVI"]
+
+
+def month_labels(start_date, end_date):
+    # "YYYY-MM" for every month from start_date to end_date (ISO dates).
+    year, month = int(start_date[:4]), int(start_date[5:7])
+    labels = []
+    while (year, month) <= (int(end_date[:4]), int(end_date[5:7])):
+        labels.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return labels
+
+
+def synthetic_pixels(pixels, months, features, seed=0, labels=None):
+    # Values depend on the pixel and the month label only, so any date range gives the same
+    # numbers for the months it shares with another.
+    labels = labels or [f"2024-{m + 1:02d}" for m in range(months)]
+    result = {}
+    for i in range(pixels):
+        lon = round(77.5 + (i % 1000) * 0.0001, 6)
+        lat = round(12.9 + (i // 1000) * 0.0001, 6)
+        monthly = {}
+        for label in labels:
+            m = int(label[:4]) * 12 + int(label[5:7])
+            monthly[label] = {f: round(((i + m + seed) % 97) / 97, 4) for f in features}
+        result[f"{lon},{lat}"] = monthly
+    return result
+
+
+class StandinUpstream:
+    # Extraction requests take latency plus up to jitter seconds. Prediction requests take
+    # model_latency + rows * model_row_cost seconds, with at most model_workers processed
+    # at once (like a model server with N workers). A fraction error_rate of the requests to
+    # each service is answered with 503 after its latency, from a seeded generator so runs
+    # are repeatable.
+    def __init__(self, pixels=100, months=3, latency=0.5, model_latency=0.05, model_row_cost=0.00002, model_workers=4,
+                 jitter=0.0, error_rate=0.0, model_error_rate=0.0, seed=0):
+        self.pixels = pixels
+        self.months = months
+        self.latency = latency
+        self.model_latency = model_latency
+        self.model_row_cost = model_row_cost
+        self.model_workers = model_workers
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.model_error_rate = model_error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._bodies = {}
+        self._model_slots = None
+
+    def _labels(self, request_body):
+        # The months of the requested date range, or `months` months from January 2024.
+        try:
+            request = json.loads(request_body)
+            return tuple(month_labels(request["start_date"], request["end_date"]))
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _body(self, path, labels=None):
+        if (path, labels) not in self._bodies:
+            if path.endswith("extract-s1-parameters"):
+                data = synthetic_pixels(self.pixels, self.months, S1_FEATURES, labels=labels)
+            elif path.endswith("extract-s2-parameters"):
+                data = synthetic_pixels(self.pixels, self.months, S2_FEATURES, seed=1, labels=labels)
+            else:
+                data = {"type": "FeatureCollection", "features": []}
+            self._bodies[path, labels] = json.dumps(data).encode()
+        return self._bodies[path, labels]
+
+    async def _read_body(self, receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return body
+
+    async def _predict(self, request_body):
+        rows = json.loads(request_body)
+        if self._model_slots is None:
+            self._model_slots = asyncio.Semaphore(self.model_workers)
+        async with self._model_slots:
+            await asyncio.sleep(self.model_latency + len(rows) * self.model_row_cost)
+        predictions = []
+        for row in rows:
+            item = {"lon": row["lon"], "lat": row["lat"], "prediction": int((row["lon"] + row["lat"]) * 10000) % 2}
+            if "id" in row:
+                item["id"] = row["id"]
+            predictions.append(item)
+        return json.dumps(predictions).encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        request_body = await self._read_body(receive)
+        self.requests += 1
+        status = 200
+        if scope["path"].endswith("crop-prediction-transformer"):
+            if self.random.random() < self.model_error_rate:
+                await asyncio.sleep(self.model_latency)
+                status, body = 503, b'{"error": "stand-in failure"}'
+            else:
+                body = await self._predict(request_body)
+        else:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+            if self.random.random() < self.error_rate:
+                status, body = 503, b'{"error": "stand-in failure"}'
+            else:
+                body = self._body(scope["path"], self._labels(request_body))
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def _free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def _run(app, host, port):
+    uvicorn.run(app, host=host, port=port, log_level="warning", lifespan="on")
+
+
+@contextmanager
+def serve(app, host="127.0.0.1"):
+    # The stand-in runs in its own process so it does not compete for the GIL with the
+    # code under test.
+    port = _free_port(host)
+    process = multiprocessing.Process(target=_run, args=(app, host, port), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=0.1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                process.terminate()
+                raise RuntimeError("stand-in upstream failed to start")
+            time.sleep(0.05)
+    try:
+        yield f"http://{host}:{port}"
+    finally:
+        process.terminate()
+        process.join()
+
+
+def point_upstreams(base_url, names=("gee", "model", "mock")):
+    from django.conf import settings
+
+    for name in names:
+        settings.UPSTREAMS[name]["BASE_URL"] = base_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in GEE extraction and model microservices")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--pixels", type=int, default=100, help="pixels per extraction response")
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per extraction request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds per extraction request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of extraction requests answered with 503")
+    parser.add_argument("--model-latency", type=float, default=0.05, help="fixed seconds per model request")
+    parser.add_argument("--row-cost", type=float, default=0.00002, help="model seconds per pixel")
+    parser.add_argument("--model-workers", type=int, default=4, help="requests the model processes at once")
+    parser.add_argument("--model-error-rate", type=float, default=0.0, help="fraction of model requests answered with 503")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    _run(StandinUpstream(
+        pixels=args.pixels, months=args.months, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        model_latency=args.model_latency, model_row_cost=args.row_cost, model_workers=args.model_workers,
+        model_error_rate=args.model_error_rate, seed=args.seed,
+    ), args.host, args.port)
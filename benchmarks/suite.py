@@ -0,0 +1,109 @@
+"""
+Runs a fixed set of the benchmarks and writes one JSON report that can be compared
+between commits.
+
+Each benchmark runs in its own process, so its peak RSS (from wait4) is its own. The
+report holds the environment (commit, Python, platform, CPUs) and, per benchmark, the
+JSON rows it printed, its wall time and peak RSS. With --baseline, metrics that got worse
+than the baseline by more than --tolerance are listed and the exit status is 1.
+
+    python -m benchmarks.suite --output bench-main.json
+    python -m benchmarks.suite --baseline bench-main.json --output bench-branch.json
+    python -m benchmarks.suite --profile full --only merge load
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.report import compare, environment, wait_rusage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (module, arguments) per profile. "quick" takes a few minutes on a laptop.
+PROFILES = {
+    "quick": {
+        "merge": ("benchmarks.bench_merge", ["--pixels", "10000", "50000", "--months", "6"]),
+        "output": ("benchmarks.bench_output", ["--pixels", "10000", "100000"]),
+        "streaming": ("benchmarks.bench_streaming", ["--pixels", "100000"]),
+        "progress": ("benchmarks.bench_progress", ["--updates", "500"]),
+        "inference": ("benchmarks.bench_inference", ["--pixels", "20000", "--batch-sizes", "5000", "--inflight", "1", "4"]),
+        "load": ("benchmarks.bench_load", ["--requests", "60", "--concurrency", "10", "--pixels", "1000", "--flag"]),
+    },
+    "full": {
+        "merge": ("benchmarks.bench_merge", ["--pixels", "10000", "100000", "1000000", "--months", "6"]),
+        "output": ("benchmarks.bench_output", ["--pixels", "10000", "100000", "1000000"]),
+        "streaming": ("benchmarks.bench_streaming", ["--pixels", "100000", "1000000"]),
+        "serialization": ("benchmarks.bench_serialization", ["--pixels", "100000"]),
+        "progress": ("benchmarks.bench_progress", ["--updates", "500"]),
+        "inference": ("benchmarks.bench_inference", ["--pixels", "50000"]),
+        "views": ("benchmarks.bench_async_views", ["--concurrency", "8", "32"]),
+        "load": ("benchmarks.bench_load", ["--requests", "200", "--concurrency", "20", "--pixels", "5000", "--flag"]),
+        "load_errors": ("benchmarks.bench_load", [
+            "--requests", "200", "--concurrency", "20", "--pixels", "5000", "--flag",
+            "--error-rate", "0.05", "--jitter", "0.5"]),
+    },
+}
+
+
+def run_benchmark(module, arguments):
+    # The JSON objects the benchmark prints, one per line, are its rows; other output is
+    # passed through to stderr.
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))}
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", module, *arguments], cwd=ROOT, env=env,
+                               stdout=subprocess.PIPE, text=True)
+    rows = []
+    for line in process.stdout:
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if isinstance(row, dict):
+            rows.append(row)
+        else:
+            sys.stderr.write(line)
+    returncode, peak_rss_mib = wait_rusage(process)
+    return {
+        "command": [module, *arguments],
+        "returncode": returncode,
+        "wall_s": round(time.perf_counter() - start, 2),
+        "peak_rss_mib": peak_rss_mib,
+        "rows": rows,
+    }
+
+
+def main(args):
+    report = {"environment": environment(), "profile": args.profile, "benchmarks": {}}
+    for name, (module, arguments) in PROFILES[args.profile].items():
+        if args.only and name not in args.only:
+            continue
+        result = run_benchmark(module, arguments)
+        report["benchmarks"][name] = result
+        print(json.dumps({"benchmark": name, **{k: v for k, v in result.items() if k != "command"}}))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = [name for name, result in report["benchmarks"].items() if result["returncode"] != 0]
+    if failed:
+        print(json.dumps({"failed": failed}))
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for regression in regressions:
+            print(json.dumps({"regression": regression}))
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--only", nargs="+", default=None, help="run only these benchmarks")
+    parser.add_argument("--output", default=None, help="write the report to this file")
+    parser.add_argument("--baseline", default=None, help="a previous report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown, 0.2 = 20%%")
+    sys.exit(main(parser.parse_args()))
@@ -12,11 +12,13 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import api.routing 
+from api.lifespan import lifespan_app
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "crop_mapping_backend.settings")
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
+    "lifespan": lifespan_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             api.routing.websocket_urlpatterns
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -97,25 +100,245 @@ TEMPLATES = [
 # WSGI_APPLICATION = 'crop_mapping_backend.wsgi.application'
 ASGI_APPLICATION = "crop_mapping_backend.asgi.application"
 
-CHANNEL_LAYERS = {
+REDIS_URL = os.environ.get("REDIS_URL", "redis://redis-service:6379/0")
+
+# Channel layer for the progress sockets. "memory" only reaches sockets on the same process;
+# with several replicas use "redis", so a socket on any replica sees progress from a job on any other.
+CHANNEL_LAYER = os.environ.get("CHANNEL_LAYER", "memory")
+if CHANNEL_LAYER == "redis":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+                "prefix": "progress",
+                "capacity": int(os.environ.get("CHANNEL_LAYER_CAPACITY", 100)),
+                "expiry": int(os.environ.get("CHANNEL_LAYER_EXPIRY", 60)),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# Progress updates of a job are coalesced: at most one "progress" message per COALESCE_MS
+# carrying the latest state (0 sends every update). Errors and the final update go out at once.
+PROGRESS = {
+    "COALESCE_MS": int(os.environ.get("PROGRESS_COALESCE_MS", 250)),
+}
+
+# Upstream microservices
+# Local development: http://localhost:4000 (GEE) and http://localhost:6000 (model),
+# or http://host.docker.internal:<port> when running inside Docker.
+GEE_SERVICE_URL = os.environ.get("GEE_SERVICE_URL", "https://gee.agroscope.site")
+MODEL_SERVICE_URL = os.environ.get("MODEL_SERVICE_URL", "https://model.agroscope.site")
+MOCK_SERVICE_URL = os.environ.get("MOCK_SERVICE_URL", "http://localhost:4000")
+
+# Pooled HTTP client per upstream (see api/upstream.py). TIMEOUT is the read/write/pool
+# timeout in seconds; HTTP2 needs the optional h2 package.
+UPSTREAM_DEFAULTS = {
+    "TIMEOUT": float(os.environ.get("UPSTREAM_TIMEOUT", 60)),
+    "CONNECT_TIMEOUT": float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10)),
+    "MAX_CONNECTIONS": int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 20)),
+    "MAX_KEEPALIVE_CONNECTIONS": int(os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", 10)),
+    "KEEPALIVE_EXPIRY": float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", 30)),
+    "HTTP2": os.environ.get("UPSTREAM_HTTP2", "0") == "1",
+}
+UPSTREAMS = {
+    "gee": {
+        **UPSTREAM_DEFAULTS,
+        "BASE_URL": GEE_SERVICE_URL,
+        "TIMEOUT": float(os.environ.get("GEE_TIMEOUT", UPSTREAM_DEFAULTS["TIMEOUT"])),
+    },
+    "model": {
+        **UPSTREAM_DEFAULTS,
+        "BASE_URL": MODEL_SERVICE_URL,
+        "TIMEOUT": float(os.environ.get("MODEL_TIMEOUT", UPSTREAM_DEFAULTS["TIMEOUT"])),
+    },
+    "mock": {
+        **UPSTREAM_DEFAULTS,
+        "BASE_URL": MOCK_SERVICE_URL,
+    },
+}
+
+# Background pipeline jobs (see api/jobs.py). STORE is "local" (per-process, for development
+# and single-replica setups) or "redis" (shared by all replicas via REDIS_URL).
+# With CANCEL_ABANDONED, a job is cancelled once its last progress socket has been closed for
+# ABANDON_GRACE seconds; jobs that never had a socket are left alone.
+JOBS = {
+    "STORE": os.environ.get("JOB_STORE", "local"),
+    "TTL": int(os.environ.get("JOB_TTL", 3600)),
+    "MAX_CONCURRENT": int(os.environ.get("JOBS_MAX_CONCURRENT", 2)),
+    "MAX_QUEUED": int(os.environ.get("JOBS_MAX_QUEUED", 50)),
+    "CANCEL_ABANDONED": os.environ.get("JOBS_CANCEL_ABANDONED", "0") == "1",
+    "ABANDON_GRACE": float(os.environ.get("JOBS_ABANDON_GRACE", 10)),
+}
+# A shared channel layer means several replicas; with a local job store, the /jobs/<jobId>/
+# requests would only find a job on the replica that ran it.
+if CHANNEL_LAYER == "redis" and JOBS["STORE"] != "redis":
+    raise ImproperlyConfigured("CHANNEL_LAYER=redis needs JOB_STORE=redis, so every replica sees every job")
+# Open sockets are counted in the job store; a local one misses sockets that reconnected to
+# another replica, and would cancel their jobs.
+if JOBS["CANCEL_ABANDONED"] and JOBS["STORE"] != "redis":
+    raise ImproperlyConfigured("JOBS_CANCEL_ABANDONED=1 needs JOB_STORE=redis, so sockets on every replica are counted")
+
+# AOIs larger than one TILE_SIZE_DEG grid cell are split into tiles that are extracted
+# concurrently (at most CONCURRENCY calls per job); failed tiles are retried per RESILIENCE.
+TILING = {
+    "TILE_SIZE_DEG": float(os.environ.get("TILE_SIZE_DEG", 0.05)),
+    "MAX_TILES": int(os.environ.get("TILE_MAX_TILES", 64)),
+    "CONCURRENCY": int(os.environ.get("TILE_CONCURRENCY", 8)),
+}
+
+# Policy per upstream call (see api/resilience.py). Failed attempts (connection errors, timeouts,
+# 429 and 5xx) are retried RETRIES times after a random delay of up to BACKOFF * 2**n seconds.
+# With HEDGE, a duplicate request is sent once an attempt has run longer than the call's recent
+# HEDGE_QUANTILE latency (at least HEDGE_MIN_DELAY, after HEDGE_MIN_SAMPLES calls); the first
+# answer wins. TIMEOUT bounds each attempt (0: only the client timeout). After BREAKER_FAILURES
+# failed calls in a row the call fails fast for BREAKER_RESET seconds, then up to BREAKER_PROBES
+# trial calls are let through at a time; other calls wait for their outcome.
+RESILIENCE_DEFAULTS = {
+    "RETRIES": int(os.environ.get("UPSTREAM_RETRIES", 2)),
+    "BACKOFF": float(os.environ.get("UPSTREAM_RETRY_BACKOFF", 1.0)),
+    "HEDGE": os.environ.get("UPSTREAM_HEDGE", "0") == "1",
+    "HEDGE_QUANTILE": float(os.environ.get("UPSTREAM_HEDGE_QUANTILE", 0.95)),
+    "HEDGE_MIN_DELAY": float(os.environ.get("UPSTREAM_HEDGE_MIN_DELAY", 0.5)),
+    "HEDGE_MIN_SAMPLES": int(os.environ.get("UPSTREAM_HEDGE_MIN_SAMPLES", 20)),
+    "TIMEOUT": float(os.environ.get("UPSTREAM_ATTEMPT_TIMEOUT", 0)),
+    "BREAKER_FAILURES": int(os.environ.get("UPSTREAM_BREAKER_FAILURES", 5)),
+    "BREAKER_RESET": float(os.environ.get("UPSTREAM_BREAKER_RESET", 30)),
+    "BREAKER_PROBES": int(os.environ.get("UPSTREAM_BREAKER_PROBES", 1)),
+}
+RESILIENCE = {
+    "s1": {**RESILIENCE_DEFAULTS},
+    "s2": {**RESILIENCE_DEFAULTS},
+    "model": {
+        **RESILIENCE_DEFAULTS,
+        "HEDGE": os.environ.get("MODEL_HEDGE", "1" if RESILIENCE_DEFAULTS["HEDGE"] else "0") == "1",
+    },
+}
+
+# Model inference is split into BATCH_SIZE-pixel requests with at most MAX_INFLIGHT outstanding.
+# Predictions are joined back by position within each batch. SEND_IDS adds an integer "id"
+# column to join them by pixel id instead; only turn it on for a model that accepts the column.
+MODEL_INFERENCE = {
+    "SEND_IDS": os.environ.get("MODEL_SEND_IDS", "0") == "1",
+    "BATCH_SIZE": int(os.environ.get("MODEL_BATCH_SIZE", 5000)),
+    "MAX_INFLIGHT": int(os.environ.get("MODEL_MAX_INFLIGHT", 4)),
+}
+
+# Raster output (?format=png|geotiff|raster): predictions are snapped onto their sampling grid,
+# whose spacing is inferred from the pixel coordinates (DEFAULT_STEP_DEG, ~10 m, if it cannot be).
+RASTER = {
+    "MAX_PIXELS": int(os.environ.get("RASTER_MAX_PIXELS", 25_000_000)),
+    "DEFAULT_STEP_DEG": float(os.environ.get("RASTER_DEFAULT_STEP_DEG", 10 / 111320)),
+}
+
+# Vector tiles of finished jobs (/api/jobs/<id>/tiles/{z}/{x}/{y}.mvt): pixels are points from
+# DETAIL_ZOOM up and AGGREGATE_CELLS x AGGREGATE_CELLS ragi-fraction cells per tile below it.
+TILES = {
+    "DETAIL_ZOOM": int(os.environ.get("TILES_DETAIL_ZOOM", 14)),
+    "AGGREGATE_CELLS": int(os.environ.get("TILES_AGGREGATE_CELLS", 64)),
+    "INDEX_CACHE_BYTES": int(os.environ.get("TILES_INDEX_CACHE_BYTES", 128 * 1024 * 1024)),
+    "TILE_CACHE_BYTES": int(os.environ.get("TILES_TILE_CACHE_BYTES", 64 * 1024 * 1024)),
+    "CACHE_TTL": int(os.environ.get("TILES_CACHE_TTL", 3600)),
+}
+
+# Cache for S1/S2 extraction results keyed on canonical geometry + date range (see api/cache.py).
+# The in-process LRU tier holds up to MAX_BYTES of response bodies; set EXTRACTION_CACHE_SHARED=redis
+# to add a tier shared by all replicas through the "extraction" Django cache.
+EXTRACTION_CACHE = {
+    "ENABLED": os.environ.get("EXTRACTION_CACHE_ENABLED", "1") == "1",
+    "MAX_BYTES": int(os.environ.get("EXTRACTION_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    "TTL": int(os.environ.get("EXTRACTION_CACHE_TTL", 6 * 3600)),
+    "SHARED_ALIAS": "extraction" if os.environ.get("EXTRACTION_CACHE_SHARED") == "redis" else None,
+    "SHARED_TTL": int(os.environ.get("EXTRACTION_CACHE_SHARED_TTL", 24 * 3600)),
+}
+
+# Persistent spatial store in the CropData table (see api/store.py; needs `manage.py migrate`,
+# which the Docker image runs on start). Off by default: it only pays off in a database shared by
+# the replicas and kept across rollouts (see DATABASES), not in each pod's SQLite file.
+# Successful jobs save their S1/S2 extractions per grid tile and their predictions per grid cell
+# of CELL_SIZE_DEG; with REUSE, tiles of later AOIs inside a stored whole-cell tile are read from
+# it instead of the extraction services. Queries returning more than MAX_QUERY_PIXELS get 422.
+SPATIAL_STORE = {
+    "ENABLED": os.environ.get("SPATIAL_STORE_ENABLED", "0") == "1",
+    "REUSE": os.environ.get("SPATIAL_STORE_REUSE", "1") == "1",
+    "BATCH_SIZE": int(os.environ.get("SPATIAL_STORE_BATCH_SIZE", 100)),
+    "CELL_SIZE_DEG": float(os.environ.get("SPATIAL_STORE_CELL_SIZE_DEG", TILING["TILE_SIZE_DEG"])),
+    "MAX_QUERY_PIXELS": int(os.environ.get("SPATIAL_STORE_MAX_QUERY_PIXELS", 5_000_000)),
+}
+
+# Batch submissions (api/batch.py): the AOIs of one FeatureCollection go through one pipeline
+# run over their union, at most MAX_AOIS features per batch.
+BATCH = {
+    "MAX_AOIS": int(os.environ.get("BATCH_MAX_AOIS", 200)),
+}
+
+CACHES = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-        # "BACKEND": "channels_redis.core.RedisChannelLayer",
-        # "CONFIG": {
-        #     "hosts": [("redis-service", 6379)],
-        # },
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
     },
 }
+if EXTRACTION_CACHE["SHARED_ALIAS"]:
+    CACHES["extraction"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+    }
+
+# JSON encoder for results and model requests: "auto" uses orjson when installed, "json" forces the stdlib.
+JSON_SERIALIZER = os.environ.get("JSON_SERIALIZER", "auto")
+
+# Results, tiles and other large responses are gzip/brotli compressed when the client accepts it
+# (brotli needs the optional "brotli" package).
+RESPONSE_COMPRESSION = {
+    "ENABLED": os.environ.get("RESPONSE_COMPRESSION", "1") == "1",
+    "MIN_BYTES": int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", 1024)),
+    "GZIP_LEVEL": int(os.environ.get("RESPONSE_GZIP_LEVEL", 5)),
+    "BROTLI_QUALITY": int(os.environ.get("RESPONSE_BROTLI_QUALITY", 5)),
+}
+
+# Raw S1/S2 extraction results in GeoJSON responses: ECHO is the default for requests without
+# ?results=0|1. Jobs keep them for paging through /api/jobs/<id>/results/ either way, stored in
+# chunks of CHUNK_SIZE pixels so that a page reads only the chunks it covers.
+RESULTS = {
+    "ECHO": os.environ.get("RESULTS_ECHO", "1") == "1",
+    "PAGE_SIZE": int(os.environ.get("RESULTS_PAGE_SIZE", 1000)),
+    "MAX_PAGE_SIZE": int(os.environ.get("RESULTS_MAX_PAGE_SIZE", 10000)),
+    "CHUNK_SIZE": int(os.environ.get("RESULTS_CHUNK_SIZE", 5000)),
+}
+
+# Request bodies at least this large are parsed in a worker thread instead of on the event loop
+ASYNC_OFFLOAD_BYTES = int(os.environ.get("ASYNC_OFFLOAD_BYTES", 64 * 1024))
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite in the project directory by default, which is per pod and lost on each rollout. Set
+# DATABASE_ENGINE (e.g. django.db.backends.postgresql, which needs psycopg) and the other
+# DATABASE_* variables to share one database between replicas, e.g. for the spatial store.
+DATABASE_ENGINE = os.environ.get("DATABASE_ENGINE", "django.db.backends.sqlite3")
+if DATABASE_ENGINE == "django.db.backends.sqlite3":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get("DATABASE_NAME", BASE_DIR / 'db.sqlite3'),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': DATABASE_ENGINE,
+            'NAME': os.environ.get("DATABASE_NAME", ""),
+            'HOST': os.environ.get("DATABASE_HOST", ""),
+            'PORT': os.environ.get("DATABASE_PORT", ""),
+            'USER': os.environ.get("DATABASE_USER", ""),
+            'PASSWORD': os.environ.get("DATABASE_PASSWORD", ""),
+        }
     }
-}
 
 
 # Password validation
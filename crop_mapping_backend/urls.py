@@ -16,10 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from api.views import home_view 
+from api.views import home_view, metrics_view
 
 urlpatterns = [
     path("", home_view), 
     path('admin/', admin.site.urls),
+    path("metrics", metrics_view),
     path("api/", include("api.urls"))
 ]